@@ -1,17 +1,27 @@
 from __future__ import division, unicode_literals
 
+import binascii
+import contextlib
+import errno
+import io
 import os
-import shutil
+import threading
+import time
 import warnings
 
-from file_archive.compat import string_types, sha1
-from file_archive.database import normalize_metadata, MetadataStore
+from file_archive.blobs import (blob_kind, chunk_path, map_blob, open_blob,
+                                read_directory, read_refs, write_blob,
+                                write_chunked, write_directory)
+from file_archive.compat import BytesIO, scandir, string_types
+from file_archive.database import (normalize_metadata, GroupCommit,
+                                   MetadataStore)
 from file_archive.errors import CreationError, InvalidStore, UsageWarning
+from file_archive.hashing import get_algorithm
 
 
 __version__ = '0.7'
 
-__all__ = ['FileStore']
+__all__ = ['FileStore', 'GroupCommit']
 
 
 CHUNKSIZE = 4096
@@ -31,16 +41,88 @@ def BufferedReader(fp):
         yield chunk
 
 
-def hash_file(f):
-    """Hashes a file to a 40 hex character SHA1.
+def hash_file(f, algorithm=None):
+    """Hashes a file to a hex string, with SHA1 unless `algorithm` is given.
+
+    `algorithm` can be a name or a HashAlgorithm, see file_archive.hashing.
     """
-    h = sha1()
-    h.update(b'file\n')
+    h = get_algorithm(algorithm).hash(b'file\n')
     for chunk in BufferedReader(f):
         h.update(chunk)
     return h.hexdigest()
 
 
+# Size of the buffers hash_files() reads files into
+HASH_BUFSIZE = 1 << 20
+
+# Number of threads hash_files() uses by default (if None, one per CPU, up
+# to 4), and the number of files below which it doesn't bother starting them
+HASH_WORKERS = None
+_HASH_MIN_BATCH = 64
+
+_hash_buffers = threading.local()
+
+
+def _hash_path(path, algorithm):
+    """Hashes a file given its path, like hash_file() does.
+
+    The file is read into a buffer kept around for this thread, and given
+    directly to the hash object. Returns (hash, size).
+    """
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None:
+        buf = _hash_buffers.buf = bytearray(HASH_BUFSIZE)
+    view = memoryview(buf)
+    h = algorithm.new(b'file\n')
+    size = 0
+    with io.open(path, 'rb', buffering=0) as fp:
+        n = fp.readinto(buf)
+        while n:
+            h.update(view[:n])
+            size += n
+            n = fp.readinto(buf)
+    return h.hexdigest(), size
+
+
+def _hash_paths(paths, workers=None, algorithm=None):
+    """Hashes files given their paths. Returns a list of (hash, size).
+    """
+    algorithm = get_algorithm(algorithm)
+    if workers is None:
+        workers = HASH_WORKERS
+    if workers is None:
+        import multiprocessing
+
+        try:
+            workers = min(4, multiprocessing.cpu_count())
+        except NotImplementedError:  # pragma: no cover
+            workers = 1
+    paths = list(paths)
+    if workers <= 1 or len(paths) < _HASH_MIN_BATCH:
+        return [_hash_path(path, algorithm) for path in paths]
+    # Reading and hashing release the GIL
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda path: _hash_path(path, algorithm), paths,
+                        chunksize=max(1, len(paths) // (workers * 8)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def hash_files(paths, workers=None, algorithm=None):
+    """Hashes many files given their paths, like hash_file() does.
+
+    This is faster than calling hash_file() for each of them, especially for
+    small files: they are read on a pool of `workers` threads, with less
+    overhead per file. Returns the list of hashes, in the same order.
+    """
+    return [filehash
+            for filehash, _size in _hash_paths(paths, workers, algorithm)]
+
+
 def copy_file(fileobj, destination):
     """Copies a file object to a destination name.
     """
@@ -59,58 +141,202 @@ def relativize_link(link, root):
     If the target is not inside root, returns None.
     root must be a realpath (os.path.realpath()).
     """
-    target = os.path.join(os.path.dirname(link), os.readlink(link))
-    target = os.path.realpath(target)
-    root = os.path.realpath(root) + os.path.sep
+    return _relative_link(link, os.path.realpath(os.path.dirname(link)),
+                          os.path.realpath(root))
+
+
+def _relative_link(link, realdir, root):
+    """Tries to make the file a relative link, like relativize_link().
+
+    realdir is the real path of the directory containing the link, and root
+    has to be a real path as well.
+    """
+    target = os.path.realpath(os.path.join(realdir, os.readlink(link)))
+    root = root + os.path.sep
     if os.path.commonprefix([target, root]) == root:
-        return os.path.relpath(target, os.path.realpath(os.path.dirname(link)))
+        return os.path.relpath(target, realdir)
     else:
         return None
 
 
-def hash_directory(path, root=None, visited=None):
-    """Hashes a directory to a 40 hex character string.
+def _scan_directory(path, root, visited, realdir=None, warn=True):
+    """Lists the content of a single directory, to hash or copy it.
+
+    This is what walking a directory is built on. The types of the entries
+    come with the listing from scandir(), and real paths are tracked along
+    the way, so that os.path.realpath() only gets called for symbolic links.
+
+    Returns a sorted list of (kind, name, path, extra) tuples, where kind is
+    'file', 'dir' or 'link'; extra is the real path of directories and the
+    relative target of links.
     """
-    h = sha1()
-    if visited is None:
-        visited = set()
-    if os.path.realpath(path) in visited:
+    if realdir is None:
+        realdir = os.path.realpath(path)
+    if realdir in visited:
         raise ValueError("Can't hash directory structure: loop detected at "
                          "%s" % path)
-    visited.add(os.path.realpath(path))
-    if root is None:
-        root = os.path.realpath(path)
-    h.update(b'dir\n')
-    for f in sorted(os.listdir(path)):
-        pf = os.path.join(path, f)
-        if os.path.islink(pf):
-            link = relativize_link(pf, root)
+    visited.add(realdir)
+    entries = []
+    for entry in sorted(scandir(path), key=lambda e: e.name):
+        f, pf = entry.name, entry.path
+        islink = entry.is_symlink()
+        if islink:
+            link = _relative_link(pf, realdir, root)
             if link is not None:
-                h.update('link %s %s\n' % (f, sha1(link).hexdigest()))
+                entries.append(('link', f, pf, link))
                 continue
-        if os.path.isdir(pf):
-            if os.path.islink(pf):
-                warnings.warn("%s is a symbolic link, recursing on target "
-                              "directory" % pf,
-                              UsageWarning)
-            h.update('dir %s %s\n' % (f, hash_directory(pf, root, visited)))
+        if entry.is_dir():
+            if islink:
+                if warn:
+                    warnings.warn("%s is a symbolic link, recursing on "
+                                  "target directory" % pf,
+                                  UsageWarning)
+                entries.append(('dir', f, pf, os.path.realpath(pf)))
+            else:
+                entries.append(('dir', f, pf, os.path.join(realdir, f)))
         else:
-            if os.path.islink(pf):
+            if islink and warn:
                 warnings.warn("%s is a symbolic link, using target file "
                               "instead" % pf,
                               UsageWarning)
-            with open(pf, 'rb') as fd:
-                h.update('file %s %s\n' % (f, hash_file(fd)))
+            entries.append(('file', f, pf, None))
+    return entries
+
+
+def _list_directory(path, root, visited, file_func, dir_func,
+                    algorithm=None):
+    """Lists a directory, as hash_directory() hashes it.
+
+    file_func(path) and dir_func(path) are called to get the hash of files
+    and subdirectories; links are hashed with `algorithm`. Returns a list of
+    (kind, name, hash, link_target) tuples.
+    """
+    algorithm = get_algorithm(algorithm)
+    entries = []
+    for kind, name, path, extra in _scan_directory(path, root, visited):
+        if kind == 'link':
+            entries.append((kind, name, algorithm.hash(extra).hexdigest(),
+                            extra))
+        elif kind == 'dir':
+            entries.append((kind, name, dir_func(path), None))
+        else:
+            entries.append((kind, name, file_func(path), None))
+    return entries
+
+
+def _list_tree(path, root, visited, algorithm=None, realdir=None, warn=True):
+    """Lists a directory recursively, without reading files.
+
+    This is the manifest of a directory, from which it is both hashed and
+    copied. It is like the listing from _list_directory(), but file entries
+    have the path of the file instead of its hash, and dir entries have their
+    own listing.
+    """
+    algorithm = get_algorithm(algorithm)
+    entries = []
+    for kind, name, path, extra in _scan_directory(path, root, visited,
+                                                   realdir, warn):
+        if kind == 'link':
+            entries.append((kind, name, algorithm.hash(extra).hexdigest(),
+                            extra))
+        elif kind == 'dir':
+            entries.append((kind, name,
+                            _list_tree(path, root, visited, algorithm,
+                                       extra, warn),
+                            None))
+        else:
+            entries.append((kind, name, path, None))
+    return entries
+
+
+def _tree_files(entries):
+    """Yields the paths of the files in a listing from _list_tree().
+    """
+    for kind, _name, value, _target in entries:
+        if kind == 'file':
+            yield value
+        elif kind == 'dir':
+            for path in _tree_files(value):
+                yield path
+
+
+def _hash_tree(path, root=None, visited=None, workers=None, algorithm=None):
+    """Hashes a directory, reading all its files in one batch.
+
+    Returns (dirhash, size, files) where size and files are the total size
+    and number of the files in the directory.
+    """
+    if visited is None:
+        visited = set()
+    if root is None:
+        root = os.path.realpath(path)
+    algorithm = get_algorithm(algorithm)
+    entries = _list_tree(path, root, visited, algorithm)
+    paths = list(_tree_files(entries))
+    hashes = dict(zip(paths, _hash_paths(paths, workers, algorithm)))
+    return (_tree_hash(entries, hashes, algorithm),
+            sum(size for _filehash, size in hashes.values()),
+            len(paths))
+
+
+def _tree_hash(entries, hashes, algorithm=None):
+    """Computes the hash of a listing from _list_tree().
+
+    `hashes` maps the path of each file to its (hash, size).
+    """
+    listing = []
+    for kind, name, value, target in entries:
+        if kind == 'file':
+            value = hashes[value][0]
+        elif kind == 'dir':
+            value = _tree_hash(value, hashes, algorithm)
+        listing.append((kind, name, value, target))
+    return _directory_hash(listing, algorithm)
+
+
+def _directory_hash(entries, algorithm=None):
+    """Computes the hash of a directory from its listing.
+    """
+    h = get_algorithm(algorithm).hash(b'dir\n')
+    for kind, name, filehash, _target in entries:
+        h.update('%s %s %s\n' % (kind, name, filehash))
     return h.hexdigest()
 
 
-def hash_metadata(metadata):
-    """Hashes a dictionary of metadata.
+def hash_directory(path, root=None, visited=None, open_func=None,
+                   algorithm=None):
+    """Hashes a directory to a hex string, like hash_file() does for files.
+
+    If given, files are opened with open_func(path, 'rb'); otherwise they are
+    hashed in batch, like hash_files() does.
+    """
+    if visited is None:
+        visited = set()
+    if root is None:
+        root = os.path.realpath(path)
+    algorithm = get_algorithm(algorithm)
+    if open_func is None:
+        return _hash_tree(path, root, visited, algorithm=algorithm)[0]
+
+    def file_func(pf):
+        with open_func(pf, 'rb') as fd:
+            return hash_file(fd, algorithm)
+
+    def dir_func(pf):
+        return hash_directory(pf, root, visited, open_func, algorithm)
+
+    return _directory_hash(_list_directory(path, root, visited,
+                                           file_func, dir_func, algorithm),
+                           algorithm)
+
+
+def hash_metadata(metadata, algorithm=None):
+    """Hashes a dictionary of metadata, to get the objectid of an entry.
     """
     assert 'hash' in metadata
 
     metadata = normalize_metadata(metadata)
-    h = sha1()
+    h = get_algorithm(algorithm).hash()
     for k, v in sorted(metadata.items(), key=lambda p: p[0]):
         h.update('%d:%s' % (len(k), k))
         if v['type'] == 'int':
@@ -127,26 +353,107 @@ def copy_directory(sourcepath, destination, root=None):
     if root is None:
         root = os.path.realpath(sourcepath)
     # We don't display a warning for links, hash_directory() does that
+    _copy_tree(_list_tree(sourcepath, root, set(), warn=False), destination)
+
+
+def _copy_tree(entries, destination):
+    """Copies a directory to a destination name, given its _list_tree().
+    """
     try:
         os.mkdir(destination)
-        for f in os.listdir(sourcepath):
-            pf = os.path.join(sourcepath, f)
-            df = os.path.join(destination, f)
-            if os.path.islink(pf):
-                link = relativize_link(pf, root)
-                if link is not None:
-                    os.symlink(link, df)
-                    continue
-            if os.path.isdir(pf):
-                copy_directory(pf, df, root)
+        for kind, name, value, target in entries:
+            df = os.path.join(destination, name)
+            if kind == 'link':
+                os.symlink(target, df)
+            elif kind == 'dir':
+                _copy_tree(value, df)
             else:
-                with open(pf, 'rb') as fd:
+                with open(value, 'rb') as fd:
                     copy_file(fd, df)
     except BaseException:  # pragma: no cover
+        import shutil
         shutil.rmtree(destination)
         raise
 
 
+def _temp_name(path):
+    """Returns a unique temporary name next to the given path.
+
+    Blobs are written under that name, then renamed into place, so that a
+    partially-written blob never shows up under its final name.
+    """
+    suffix = binascii.hexlify(os.urandom(6)).decode('ascii')
+    return '%s.tmp%s' % (path, suffix)
+
+
+def _move_into_place(temp, destination):
+    """Renames a freshly written blob to its final name.
+
+    Returns False if the blob was already stored by someone else, in which
+    case the temporary copy is discarded.
+    """
+    try:
+        os.rename(temp, destination)
+    except OSError:
+        if os.path.isdir(temp):
+            import shutil
+            shutil.rmtree(temp)
+        else:
+            os.remove(temp)
+        if not os.path.exists(destination):  # pragma: no cover
+            raise
+        return False
+    return True
+
+
+def _make_dirs(path):
+    """Creates a directory and its parents, if they don't exist.
+    """
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Might have been created concurrently
+            if not os.path.isdir(path):
+                raise
+
+
+class SharedLock(object):
+    """A lock that can be held by many "shared" owners or one "exclusive" one.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._exclusive = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                if not self._shared:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._cond:
+            while self._exclusive or self._shared:
+                self._cond.wait()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
 class Entry(object):
     """Represents a file in the store, along with its metadata.
 
@@ -165,7 +472,20 @@ class Entry(object):
         return self.metadata[key]
 
     def open(self, binary=True):
-        return open(self.filename, 'rb' if binary else 'r')
+        return open_blob(self.filename, binary)
+
+    def mmap(self):
+        """Maps the file in memory, read-only.
+
+        See FileStore.map_file().
+        """
+        return map_blob(self.filename)
+
+    def isdir(self):
+        """Indicates whether the entry is a directory rather than a file.
+        """
+        return (os.path.isdir(self.filename) or
+                blob_kind(self.filename) == 'directory')
 
 
 class EntryIterator(object):
@@ -188,18 +508,107 @@ class EntryIterator(object):
 
 class FileStore(object):
     """Represents a file store.
+
+    If `pool_size` is given, the store can be shared between threads, with
+    queries running concurrently on up to `pool_size` database connections.
+
+    If `group_commit` is given (a GroupCommit object), entries added
+    concurrently are committed together; see flush().
+
+    Blobs are compressed or split into chunks, and directories stored as
+    manifests, if the store was created with these options; see
+    create_store(). Hashes are computed with the store's `hash_algorithm`.
+
+    If `deferred_delete` is True, remove() doesn't delete unreferenced blobs
+    but atomically moves them to a trash directory, so that it takes constant
+    time. The trash is emptied by gc(), empty_trash(), or a background thread
+    if start_reaper() is called.
+
+    If `hash_cache` is True, the hashes of the files added from a path are
+    recorded in the database, along with their size, mtime and inode; files
+    for which these didn't change since are not read again to be hashed.
+    Records of files that are gone or changed are removed by gc().
     """
-    def __init__(self, path):
+    # Files modified less than this many seconds before they are hashed are
+    # not recorded in the hash cache: they could change again without their
+    # mtime changing
+    HASH_CACHE_RACY = 2
+
+    def __init__(self, path, pool_size=None, group_commit=None,
+                 deferred_delete=False, hash_cache=False):
         self.store = os.path.join(path, 'objects')
         if not os.path.isdir(self.store):
             raise InvalidStore("objects is not a directory")
         db = os.path.join(path, 'database')
         if not os.path.isfile(db):
             raise InvalidStore("database is not a file")
-        self.metadata = MetadataStore(db)
+        self.metadata = MetadataStore(db, pool_size=pool_size,
+                                      group_commit=group_commit)
+        self.compression = None
+        self.chunking = None
+        config = self.metadata.get_config()
+        if 'compression.codec' in config:
+            from file_archive.compression import Compression
+            try:
+                self.compression = Compression.from_config(config)
+            except (ValueError, ImportError):
+                # Unknown codec, or its module is not installed
+                self.metadata.close()
+                raise InvalidStore("Compression codec %s is not available" %
+                                   config['compression.codec'])
+        if 'chunking.avg_size' in config:
+            from file_archive.chunking import Chunking
+            self.chunking = Chunking.from_config(config)
+        self.directory_manifests = config.get('directories') == 'manifest'
+        try:
+            self.hash_algorithm = get_algorithm(config.get('hash.algorithm'))
+        except (KeyError, ImportError):
+            self.metadata.close()
+            raise InvalidStore("Hash algorithm %s is not available" %
+                               config['hash.algorithm'])
+        # Held exclusively while deleting unreferenced blobs, so that no entry
+        # referring to them gets added concurrently
+        self._gc_lock = SharedLock()
+        # In the objects directory, so that moving blobs there is a rename
+        self._trash = os.path.join(self.store, 'trash')
+        self.deferred_delete = deferred_delete
+        self.hash_cache = hash_cache
+        self._reaper = None
 
     @staticmethod
-    def create_store(path):
+    def create_store(path, compression=None, chunking=None,
+                     directory_manifests=False, hash_algorithm=None):
+        """Creates a new, empty store.
+
+        `compression` can be a Compression object or the name of a codec, to
+        compress the file blobs of this store.
+
+        `chunking` can be a Chunking object, to store large files as a list of
+        content-defined chunks, shared between files (if True, the default
+        options are used).
+
+        If `directory_manifests` is True, directories are stored as a listing
+        of their content, referring to file blobs that are shared with the
+        other files and directories of the store.
+
+        `hash_algorithm` is the name of the algorithm identifying contents
+        and entries, see file_archive.hashing; by default, SHA1.
+        """
+        if hash_algorithm is not None:
+            # Fail early if the algorithm is not available
+            try:
+                hash_algorithm = get_algorithm(hash_algorithm).name
+            except KeyError:
+                raise ValueError("Unknown hash algorithm %r" % hash_algorithm)
+            except ImportError:
+                raise ValueError("Hash algorithm %s is not available" %
+                                 hash_algorithm)
+        if chunking is True:
+            from file_archive.chunking import Chunking
+            chunking = Chunking()
+        if isinstance(compression, string_types):
+            from file_archive.compression import Compression
+            compression = Compression(compression)
         if os.path.exists(path):
             if not os.path.isdir(path) or os.listdir(path):
                 raise CreationError("Path is not a directory or is not empty")
@@ -214,27 +623,161 @@ class FileStore(object):
             raise CreationError("Could not create directories: %s: %s" % (
                 e.__class__.__name__, e.message))
         MetadataStore.create_db(os.path.join(path, 'database'))
+        config = {}
+        if compression is not None:
+            config.update(compression.to_config())
+        if chunking:
+            config.update(chunking.to_config())
+        if directory_manifests:
+            config['directories'] = 'manifest'
+        if hash_algorithm is not None:
+            config['hash.algorithm'] = hash_algorithm
+        if config:
+            metadata = MetadataStore(os.path.join(path, 'database'))
+            try:
+                metadata.set_config(config)
+            finally:
+                metadata.close()
 
     def close(self):
+        if self._reaper is not None:
+            self._reaper.close()
+            self._reaper = None
         self.metadata.close()
         self.metadata = None
         self.store = None
 
+    def flush(self):
+        """Waits for the entries added so far to be committed.
+
+        Only useful with group commit; errors from fire-and-forget additions
+        are raised here (or by close()).
+        """
+        self.metadata.flush()
+
     def open_file(self, objectid, path=None, binary=True):
         """Returns a file object for a given objectid.
         """
-        filepath = self.get_filename(objectid)
+        return self._open_blob(self.get_filename(objectid), path, binary)
+
+    def map_file(self, objectid, path=None):
+        """Maps a file in memory, read-only, given its objectid.
+
+        Files stored as-is are memory-mapped, so reading them repeatedly
+        doesn't copy them out of the page cache; an mmap object is returned.
+        Compressed or chunked files are decoded into memory, and a read-only
+        memoryview is returned.
+        """
+        filepath = self._object_path(objectid)
+        blobpath, encoded = self._find_blob(filepath, path)
+        return map_blob(blobpath, decode=encoded)
+
+    def read_range(self, objectid, offset, length=None, path=None):
+        """Reads part of a file, given its objectid.
+
+        Returns `length` bytes from `offset`, fewer if the end of the file is
+        reached (or all the rest if `length` is None). For compressed or
+        chunked files, only the blocks or chunks in the range are read.
+        """
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError("Invalid range")
+        with self._open_blob(self._object_path(objectid), path) as fp:
+            fp.seek(offset)
+            return fp.read(-1 if length is None else length)
+
+    def _object_path(self, objectid):
+        """Gets the path of the blob for an objectid or Entry.
+        """
+        if isinstance(objectid, Entry):
+            return objectid.filename
+        else:
+            return self.get_filename(objectid)
+
+    def _open_blob(self, filepath, path=None, binary=True):
+        """Opens a blob given its location in the store.
+        """
+        blobpath, encoded = self._find_blob(filepath, path)
+        if encoded:
+            return open_blob(blobpath, binary)
+        else:
+            return open(blobpath, 'rb' if binary else 'r')
+
+    def _find_blob(self, filepath, path=None):
+        """Finds the blob for a file, possibly in a directory.
+
+        Returns (blobpath, encoded), where encoded is False for files in
+        directories that were copied to the store (those are always as-is).
+        """
         if os.path.isdir(filepath):
             if path:
-                return open(os.path.join(filepath, path),
-                            'rb' if binary else 'r')
+                return os.path.join(filepath, path), False
+            else:
+                raise ValueError("Object is a directory, not a file")
+        elif blob_kind(filepath) == 'directory':
+            if path:
+                return self._resolve_path(filepath, path), True
             else:
                 raise ValueError("Object is a directory, not a file")
         else:  # os.path.isfile(filepath):
             if path is not None:
                 raise ValueError("Object is a file, not a directory")
             else:
-                return open(filepath, 'rb' if binary else 'r')
+                return filepath, True
+
+    def _resolve_path(self, filepath, path):
+        """Finds the file blob for a path in a 'directory' blob.
+        """
+        parts = path.replace(os.sep, '/').split('/')
+        stack = [filepath]
+        links = 0
+        while parts:
+            part = parts.pop(0)
+            if not part or part == '.':
+                continue
+            elif part == '..':
+                if len(stack) > 1:
+                    stack.pop()
+                continue
+            for kind, name, filehash, target in read_directory(stack[-1]):
+                if name == part:
+                    break
+            else:
+                raise IOError(errno.ENOENT, "No such file or directory", path)
+            if kind == 'link':
+                links += 1
+                if links > 40:
+                    raise IOError(errno.ELOOP, "Too many symbolic links",
+                                  path)
+                parts[:0] = target.split('/')
+            elif kind == 'dir':
+                stack.append(self._make_filename(filehash))
+            elif parts:
+                raise IOError(errno.ENOTDIR, "Not a directory", path)
+            else:
+                return self._make_filename(filehash)
+        raise IOError(errno.EISDIR, "Is a directory", path)
+
+    def extract(self, objectid, destination):
+        """Writes a file or directory from the store to a new path.
+        """
+        filepath = self._object_path(objectid)
+        self._extract_blob(filepath, destination)
+
+    def _extract_blob(self, filepath, destination):
+        if os.path.isdir(filepath):
+            import shutil
+            shutil.copytree(filepath, destination, symlinks=True)
+        elif blob_kind(filepath) == 'directory':
+            os.mkdir(destination)
+            for kind, name, filehash, target in read_directory(filepath):
+                path = os.path.join(destination, name)
+                if kind == 'link':
+                    os.symlink(target, path)
+                else:
+                    self._extract_blob(self._make_filename(filehash), path)
+        else:
+            with open_blob(filepath) as fp:
+                copy_file(fp, destination)
 
     def get_filename(self, objectid):
         """Returns the file path for a given objectid.
@@ -248,10 +791,264 @@ class FileStore(object):
         """Gets or makes the path for the given filehash.
         """
         dirname = os.path.join(self.store, filehash[:2])
-        if make_dir and not os.path.isdir(dirname):
-            os.mkdir(dirname)
+        if make_dir:
+            _make_dirs(dirname)
         return os.path.join(dirname, filehash[2:])
 
+    def _store_file(self, newfile, name=None, filehash=None):
+        """Hashes a file object and writes it to the store if needed.
+
+        `name` is the original filename, if known; it is used to decide
+        whether to compress the file. If `filehash` is given, the file is
+        not hashed again.
+
+        Returns (filehash, created, stats) where created indicates whether
+        the blob was written by this call, and stats is (size, 1).
+        """
+        if filehash is None:
+            newfile.seek(0, os.SEEK_SET)
+            filehash = hash_file(newfile, self.hash_algorithm)
+        else:
+            newfile.seek(0, os.SEEK_END)
+        # We are at the end of the file
+        stats = newfile.tell(), 1
+        newfile.seek(0, os.SEEK_SET)
+        storedfile = self._make_filename(filehash, make_dir=True)
+        if os.path.exists(storedfile) and not self._missing_refs(storedfile):
+            return filehash, False, stats
+        if (self.chunking is not None and
+                stats[0] >= self.chunking.threshold):
+            return (filehash,
+                    self._store_chunked(newfile, storedfile, name),
+                    stats)
+        temp = _temp_name(storedfile)
+        write_blob(newfile, temp, self.compression, name)
+        return filehash, _move_into_place(temp, storedfile), stats
+
+    def _store_chunked(self, newfile, storedfile, name=None):
+        """Writes a file as a list of chunks, storing the missing ones.
+
+        Returns whether the blob was written by this call.
+        """
+        from file_archive.chunking import iter_chunks
+
+        chunks = []
+        for chunk in iter_chunks(newfile, self.chunking):
+            chunkhash = self.hash_algorithm.new(chunk).hexdigest()
+            chunks.append((chunkhash, len(chunk)))
+            path = chunk_path(self.store, chunkhash)
+            if not os.path.exists(path):
+                _make_dirs(os.path.dirname(path))
+                temp = _temp_name(path)
+                write_blob(BytesIO(chunk), temp, self.compression, name)
+                _move_into_place(temp, path)
+        temp = _temp_name(storedfile)
+        write_chunked(chunks, temp)
+        return _move_into_place(temp, storedfile)
+
+    def _missing_refs(self, storedfile, checked=None):
+        """Checks whether something a blob refers to is missing.
+
+        This can happen if they were deleted with another blob while this one
+        was being stored.
+
+        `checked` can be a set of the blobs already known to be complete; the
+        blobs found to be complete are added to it.
+        """
+        for kind, childhash in read_refs(storedfile):
+            if kind == 'chunk':
+                if not os.path.exists(chunk_path(self.store, childhash)):
+                    return True
+            else:
+                child = self._make_filename(childhash)
+                if checked is not None and child in checked:
+                    continue
+                if (not os.path.exists(child) or
+                        self._missing_refs(child, checked)):
+                    return True
+        if checked is not None:
+            checked.add(storedfile)
+        return False
+
+    def _all_refs(self, filehash):
+        """Lists what a blob refers to, recursively.
+
+        Returns a list of (parent, kind, hash) for blob_refs.
+        """
+        refs = []
+        parents = [filehash]
+        seen = set(parents)
+        while parents:
+            parent = parents.pop()
+            for kind, childhash in read_refs(self._make_filename(parent)):
+                refs.append((parent, kind, childhash))
+                if kind == 'blob' and childhash not in seen:
+                    seen.add(childhash)
+                    parents.append(childhash)
+        return refs
+
+    def _store_directory(self, newdir):
+        """Hashes a directory and copies it to the store if needed.
+
+        Returns (dirhash, created, stats) where created indicates whether the
+        blob was written by this call, and stats is (size, files) for the
+        files in the directory, counted while hashing.
+        """
+        if self.directory_manifests:
+            try:
+                return self._store_tree(newdir)
+            except (IOError, OSError):
+                raise ValueError("Can't access directory")
+
+        try:
+            entries = _list_tree(newdir, os.path.realpath(newdir), set(),
+                                 self.hash_algorithm)
+            paths = list(_tree_files(entries))
+            hashes = dict(zip(paths, self._hash_paths(paths)))
+        except (IOError, OSError):
+            raise ValueError("Can't access directory")
+        dirhash = _tree_hash(entries, hashes, self.hash_algorithm)
+        size = sum(size for _filehash, size in hashes.values())
+        files = len(paths)
+        storeddir = self._make_filename(dirhash, make_dir=True)
+        if os.path.exists(storeddir):
+            return dirhash, False, (size, files)
+        # Copy from the same listing, rather than walking the directory again
+        temp = _temp_name(storeddir)
+        try:
+            _copy_tree(entries, temp)
+        except (IOError, OSError):
+            raise ValueError("Can't access directory")
+        return dirhash, _move_into_place(temp, storeddir), (size, files)
+
+    def _store_tree(self, newdir):
+        """Stores a directory as 'directory' blobs and file blobs.
+
+        All the files are hashed first, in batch, so that only the ones
+        missing from the store get read again. Returns (dirhash, created,
+        stats) like _store_directory().
+        """
+        entries = _list_tree(newdir, os.path.realpath(newdir), set(),
+                             self.hash_algorithm)
+        paths = list(_tree_files(entries))
+        hashes = dict(zip(paths, self._hash_paths(paths)))
+        dirhash, created = self._store_listing(entries, hashes, set())
+        return (dirhash, created,
+                (sum(size for _filehash, size in hashes.values()),
+                 len(paths)))
+
+    def _hash_paths(self, paths):
+        """Hashes files given their paths, using the hash cache if enabled.
+
+        Returns a list of (hash, size).
+        """
+        if not self.hash_cache:
+            return _hash_paths(paths, algorithm=self.hash_algorithm)
+        from file_archive.verify import _mtime_ns
+
+        # Files are stat()ed before being read, so that if they change while
+        # being hashed, their record won't match next time
+        racy = int((time.time() - self.HASH_CACHE_RACY) * 1000000000)
+        realdirs = {}
+        keys = []
+        stats = []
+        for path in paths:
+            dirname, name = os.path.split(path)
+            try:
+                realdir = realdirs[dirname]
+            except KeyError:
+                realdir = realdirs[dirname] = os.path.realpath(dirname)
+            keys.append(os.path.join(realdir, name))
+            st = os.stat(path)
+            stats.append((st.st_size, _mtime_ns(st), st.st_ino))
+        cached = self.metadata.get_cached_hashes(keys)
+
+        results = [None] * len(keys)
+        todo = []
+        for i, (key, stat) in enumerate(zip(keys, stats)):
+            record = cached.get(key)
+            if record is not None and record[:3] == stat:
+                results[i] = record[3], stat[0]
+            else:
+                todo.append(i)
+        records = []
+        hashed = _hash_paths([paths[i] for i in todo],
+                             algorithm=self.hash_algorithm)
+        for i, (filehash, size) in zip(todo, hashed):
+            results[i] = filehash, size
+            if stats[i][1] < racy and stats[i][0] == size:
+                records.append((keys[i],) + stats[i] + (filehash,))
+        if records:
+            self.metadata.set_cached_hashes(records)
+        return results
+
+    def _store_listing(self, entries, hashes, checked):
+        """Stores a listing from _list_tree() as a 'directory' blob.
+
+        `hashes` maps the path of each file to its (hash, size); `checked` is
+        the set of blobs known to be complete, see _missing_refs(). Returns
+        (dirhash, created).
+        """
+        listing = []
+        for kind, name, value, target in entries:
+            if kind == 'file':
+                path, value = value, hashes[value][0]
+                storedfile = self._make_filename(value)
+                if storedfile not in checked:
+                    if (not os.path.exists(storedfile) or
+                            self._missing_refs(storedfile, checked)):
+                        with open(path, 'rb') as fp:
+                            self._store_file(fp, name, filehash=value)
+                    checked.add(storedfile)
+            elif kind == 'dir':
+                value = self._store_listing(value, hashes, checked)[0]
+            listing.append((kind, name, value, target))
+        dirhash = _directory_hash(listing, self.hash_algorithm)
+        storedfile = self._make_filename(dirhash, make_dir=True)
+        checked_before = storedfile in checked
+        checked.add(storedfile)
+        if checked_before or (os.path.exists(storedfile) and
+                              not self._missing_refs(storedfile, checked)):
+            return dirhash, False
+        temp = _temp_name(storedfile)
+        write_directory(listing, temp)
+        return dirhash, _move_into_place(temp, storedfile)
+
+    def _store_path(self, path):
+        """Stores a file or directory given its path.
+
+        Returns (filehash, created, stats), see _store_file().
+        """
+        if os.path.isdir(path):
+            return self._store_directory(path)
+        with open(path, 'rb') as fp:
+            return self._store_file(fp, os.path.basename(path))
+
+    def _add_entry(self, filehash, created, metadata, stats=None):
+        """Adds the database entry for a blob that was just stored.
+
+        If this fails, the blob is deleted again if it was created for this
+        entry. Returns None if the blob was garbage-collected by a concurrent
+        remove() since it was stored; it then needs to be stored again.
+        """
+        metadata = dict(metadata)
+        metadata['hash'] = filehash
+        with self._gc_lock.shared():
+            storedfile = self._make_filename(filehash)
+            if (not os.path.exists(storedfile) or
+                    self._missing_refs(storedfile)):
+                return None
+            try:
+                objectid = hash_metadata(metadata, self.hash_algorithm)
+                self.metadata.add(objectid, metadata,
+                                  refs=self._all_refs(filehash),
+                                  stats=stats)
+            except BaseException:
+                if created and not self.metadata.has_filehash(filehash):
+                    self._delete_blob(filehash)
+                raise
+        return Entry(self, objectid, metadata)
+
     def add_file(self, newfile, metadata):
         """Adds a file given a file object or path and dict of metadata.
 
@@ -260,30 +1057,31 @@ class FileStore(object):
 
         Note that, if you pass a file object, it needs to support
         newfile.seek(0, os.SEEK_SET) as it will be read twice: once to compute
-        its SHA1 hash, and a second time to write it to disk.
+        its hash, and a second time to write it to disk.
         """
         if isinstance(newfile, string_types):
             if os.path.islink(newfile):
                 warnings.warn("%s is a symbolic link, using target file "
                               "instead" % newfile,
                               UsageWarning)
+            filehash = None
+            if self.hash_cache:
+                try:
+                    filehash = self._hash_paths([newfile])[0][0]
+                except (IOError, OSError):
+                    pass
             with open(newfile, 'rb') as fp:
-                return self.add_file(fp, metadata)
-        newfile.seek(0, os.SEEK_SET)
-        filehash = hash_file(newfile)
-        newfile.seek(0, os.SEEK_SET)
-        metadata = dict(metadata)
-        metadata['hash'] = filehash
-        objectid = hash_metadata(metadata)
-        storedfile = self._make_filename(filehash, make_dir=True)
-        if not os.path.exists(storedfile):
-            copy_file(newfile, storedfile)
-        try:
-            self.metadata.add(objectid, metadata)
-        except BaseException:  # pragma: no cover
-            os.remove(storedfile)
-            raise
-        return Entry(self, objectid, metadata)
+                return self._add_file(fp, metadata, os.path.basename(newfile),
+                                      filehash)
+        return self._add_file(newfile, metadata)
+
+    def _add_file(self, newfile, metadata, name=None, filehash=None):
+        entry = None
+        while entry is None:
+            filehash, created, stats = self._store_file(newfile, name,
+                                                        filehash)
+            entry = self._add_entry(filehash, created, metadata, stats)
+        return entry
 
     def add_directory(self, newdir, metadata):
         """Adds a directory given a path and dict of metadata.
@@ -293,22 +1091,11 @@ class FileStore(object):
         """
         if not isinstance(newdir, string_types):
             raise TypeError("newdir should be a string, not %s" % type(newdir))
-        try:
-            dirhash = hash_directory(newdir)
-        except (IOError, OSError):
-            raise ValueError("Can't access directory")
-        metadata = dict(metadata)
-        metadata['hash'] = dirhash
-        objectid = hash_metadata(metadata)
-        storeddir = self._make_filename(dirhash, make_dir=True)
-        if not os.path.exists(storeddir):
-            copy_directory(newdir, storeddir)
-        try:
-            self.metadata.add(objectid, metadata)
-        except BaseException:  # pragma: no cover
-            shutil.rmtree(storeddir)
-            raise
-        return Entry(self, objectid, metadata)
+        entry = None
+        while entry is None:
+            dirhash, created, stats = self._store_directory(newdir)
+            entry = self._add_entry(dirhash, created, metadata, stats)
+        return entry
 
     def add(self, newpath, metadata):
         """Adds a file or directory with a dict of metadata.
@@ -329,17 +1116,131 @@ class FileStore(object):
 
         It is deleted from the store and removed from the database.
         """
+        with self._gc_lock.exclusive():
+            filehash = self._remove_entry(objectid)
+            if filehash is not None:
+                self._delete_blob(filehash)
+
+    def remove_many(self, conditions=None, objectids=None):
+        """Removes all the files and directories matching the conditions.
+
+        Alternatively, a list of objectids or Entries can be given. The
+        entries are removed from the database in a single transaction, then
+        the blobs no entry refers to anymore are deleted.
+
+        Returns the number of entries removed.
+        """
+        if objectids is not None:
+            objectids = [o.objectid if isinstance(o, Entry) else o
+                         for o in objectids]
+        with self._gc_lock.exclusive():
+            count, filehashes = self.metadata.remove_many(
+                conditions=conditions, objectids=objectids)
+            for filehash in filehashes:
+                self._delete_blob(filehash)
+        return count
+
+    def update_metadata(self, conditions=None, objectids=None, set=None,
+                        unset=None):
+        """Changes the metadata of all the entries matching the conditions.
+
+        Alternatively, a list of objectids or Entries can be given. Keys in
+        the `set` dict are given the new values, and keys in the `unset` list
+        are removed. All the entries are updated in a single transaction; the
+        files are not touched.
+
+        Since the objectid is computed from the metadata, entries get new
+        objectids; entries that end up with the same metadata as another are
+        merged with it. Returns a dict mapping the old objectids to the new
+        ones.
+        """
+        if objectids is not None:
+            objectids = [o.objectid if isinstance(o, Entry) else o
+                         for o in objectids]
+        return self.metadata.update_metadata(
+            conditions=conditions, objectids=objectids, set=set, unset=unset,
+            algorithm=self.hash_algorithm)
+
+    def _remove_entry(self, objectid):
+        """Removes an entry from the database.
+
+        Returns the hash of the blob if no entry refers to it anymore and it
+        should be garbage-collected, else None.
+        """
         if isinstance(objectid, Entry):
             entry = objectid
         else:
             entry = self.get(objectid)
         self.metadata.remove(entry.objectid)
         if not self.metadata.has_filehash(entry['hash']):
-            # Garbage collection
-            if os.path.isdir(entry.filename):
-                shutil.rmtree(entry.filename)
+            return entry['hash']
+        return None
+
+    def _release_blob(self, filehash):
+        """Forgets what a blob that is about to be deleted refers to.
+
+        Returns the (path, hash) of the chunks and blobs to delete along with
+        it.
+        """
+        released = []
+        for kind, childhash in self.metadata.release_blob(filehash):
+            if kind == 'chunk':
+                released.append((chunk_path(self.store, childhash),
+                                 childhash))
             else:
-                os.remove(entry.filename)
+                released.append((self._make_filename(childhash), childhash))
+        return released
+
+    def _delete_blob(self, filehash, children=None):
+        """Deletes a blob from the objects directory.
+
+        The chunks and blobs no other blob refers to are deleted as well (the
+        result of _release_blob() can be passed in if it was already called).
+        With deferred_delete, they are moved to the trash instead.
+        """
+        if children is None:
+            children = self._release_blob(filehash)
+        self._discard(self._make_filename(filehash), filehash)
+        for path, childhash in children:
+            try:
+                self._discard(path, childhash)
+            except OSError:
+                pass  # Already gone
+
+    def _discard(self, path, filehash):
+        if self.deferred_delete:
+            _make_dirs(self._trash)
+            os.rename(path, _temp_name(os.path.join(self._trash, filehash)))
+            if self._reaper is not None:
+                self._reaper.wake()
+        elif os.path.isdir(path):
+            import shutil
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def empty_trash(self):
+        """Deletes the blobs that remove() moved to the trash.
+
+        Returns (count, size) for the blobs deleted.
+        """
+        from file_archive.sweep import empty_trash
+
+        return empty_trash(self._trash)
+
+    def start_reaper(self):
+        """Starts a background thread that empties the trash.
+
+        It deletes the blobs moved to the trash by remove() as they come, and
+        is stopped by close().
+        """
+        from file_archive.sweep import Reaper
+
+        if self._reaper is None:
+            self._reaper = Reaper(self._trash)
+            self._reaper.start()
+            # Reclaim what might have been left by a previous process
+            self._reaper.wake()
 
     def get(self, objectid):
         """Gets an Entry from a hash.
@@ -358,16 +1259,207 @@ class FileStore(object):
         else:
             return Entry(self, objectid, metadata)
 
-    def query(self, conditions, limit=None):
+    def query(self, conditions, limit=None, size=None, after=None):
         """Returns all the Entries matching the conditions.
 
         An EntryIterator is returned, with which you can access the different
         results.
+
+        `size` can be used to filter on the size of files (or the total size
+        of directories), as a number or a dict like {'gt': 1000, 'lt': 2000}.
+
+        Entries come ordered by objectid. To page through results, pass a
+        limit, then the objectid of the last entry as `after` to get the next
+        page.
         """
-        infos = self.metadata.query_all(conditions, limit)
+        infos = self.metadata.query_all(conditions, limit, size, after)
         return EntryIterator(self, infos)
 
-    def verify(self):
+    def metadata_keys(self):
+        """Lists the metadata keys in use, as (key, type, count) tuples.
+
+        This is meant for completion, and might lag behind recent changes by
+        a few seconds.
+        """
+        return self.metadata.keys()
+
+    def metadata_values(self, key, limit=None):
+        """Lists the most frequent values of a key, as (value, count) tuples.
+
+        This is meant for completion, and might lag behind recent changes by
+        a few seconds.
+        """
+        return self.metadata.values(key, limit)
+
+    def disk_usage(self, conditions=None):
+        """Returns the size and number of files of entries.
+
+        This reads the sizes recorded when the entries were added, in a
+        single query. Returns a list of (objectid, filehash, size, files)
+        tuples, for the entries matching the conditions (or all of them).
+
+        Entries added before sizes were recorded are measured from their blob
+        once, and their size is then recorded as well.
+        """
+        rows = self.metadata.entry_stats(conditions)
+        missing = set(filehash for _objectid, filehash, size, _files in rows
+                      if size is None)
+        if not missing:
+            return rows
+        stats = {}
+        for filehash in missing:
+            stats[filehash] = self._measure_blob(
+                self._make_filename(filehash))
+        self.metadata.set_stats([(h,) + s for h, s in stats.items()])
+        return [(objectid, filehash) + stats.get(filehash, (size, files))
+                for objectid, filehash, size, files in rows]
+
+    def _measure_blob(self, filepath):
+        """Computes (size, files) for a blob, reading it if needed.
+        """
+        if os.path.isdir(filepath):
+            size = files = 0
+            for dirpath, _dirnames, filenames in os.walk(filepath):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if not os.path.islink(path):
+                        size += os.path.getsize(path)
+                        files += 1
+            return size, files
+        kind = blob_kind(filepath)
+        if kind is None:
+            return os.path.getsize(filepath), 1
+        elif kind == 'directory':
+            size = files = 0
+            for entrykind, _name, filehash, _target in read_directory(
+                    filepath):
+                if entrykind != 'link':
+                    s, f = self._measure_blob(self._make_filename(filehash))
+                    size += s
+                    files += f
+            return size, files
+        else:
+            with open_blob(filepath) as fp:
+                return fp.seek(0, os.SEEK_END), 1
+
+    def _iter_blobs(self, temporary=False):
+        """Yields (filehash, DirEntry) for each blob in the objects directory.
+
+        If temporary is True, blobs being written (or left over by a crash)
+        are included as well; their name is not a valid hash.
+        """
+        for prefix in scandir(self.store):
+            if len(prefix.name) != 2 or not prefix.is_dir():
+                continue
+            for blob in scandir(prefix.path):
+                if temporary or '.tmp' not in blob.name:
+                    yield prefix.name + blob.name, blob
+
+    def verify(self, workers=4, progress=None, checkpoint=None, rate=None,
+               time_limit=None, quick=False, max_age=None):
         """Checks the integrity of the store.
+
+        Every blob is re-hashed, on a pool of `workers` threads, and every
+        objectid is checked against the hash of its metadata. Blobs no entry
+        refers to and entries whose blob is missing are also reported.
+
+        `progress` is called with (blobs_checked, blobs_total, bytes_read)
+        after each blob. If a `checkpoint` filename is given, results are
+        recorded there as they come, and blobs already in that file are not
+        checked again; it is deleted once verification completes. `rate`
+        limits reads to that many bytes per second, and `time_limit` stops
+        verification after that many seconds.
+
+        Verified blobs are recorded in a ledger along with their size, mtime
+        and inode. If `quick` is True, only the blobs for which these changed,
+        or that were last verified more than `max_age` seconds ago, are
+        re-hashed.
+
+        Returns a VerifyReport.
         """
-        # TODO : verify
+        from file_archive.verify import Verifier
+
+        verifier = Verifier(self, workers=workers, progress=progress,
+                            checkpoint=checkpoint, rate=rate,
+                            time_limit=time_limit, quick=quick,
+                            max_age=max_age)
+        return verifier.run()
+
+    def gc(self, dry_run=False, quarantine=None, workers=4, grace=3600):
+        """Removes the blobs no entry refers to.
+
+        This finds files and directories in the objects directory that don't
+        match the hash of any entry, including temporary files left over by a
+        crash; blobs modified less than `grace` seconds ago are left alone,
+        since they might be in the process of being added. Deletions happen on
+        a pool of `workers` threads. The trash (see `deferred_delete`) is
+        emptied as well, and the records of the hash cache (see `hash_cache`)
+        whose file is gone or changed are removed.
+
+        If `dry_run` is True, nothing is removed. If a `quarantine` directory
+        is given, blobs are moved there instead of being deleted.
+
+        Returns a GCReport.
+        """
+        from file_archive.sweep import Collector
+
+        collector = Collector(self, dry_run=dry_run, quarantine=quarantine,
+                              workers=workers, grace=grace)
+        return collector.run()
+
+    def convert(self, destination, hash_algorithm=None, progress=None):
+        """Copies all the entries to a new store, with another hash algorithm.
+
+        The new store is created at `destination` with the same options as
+        this one, except for `hash_algorithm` (see create_store()). Every blob
+        is extracted and added again, once for each entry referring to it, so
+        that the hashes and the objectids are computed with the new algorithm;
+        the rest of the metadata is kept. This store is left unchanged.
+
+        `progress` is called with (blobs_done, blobs_total) after each blob.
+        Returns a dict mapping the old objectids to the new ones.
+        """
+        import shutil
+        import tempfile
+
+        FileStore.create_store(destination,
+                               compression=self.compression,
+                               chunking=self.chunking,
+                               directory_manifests=self.directory_manifests,
+                               hash_algorithm=hash_algorithm)
+        blobs = {}
+        for objectid, metadata in self.metadata.query_all({}):
+            blobs.setdefault(metadata.pop('hash'), []).append(
+                (objectid, metadata))
+        newids = {}
+        temp = tempfile.mkdtemp(prefix='file_archive_convert_')
+        store = FileStore(destination)
+        try:
+            for done, (filehash, entries) in enumerate(sorted(blobs.items())):
+                path = os.path.join(temp, 'blob')
+                self._extract_blob(self._make_filename(filehash), path)
+                # Hash and store the blob once, for all the entries
+                stored = None
+                for objectid, metadata in entries:
+                    entry = None
+                    while entry is None:
+                        if stored is None:
+                            stored = store._store_path(path)
+                        newhash, created, stats = stored
+                        entry = store._add_entry(newhash, created, metadata,
+                                                 stats)
+                        if entry is None:
+                            stored = None  # Collected, store it again
+                        else:
+                            stored = newhash, False, stats
+                    newids[objectid] = entry.objectid
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                if progress is not None:
+                    progress(done + 1, len(blobs))
+        finally:
+            store.close()
+            shutil.rmtree(temp)
+        return newids
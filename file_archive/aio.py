@@ -0,0 +1,227 @@
+"""asyncio interface to a file store.
+
+This module requires Python 3.5 or later.
+"""
+
+from __future__ import division, unicode_literals
+
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+import os
+import warnings
+
+from file_archive import Entry, FileStore
+from file_archive.compat import string_types
+from file_archive.database import normalize_metadata
+from file_archive.errors import UsageWarning
+
+
+__all__ = ['AsyncFileStore', 'AsyncFile', 'AsyncEntryIterator']
+
+
+try:
+    _running_loop = asyncio.get_running_loop
+except AttributeError:  # Python < 3.7
+    _running_loop = asyncio.get_event_loop
+
+
+class AsyncFile(object):
+    """Asynchronous wrapper for a file object from the store.
+
+    Reads happen on the worker threads of the AsyncFileStore. It can be used
+    as an asynchronous context manager, and iterating on it with `async for`
+    gives out chunks of the file.
+    """
+    CHUNKSIZE = 65536
+
+    def __init__(self, astore, fileobj):
+        self._astore = astore
+        self._fileobj = fileobj
+
+    async def read(self, size=-1):
+        return await self._astore._run(self._fileobj.read, size)
+
+    async def seek(self, offset, whence=os.SEEK_SET):
+        return await self._astore._run(self._fileobj.seek, offset, whence)
+
+    async def close(self):
+        await self._astore._run(self._fileobj.close)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read(self.CHUNKSIZE)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncEntryIterator(object):
+    """Asynchronous iterator returned by AsyncFileStore.query().
+
+    Entries are fetched from the database thread in batches.
+    """
+    BATCH = 100
+
+    def __init__(self, astore, conditions, limit):
+        self._astore = astore
+        self._conditions = conditions
+        self._limit = limit
+        self._iterator = None
+        self._batch = collections.deque()
+        self._done = False
+
+    def _fetch(self):
+        # Runs on the database thread
+        if self._iterator is None:
+            self._iterator = self._astore._store.query(self._conditions,
+                                                       self._limit)
+        return list(itertools.islice(self._iterator, self.BATCH))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._batch:
+            if self._done:
+                raise StopAsyncIteration
+            batch = await self._astore._db(self._fetch)
+            if len(batch) < self.BATCH:
+                self._done = True
+            if not batch:
+                raise StopAsyncIteration
+            self._batch.extend(batch)
+        return self._batch.popleft()
+
+
+class AsyncFileStore(object):
+    """asyncio facade over a FileStore.
+
+    Hashing and copying files happen on a bounded pool of worker threads,
+    while all database accesses go through a single thread that owns the
+    SQLite connection, so the event loop never blocks on disk.
+    """
+    def __init__(self, path, max_workers=4):
+        self._workers = ThreadPoolExecutor(max_workers)
+        self._database = ThreadPoolExecutor(1)
+        try:
+            self._store = self._database.submit(FileStore, path).result()
+        except BaseException:
+            self._workers.shutdown(wait=False)
+            self._database.shutdown(wait=False)
+            raise
+        # Blobs currently being deleted by remove(), on the workers
+        self._deleting = {}
+
+    async def _run(self, func, *args):
+        loop = _running_loop()
+        return await loop.run_in_executor(self._workers,
+                                          functools.partial(func, *args))
+
+    async def _db(self, func, *args):
+        loop = _running_loop()
+        return await loop.run_in_executor(self._database,
+                                          functools.partial(func, *args))
+
+    async def close(self):
+        await self._db(self._store.close)
+        self._database.shutdown(wait=False)
+        self._workers.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _store_blob(self, newfile):
+        # Runs on a worker thread
+        if not isinstance(newfile, string_types):
+            return self._store._store_file(newfile)
+        elif os.path.isdir(newfile):
+            return self._store._store_directory(newfile)
+        else:
+            if os.path.islink(newfile):
+                warnings.warn("%s is a symbolic link, using target file "
+                              "instead" % newfile,
+                              UsageWarning)
+            with open(newfile, 'rb') as fp:
+                return self._store._store_file(fp, os.path.basename(newfile))
+
+    async def add(self, newfile, metadata):
+        """Adds a file or directory with a dict of metadata.
+
+        newfile can be a path to a file or directory, or a file object (which
+        will be read from a worker thread).
+        """
+        # Fail early on invalid metadata, before copying anything
+        normalize_metadata(metadata)
+        entry = None
+        while entry is None:
+            filehash, created, stats = await self._run(self._store_blob,
+                                                       newfile)
+            entry = await self._db(self._store._add_entry,
+                                   filehash, created, metadata, stats)
+        # A concurrent remove() might have decided to delete that same blob
+        # before our entry was added; store it again once it is gone
+        deleting = self._deleting.get(filehash)
+        if deleting is not None:
+            await deleting
+        blob = self._store._make_filename(filehash)
+        if not await self._run(os.path.exists, blob):
+            await self._run(self._store_blob, newfile)
+        return entry
+
+    async def get(self, objectid):
+        """Gets an Entry from its objectid.
+        """
+        return await self._db(self._store.get, objectid)
+
+    def query(self, conditions, limit=None):
+        """Returns all the Entries matching the conditions.
+
+        This returns an asynchronous iterator, to be used with `async for`.
+        """
+        return AsyncEntryIterator(self, conditions, limit)
+
+    async def remove(self, objectid):
+        """Removes a file or directory given its objectid or Entry.
+        """
+        filehash = await self._db(self._store._remove_entry, objectid)
+        if filehash is None:
+            return
+        deleting = self._deleting.get(filehash)
+        if deleting is not None:
+            await deleting
+            return
+        deleting = _running_loop().create_future()
+        self._deleting[filehash] = deleting
+        try:
+            children = await self._db(self._store._release_blob, filehash)
+            await self._run(self._store._delete_blob, filehash, children)
+        finally:
+            del self._deleting[filehash]
+            deleting.set_result(None)
+
+    async def open(self, objectid, path=None, binary=True):
+        """Opens a file from the store, given its objectid or Entry.
+
+        Returns an AsyncFile.
+        """
+        if isinstance(objectid, Entry):
+            filepath = objectid.filename
+        else:
+            filepath = await self._db(self._store.get_filename, objectid)
+        fileobj = await self._run(self._store._open_blob,
+                                  filepath, path, binary)
+        return AsyncFile(self, fileobj)
@@ -0,0 +1,362 @@
+"""On-disk formats of the file blobs.
+
+Most blobs are simply a copy of the file. Others start with MAGIC, followed by
+a header line giving their kind (and parameters), and are decoded by a reader
+for that kind:
+
+ * 'raw': the content follows as-is (used for files that start with MAGIC)
+ * 'compressed <codec> <block_size>': the content is compressed in
+   independent blocks, followed by an index of their sizes
+ * 'chunked': the content is the concatenation of chunks from the chunk store,
+   listed one per line as '<chunkhash> <size>'
+ * 'directory': a directory, listed as the lines hash_directory() hashes
+   ('file <name> <hash>', 'dir <name> <hash>' or 'link <name> <hash>'); file
+   and dir lines refer to other blobs, and link lines are followed by a line
+   with the target of the link, prefixed with a tab
+"""
+
+from __future__ import division, unicode_literals
+
+import bisect
+import errno
+import io
+import os
+import struct
+
+from file_archive.compression import get_codec
+
+
+__all__ = ['MAGIC', 'open_blob', 'map_blob', 'write_blob', 'read_refs',
+           'blob_kind', 'read_directory', 'write_directory',
+           'SegmentedReader']
+
+
+MAGIC = b'\x00file_archive blob\n'
+
+CHUNKSIZE = 65536
+
+_FOOTER = struct.Struct('>QQ')
+
+
+class SegmentedReader(io.RawIOBase):
+    """Seekable reader over content made of consecutive segments.
+
+    `offsets` gives the offset of each segment in the content, followed by
+    the total size. Subclasses implement _load(index), returning the bytes of
+    a segment; the last one loaded is kept around.
+    """
+    def __init__(self, fp, offsets):
+        io.RawIOBase.__init__(self)
+        self._fp = fp
+        self._offsets = offsets
+        self._pos = 0
+        self._cached = None, None
+
+    @property
+    def size(self):
+        return self._offsets[-1]
+
+    def _load(self, index):
+        raise NotImplementedError
+
+    def _segment(self, index):
+        if self._cached[0] != index:
+            self._cached = index, self._load(index)
+        return self._cached[1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        if self._pos >= self.size:
+            return 0
+        index = bisect.bisect_right(self._offsets, self._pos) - 1
+        data = self._segment(index)
+        start = self._pos - self._offsets[index]
+        n = min(len(b), len(data) - start)
+        b[:n] = data[start:start + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+            self._cached = None, None
+        io.RawIOBase.close(self)
+
+
+class RawReader(SegmentedReader):
+    """Reader for 'raw' blobs, skipping the header.
+    """
+    def __init__(self, fp, start, args):
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell() - start
+        offsets = list(range(0, size, CHUNKSIZE)) + [size]
+        SegmentedReader.__init__(self, fp, offsets)
+        self._start = start
+
+    def _load(self, index):
+        self._fp.seek(self._start + self._offsets[index])
+        return self._fp.read(self._offsets[index + 1] - self._offsets[index])
+
+
+class CompressedReader(SegmentedReader):
+    """Reader for 'compressed' blobs, decompressing the needed blocks only.
+    """
+    def __init__(self, fp, start, args):
+        codec, block_size = args
+        self._codec = get_codec(codec)
+        block_size = int(block_size)
+        fp.seek(-_FOOTER.size, os.SEEK_END)
+        nblocks, size = _FOOTER.unpack(fp.read(_FOOTER.size))
+        index = struct.Struct('>%dQ' % nblocks)
+        fp.seek(-_FOOTER.size - index.size, os.SEEK_END)
+        self._sizes = index.unpack(fp.read(index.size))
+        self._locations = []
+        for csize in self._sizes:
+            self._locations.append(start)
+            start += csize
+        offsets = [i * block_size for i in range(nblocks)] + [size]
+        SegmentedReader.__init__(self, fp, offsets)
+
+    def _load(self, index):
+        self._fp.seek(self._locations[index])
+        return self._codec.decompress(self._fp.read(self._sizes[index]))
+
+
+def chunk_path(objects, chunkhash):
+    """Gets the path of a chunk in the chunk store.
+    """
+    return os.path.join(objects, 'chunks', chunkhash[:2], chunkhash[2:])
+
+
+def _read_manifest(fp):
+    # Reads the rest of a 'chunked' blob, as a list of (chunkhash, size)
+    chunks = []
+    for line in fp:
+        chunkhash, size = line.decode('ascii').split()
+        chunks.append((chunkhash, int(size)))
+    return chunks
+
+
+class ChunkedReader(SegmentedReader):
+    """Reader for 'chunked' blobs, reassembling the chunks as needed.
+    """
+    def __init__(self, fp, start, args):
+        # The chunk store is in the objects directory, above the blob's
+        objects = os.path.dirname(os.path.dirname(os.path.abspath(fp.name)))
+        chunks = _read_manifest(fp)
+        self._paths = [chunk_path(objects, h) for h, _size in chunks]
+        offsets = [0]
+        for _chunkhash, size in chunks:
+            offsets.append(offsets[-1] + size)
+        SegmentedReader.__init__(self, fp, offsets)
+
+    def _load(self, index):
+        # Chunks are blobs themselves, they might be compressed
+        with open_blob(self._paths[index]) as chunk:
+            return chunk.read()
+
+
+_READERS = {'raw': RawReader, 'compressed': CompressedReader,
+            'chunked': ChunkedReader}
+
+
+def read_refs(path):
+    """Lists what a blob refers to, as (kind, hash) pairs.
+
+    These need to be kept around as long as the blob exists.
+    """
+    if os.path.isdir(path):
+        return []
+    with open(path, 'rb') as fp:
+        header = _read_header(fp)
+        if header == ['chunked']:
+            return [('chunk', h) for h, _size in _read_manifest(fp)]
+        elif header == ['directory']:
+            return [('blob', h)
+                    for kind, _name, h, _target in _read_directory(fp)
+                    if kind != 'link']
+    return []
+
+
+def _read_directory(fp):
+    entries = []
+    for line in fp:
+        line = line.decode('utf-8')[:-1]
+        if line.startswith('\t'):
+            kind, name, filehash, _target = entries[-1]
+            entries[-1] = kind, name, filehash, line[1:]
+        else:
+            kind, rest = line.split(' ', 1)
+            name, filehash = rest.rsplit(' ', 1)
+            entries.append((kind, name, filehash, None))
+    return entries
+
+
+def read_directory(path):
+    """Reads a 'directory' blob.
+
+    Returns a list of (kind, name, hash, link_target) tuples, in the order
+    hash_directory() hashes them.
+    """
+    with open(path, 'rb') as fp:
+        if _read_header(fp) != ['directory']:
+            raise IOError(errno.ENOTDIR, "Not a directory", path)
+        return _read_directory(fp)
+
+
+def write_directory(entries, destination):
+    """Writes a 'directory' blob, from (kind, name, hash, link_target) tuples.
+    """
+    with open(destination, 'wb') as destobj:
+        destobj.write(MAGIC)
+        destobj.write(b'directory\n')
+        for kind, name, filehash, target in entries:
+            destobj.write(('%s %s %s\n' % (kind, name, filehash))
+                          .encode('utf-8'))
+            if target is not None:
+                destobj.write(('\t%s\n' % target).encode('utf-8'))
+
+
+def _read_header(fp):
+    # Returns the header of an encoded blob as a list, or None
+    if fp.read(len(MAGIC)) != MAGIC:
+        return None
+    return fp.readline(1024).decode('ascii').split()
+
+
+def blob_kind(path):
+    """Returns the kind of an encoded blob, or None if it is stored as-is.
+    """
+    if os.path.isdir(path):
+        return None
+    with open(path, 'rb') as fp:
+        header = _read_header(fp)
+    return header[0] if header else None
+
+
+def open_blob(path, binary=True):
+    """Opens a file blob for reading, decoding it if needed.
+    """
+    fp = open(path, 'rb')
+    try:
+        header = _read_header(fp)
+        if header is None:
+            if binary:
+                fp.seek(0)
+                return fp
+            fp.close()
+            return open(path, 'r')
+        if header[:1] == ['directory']:
+            raise IOError(errno.EISDIR, "Is a directory", path)
+        try:
+            reader = _READERS[header[0]]
+        except (IndexError, KeyError):
+            raise IOError("Unknown blob format in %s" % path)
+        stream = io.BufferedReader(reader(fp, fp.tell(), header[1:]),
+                                   CHUNKSIZE)
+    except BaseException:
+        fp.close()
+        raise
+    if not binary:
+        stream = io.TextIOWrapper(stream)
+    return stream
+
+
+def map_blob(path, decode=True):
+    """Maps a file blob in memory, read-only.
+
+    Blobs stored as-is are memory-mapped, and an mmap object is returned;
+    others are decoded into memory, and a read-only memoryview is returned.
+    If `decode` is False, the file is mapped whatever its content.
+    """
+    with open(path, 'rb') as fp:
+        if not decode or _read_header(fp) is None:
+            size = os.fstat(fp.fileno()).st_size
+            if size == 0:
+                # Empty files can't be mapped
+                return memoryview(b'')
+            import mmap
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    with open_blob(path) as fp:
+        return memoryview(fp.read())
+
+
+def _write_compressed(fileobj, destobj, compression):
+    codec = get_codec(compression.codec)
+    block = fileobj.read(compression.block_size)
+    data = codec.compress(block, compression.level)
+    if len(data) > len(block) * compression.max_ratio:
+        return False  # Not worth it
+    destobj.write(MAGIC)
+    destobj.write(('compressed %s %d\n' % (
+        codec.name, compression.block_size)).encode('ascii'))
+    sizes = []
+    total = 0
+    while block:
+        destobj.write(data)
+        sizes.append(len(data))
+        total += len(block)
+        block = fileobj.read(compression.block_size)
+        if block:
+            data = codec.compress(block, compression.level)
+    destobj.write(struct.pack('>%dQ' % len(sizes), *sizes))
+    destobj.write(_FOOTER.pack(len(sizes), total))
+    return True
+
+
+def write_chunked(chunks, destination):
+    """Writes a 'chunked' blob, given a list of (chunkhash, size).
+    """
+    with open(destination, 'wb') as destobj:
+        destobj.write(MAGIC)
+        destobj.write(b'chunked\n')
+        for chunkhash, size in chunks:
+            destobj.write(('%s %d\n' % (chunkhash, size)).encode('ascii'))
+
+
+def write_blob(fileobj, destination, compression=None, name=None):
+    """Writes a file object to a new blob.
+
+    If a Compression object is given, the blob is compressed if it seems worth
+    it; `name` is the original filename, if known, to help decide.
+    """
+    with open(destination, 'wb') as destobj:
+        try:
+            if compression is not None:
+                fileobj.seek(0, os.SEEK_END)
+                size = fileobj.tell()
+                fileobj.seek(0, os.SEEK_SET)
+                if compression.should_compress(size, name):
+                    if _write_compressed(fileobj, destobj, compression):
+                        return
+                    fileobj.seek(0, os.SEEK_SET)
+            chunk = fileobj.read(CHUNKSIZE)
+            if chunk.startswith(MAGIC):
+                # Mark it, so it doesn't get confused with an encoded blob
+                destobj.write(MAGIC)
+                destobj.write(b'raw\n')
+            while chunk:
+                destobj.write(chunk)
+                chunk = fileobj.read(CHUNKSIZE)
+        except BaseException:  # pragma: no cover
+            destobj.close()
+            os.remove(destination)
+            raise
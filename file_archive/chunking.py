@@ -0,0 +1,195 @@
+"""Content-defined chunking of large files.
+
+Files are cut where a gear rolling hash of the last bytes matches a mask, as
+in FastCDC; since cut points only depend on the nearby content, two versions
+of a file that differ in a few places share most of their chunks.
+
+If numpy is available, the hash is computed over blocks of data at once;
+otherwise a pure-Python loop is used, which only manages a few MB/s, making
+chunking of very large files slow. Both find the same cut points.
+"""
+
+from __future__ import division, unicode_literals
+
+import hashlib
+
+
+__all__ = ['Chunking', 'iter_chunks']
+
+
+def _gear_table():
+    # Any fixed random-looking values will do; they just can't ever change
+    table = []
+    for i in range(256):
+        digest = hashlib.sha1(('gear %d' % i).encode('ascii')).hexdigest()
+        table.append(int(digest[:16], 16))
+    return table
+
+
+GEAR = _gear_table()
+
+_MASK64 = (1 << 64) - 1
+
+
+# Numpy version of the gear table, built on first use; False if numpy is not
+# available
+_gear_array = None
+
+# Size of the blocks the vectorized search works on
+_BLOCK = 1 << 16
+
+
+def _get_gear_array():
+    global _gear_array
+    if _gear_array is None:
+        try:
+            import numpy
+        except ImportError:
+            _gear_array = False
+        else:
+            _gear_array = numpy.array(GEAR, dtype=numpy.uint64)
+    return _gear_array
+
+
+def _scan(data, h, i, end, mask):
+    # Runs the gear hash over data[i:end], returns (cut, h), cut being None
+    # if no cut point was found
+    gear = GEAR
+    while i < end:
+        h = ((h << 1) + gear[data[i]]) & _MASK64
+        i += 1
+        if not h & mask:
+            return i, h
+    return None, h
+
+
+def _scan_vectorized(data, i, end, mask, gear):
+    # Same as _scan(), for i at least 63 bytes after the start of the hash:
+    # from there, the hash only depends on the last 64 bytes (the others are
+    # shifted out), so it can be computed for all the positions at once
+    import numpy
+
+    mask = numpy.uint64(mask)
+    shifted = numpy.empty(_BLOCK + 63, dtype=numpy.uint64)
+    while i < end:
+        stop = min(i + _BLOCK, end)
+        window = numpy.frombuffer(bytes(data[i - 63:stop]), numpy.uint8)
+        # Hash of the window ending at each byte, built by doubling the
+        # window size: h(2m) = h(m) + h(m) m bytes earlier shifted by m
+        h = numpy.take(gear, window)
+        m = 1
+        while m < 64:
+            numpy.left_shift(h[:-m], numpy.uint64(m),
+                             out=shifted[:len(h) - m])
+            h = h[m:]
+            h += shifted[:len(h)]
+            m *= 2
+        cuts = numpy.flatnonzero((h & mask) == 0)
+        if len(cuts):
+            return i + int(cuts[0]) + 1
+        i = stop
+    return None
+
+
+def _mask(bits):
+    # Spread the bits over the high part of the hash, which depends on more
+    # bytes than the low part
+    mask = 0
+    for i in range(bits):
+        mask |= 1 << (63 - i * 2)
+    return mask
+
+
+class Chunking(object):
+    """Chunking options for a store.
+
+    Files of at least `threshold` bytes are stored as a list of chunks of
+    `min_size` to `max_size` bytes, `avg_size` on average (this should be a
+    power of two).
+    """
+    def __init__(self, avg_size=1 << 20, min_size=None, max_size=None,
+                 threshold=None):
+        if avg_size & (avg_size - 1):
+            raise ValueError("Average chunk size should be a power of two")
+        self.avg_size = avg_size
+        self.min_size = min_size if min_size is not None else avg_size // 4
+        self.max_size = max_size if max_size is not None else avg_size * 8
+        self.threshold = (threshold if threshold is not None
+                          else self.max_size)
+        if not 0 < self.min_size <= avg_size <= self.max_size:
+            raise ValueError("Invalid chunk sizes")
+        # Normalized chunking: cut points are harder to find before the
+        # average size and easier after, narrowing the distribution of sizes
+        bits = avg_size.bit_length() - 1
+        self.mask_small = _mask(bits + 1)
+        self.mask_large = _mask(max(bits - 1, 1))
+
+    def to_config(self):
+        """Returns the options to record in the store's database.
+        """
+        return {'chunking.avg_size': '%d' % self.avg_size,
+                'chunking.min_size': '%d' % self.min_size,
+                'chunking.max_size': '%d' % self.max_size,
+                'chunking.threshold': '%d' % self.threshold}
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds the options recorded in a store's database, or None.
+        """
+        if 'chunking.avg_size' not in config:
+            return None
+        return cls(int(config['chunking.avg_size']),
+                   min_size=int(config['chunking.min_size']),
+                   max_size=int(config['chunking.max_size']),
+                   threshold=int(config['chunking.threshold']))
+
+    def find_cut(self, data, start, end, vectorized=True):
+        """Finds the end of the chunk starting at `start` in a bytearray.
+
+        `end` is the end of the available data; it is returned if no cut
+        point is found before it (and before max_size). The search uses numpy
+        if it is available, unless `vectorized` is False.
+        """
+        if end - start <= self.min_size:
+            return end
+        normal = min(start + self.avg_size, end)
+        limit = min(start + self.max_size, end)
+        segments = [(normal, self.mask_small), (limit, self.mask_large)]
+        gear = _get_gear_array() if vectorized else False
+        i = start + self.min_size
+        # The first bytes are always hashed one by one
+        warm = min(i + 63, limit) if gear is not False else limit
+        h = 0
+        for stop, mask in segments:
+            stop = min(stop, warm)
+            if i < stop:
+                cut, h = _scan(data, h, i, stop, mask)
+                if cut is not None:
+                    return cut
+                i = stop
+        for stop, mask in segments:
+            if i < stop:
+                cut = _scan_vectorized(data, i, stop, mask, gear)
+                if cut is not None:
+                    return cut
+                i = stop
+        return limit
+
+
+def iter_chunks(fileobj, chunking):
+    """Reads a file object and yields its content-defined chunks, as bytes.
+    """
+    buf = bytearray()
+    eof = False
+    while True:
+        # Keep enough data around to find the next cut point
+        while not eof and len(buf) < chunking.max_size:
+            data = fileobj.read(chunking.max_size * 4)
+            if not data:
+                eof = True
+            buf.extend(data)
+        if not buf:
+            return
+        cut = chunking.find_cut(buf, 0, len(buf))
+        yield bytes(buf[:cut])
+        del buf[:cut]
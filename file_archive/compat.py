@@ -4,20 +4,21 @@ isinstance() checks:
  * Use string_types instead of 2's basestring
  * Use int_types instead of 3's int
 
-sha1:
- * Silently accepts unicode so long as it's ASCII
-
 BytesIO, StringIO
+
+queue: the Queue module
+
+scandir: os.scandir, or a slower equivalent on Python < 3.5
 """
 
 from __future__ import division, unicode_literals
 
-import hashlib
+import os
 import sys
 
 
-__all__ = ['PY3', 'string_types', 'int_types', 'sha1', 'unicode_type',
-           'StringIO', 'BytesIO']
+__all__ = ['PY3', 'string_types', 'int_types', 'unicode_type',
+           'StringIO', 'BytesIO', 'queue', 'scandir']
 
 
 PY3 = sys.version_info >= (3, 0)
@@ -30,6 +31,8 @@ if not PY3:
 
     from StringIO import StringIO
     BytesIO = StringIO
+
+    import Queue as queue
 else:
     string_types = str
     int_types = int
@@ -37,17 +40,38 @@ else:
 
     from io import StringIO, BytesIO
 
+    import queue
+
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    class DirEntry(object):
+        def __init__(self, directory, name):
+            self.name = name
+            self.path = os.path.join(directory, name)
+
+        def is_dir(self, follow_symlinks=True):
+            if not follow_symlinks and os.path.islink(self.path):
+                return False
+            return os.path.isdir(self.path)
+
+        def is_file(self, follow_symlinks=True):
+            if not follow_symlinks and os.path.islink(self.path):
+                return False
+            return os.path.isfile(self.path)
+
+        def is_symlink(self):
+            return os.path.islink(self.path)
 
-class sha1(object):
-    def __init__(self, arg=b''):
-        self._hash = hashlib.sha1()
-        if arg:
-            self.update(arg)
+        def stat(self, follow_symlinks=True):
+            if follow_symlinks:
+                return os.stat(self.path)
+            else:
+                return os.lstat(self.path)
 
-    def update(self, arg):
-        if not isinstance(arg, bytes):
-            arg = arg.encode('ascii')
-        self._hash.update(arg)
+        def inode(self):
+            return os.lstat(self.path).st_ino
 
-    def hexdigest(self):
-        return self._hash.hexdigest()
+    def scandir(path='.'):
+        return iter([DirEntry(path, name) for name in os.listdir(path)])
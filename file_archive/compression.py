@@ -0,0 +1,182 @@
+"""Compression codecs for stored blobs.
+
+Codecs are looked up by name; 'gzip' is always available, 'lzma' needs the
+lzma module (Python 3.3+), and 'zstd' needs the zstandard package. More can be
+added with register_codec().
+"""
+
+from __future__ import division, unicode_literals
+
+import os
+
+
+__all__ = ['Compression', 'register_codec', 'available_codecs']
+
+
+class Codec(object):
+    """A compression method, as a pair of functions over bytes.
+    """
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _gzip():
+    import zlib
+
+    def compress(data, level=None):
+        if level is None:
+            level = 6
+        obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return obj.compress(data) + obj.flush()
+
+    def decompress(data):
+        return zlib.decompress(data, 31)
+
+    return Codec('gzip', compress, decompress)
+
+
+def _lzma():
+    import lzma
+
+    def compress(data, level=None):
+        return lzma.compress(data, preset=level)
+
+    return Codec('lzma', compress, lzma.decompress)
+
+
+def _zstd():
+    import zstandard
+
+    def compress(data, level=None):
+        if level is None:
+            level = 3
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return Codec('zstd', compress, decompress)
+
+
+# Functions building the codecs, so that their modules are imported on first
+# use only
+_factories = {'gzip': _gzip, 'lzma': _lzma, 'zstd': _zstd}
+_codecs = {}
+
+
+def register_codec(name, compress, decompress):
+    """Adds a codec.
+
+    compress(data, level) and decompress(data) should work on bytes; level
+    might be None, for the default level.
+    """
+    _codecs[name] = Codec(name, compress, decompress)
+
+
+def get_codec(name):
+    """Gets a codec by name.
+
+    Raises KeyError if it doesn't exist and ImportError if its module is not
+    available.
+    """
+    try:
+        return _codecs[name]
+    except KeyError:
+        pass
+    codec = _factories[name]()
+    _codecs[name] = codec
+    return codec
+
+
+def available_codecs():
+    """Returns the names of the codecs that can be used.
+    """
+    names = []
+    for name in sorted(set(_factories) | set(_codecs)):
+        try:
+            get_codec(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+class Compression(object):
+    """Compression options for a store.
+
+    `codec` is the name of the codec to use for new blobs; by default, zstd
+    if available, else gzip. Files smaller than `min_size` bytes or whose
+    name has one of the `skip_extensions` are not compressed, and neither are
+    files for which the first block doesn't compress below `max_ratio` of its
+    size. Blobs are compressed in independent blocks of `block_size` bytes, so
+    that they can be read from the middle.
+    """
+    SKIP_EXTENSIONS = frozenset([
+        '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.zip', '.7z', '.rar',
+        '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.ogg', '.mp4',
+        '.mkv', '.avi', '.webm', '.pdf', '.docx', '.xlsx', '.jar',
+    ])
+
+    def __init__(self, codec=None, level=None, min_size=1024,
+                 skip_extensions=SKIP_EXTENSIONS, max_ratio=0.9,
+                 block_size=1 << 20):
+        if codec is None:
+            codec = 'zstd' if 'zstd' in available_codecs() else 'gzip'
+        # Fail early if the codec is not available
+        try:
+            get_codec(codec)
+        except KeyError:
+            raise ValueError("Unknown compression codec %r" % codec)
+        self.codec = codec
+        self.level = level
+        self.min_size = min_size
+        self.skip_extensions = frozenset(skip_extensions)
+        self.max_ratio = max_ratio
+        self.block_size = block_size
+
+    def should_compress(self, size, name=None):
+        """Decides whether to try compressing a file, from its size and name.
+        """
+        if size < self.min_size:
+            return False
+        if name is not None:
+            ext = os.path.splitext(name)[1].lower()
+            if ext in self.skip_extensions:
+                return False
+        return True
+
+    def to_config(self):
+        """Returns the options to record in the store's database.
+        """
+        config = {'compression.codec': self.codec,
+                  'compression.min_size': '%d' % self.min_size,
+                  'compression.block_size': '%d' % self.block_size,
+                  'compression.skip_extensions': ' '.join(
+                      sorted(self.skip_extensions)),
+                  'compression.max_ratio': repr(self.max_ratio)}
+        if self.level is not None:
+            config['compression.level'] = '%d' % self.level
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds the options recorded in a store's database, or None.
+        """
+        if 'compression.codec' not in config:
+            return None
+        level = config.get('compression.level')
+        # Stores created before these were recorded use the defaults
+        skip_extensions = config.get('compression.skip_extensions')
+        if skip_extensions is None:
+            skip_extensions = cls.SKIP_EXTENSIONS
+        else:
+            skip_extensions = skip_extensions.split()
+        max_ratio = float(config.get('compression.max_ratio', 0.9))
+        return cls(config['compression.codec'],
+                   level=int(level) if level is not None else None,
+                   min_size=int(config['compression.min_size']),
+                   skip_extensions=skip_extensions,
+                   max_ratio=max_ratio,
+                   block_size=int(config['compression.block_size']))
@@ -1,12 +1,15 @@
 from __future__ import division, unicode_literals
 
+import contextlib
 import sqlite3
+import threading
+import time
 
-from file_archive.compat import PY3, string_types, int_types
+from file_archive.compat import PY3, string_types, int_types, queue
 from file_archive.errors import Error, CreationError, InvalidStore
 
 
-__all__ = ['MetadataStore']
+__all__ = ['MetadataStore', 'ConnectionPool', 'GroupCommit']
 
 
 if not PY3:
@@ -54,23 +57,376 @@ def normalize_metadata(metadata):
 _TYPES = [('TEXT', 'str'), ('INTEGER', 'int')]
 
 
+# Tables added to the schema after the 'metadata' table; they get created when
+# opening a store that doesn't have them yet
+_EXTRA_TABLES = [
+    ('verify_ledger', [
+        '''
+        CREATE TABLE verify_ledger(
+            filehash VARCHAR(40) NOT NULL PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            verified_at INTEGER NOT NULL)
+        ''',
+    ]),
+    ('store_config', [
+        '''
+        CREATE TABLE store_config(
+            key VARCHAR(255) NOT NULL PRIMARY KEY,
+            value TEXT NOT NULL)
+        ''',
+    ]),
+    ('blob_refs', [
+        '''
+        CREATE TABLE blob_refs(
+            parent VARCHAR(40) NOT NULL,
+            kind VARCHAR(8) NOT NULL,
+            child VARCHAR(40) NOT NULL,
+            PRIMARY KEY(parent, kind, child))
+        ''',
+        'CREATE INDEX blob_refs_child ON blob_refs(kind, child)',
+    ]),
+    ('blob_stats', [
+        '''
+        CREATE TABLE blob_stats(
+            filehash VARCHAR(40) NOT NULL PRIMARY KEY,
+            size INTEGER NOT NULL,
+            files INTEGER NOT NULL)
+        ''',
+        'CREATE INDEX blob_stats_size ON blob_stats(size)',
+    ]),
+    ('hash_cache', [
+        '''
+        CREATE TABLE hash_cache(
+            path TEXT NOT NULL PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            filehash VARCHAR(40) NOT NULL)
+        ''',
+    ]),
+]
+
+
+# Indexes added to the schema later, created the same way; these let keys()
+# and values() summarize the metadata from the index alone
+_EXTRA_INDEXES = [
+    ('metadata_key_str',
+     'CREATE INDEX metadata_key_str ON metadata(mkey, mvalue_str)'),
+    ('metadata_key_int',
+     'CREATE INDEX metadata_key_int ON metadata(mkey, mvalue_int)'),
+]
+
+
+# Prefix for queries on the blobs that need to be kept: those of entries, and
+# those these blobs refer to (recursively, as directories can be nested)
+_LIVE_BLOBS = '''
+    WITH RECURSIVE live(filehash) AS (
+        SELECT mvalue_str FROM metadata WHERE mkey = 'hash'
+        UNION
+        SELECT child FROM blob_refs, live
+        WHERE kind = 'blob' AND parent = live.filehash)
+    '''
+
+
+def _create_extra_tables(cur, existing=()):
+    for name, queries in _EXTRA_TABLES:
+        if name not in existing:
+            for query in queries:
+                cur.execute(query)
+    for name, query in _EXTRA_INDEXES:
+        if name not in existing:
+            cur.execute(query)
+
+
+def _create_temp_tables(cur, names):
+    # Empty stand-ins for the extra tables, for a database we can't write to
+    for name, queries in _EXTRA_TABLES:
+        if name in names:
+            cur.execute(queries[0].replace('CREATE TABLE',
+                                           'CREATE TEMP TABLE', 1))
+
+
+class ConnectionPool(object):
+    """A bounded pool of read-only connections to a database.
+
+    Connections are created on demand, up to `size`; threads asking for a
+    connection when all of them are in use wait for one to be released.
+    `temp_tables` are the extra tables to create as temporary tables on each
+    connection, if the database is read-only and doesn't have them.
+    """
+    def __init__(self, database, size, temp_tables=()):
+        if size < 1:
+            raise ValueError("Pool size should be at least 1")
+        self.database = database
+        self.size = size
+        self.temp_tables = temp_tables
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        conn.row_factory = Row
+        if self.temp_tables:
+            _create_temp_tables(conn.cursor(), self.temp_tables)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, conn):
+        with self._lock:
+            closed = self._closed
+            if closed:
+                self._created -= 1
+            else:
+                self._idle.put(conn)
+        if closed:
+            conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Closes the idle connections.
+
+        Connections still in use are closed when they are released.
+        """
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+class GroupCommit(object):
+    """Options for committing the writes of concurrent callers together.
+
+    Writes are accumulated for up to `delay` seconds or `max_entries`
+    operations, then committed in a single transaction.
+
+    If `wait` is True, callers return once their write is committed. If it is
+    False, additions return immediately ("fire-and-forget"): they might not be
+    visible to queries until flushed, and their errors are raised by the next
+    flush() or close() instead.
+    """
+    def __init__(self, delay=0.01, max_entries=100, wait=True):
+        self.delay = delay
+        self.max_entries = max_entries
+        self.wait = wait
+
+
+class PendingWrite(object):
+    """A write queued on a GroupCommitWriter.
+
+    If urgent is True, the batch gets committed as soon as it is received.
+    """
+    def __init__(self, func, urgent=False):
+        self.func = func
+        self.urgent = urgent
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter(object):
+    """Background thread committing queued writes in batches.
+
+    Each write is a function called with a cursor, run in its own savepoint so
+    that a failing write doesn't affect the others in the same transaction.
+    """
+    _STOP = object()
+
+    def __init__(self, database, options):
+        self.options = options
+        self.commits = 0
+        self._queue = queue.Queue()
+        self._errors = []
+        self._conn = sqlite3.connect(database, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.row_factory = Row
+        self._thread = threading.Thread(target=self._run,
+                                        name='file_archive group commit')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, wait=None):
+        """Queues a write.
+
+        If wait is True (or None and the writer is not fire-and-forget),
+        waits for it to be committed and returns the result of func.
+        """
+        if wait is None:
+            wait = self.options.wait
+        # Don't delay a caller that waits when others don't have to
+        pending = PendingWrite(func, urgent=wait and not self.options.wait)
+        self._queue.put(pending)
+        if wait:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+        return None
+
+    def flush(self):
+        """Waits for all queued writes to be committed.
+
+        Raises the first error of a fire-and-forget write, if any.
+        """
+        pending = PendingWrite(None, urgent=True)
+        self._queue.put(pending)
+        pending.done.wait()
+        if self._errors:
+            error = self._errors[0]
+            self._errors = []
+            raise error
+
+    def close(self):
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._conn.close()
+        if self._errors:
+            raise self._errors[0]
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is self._STOP:
+                break
+            batch = [first]
+            deadline = time.time() + self.options.delay
+            while not batch[-1].urgent and \
+                    len(batch) < self.options.max_entries:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if pending is self._STOP:
+                    stop = True
+                    break
+                batch.append(pending)
+            self._commit(batch)
+
+    def _commit(self, batch):
+        cur = self._conn.cursor()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            for pending in batch:
+                if pending.func is None:
+                    continue
+                cur.execute('SAVEPOINT pending_write')
+                try:
+                    pending.result = pending.func(cur)
+                except Exception as e:
+                    cur.execute('ROLLBACK TO pending_write')
+                    pending.error = e
+                cur.execute('RELEASE pending_write')
+            cur.execute('COMMIT')
+            self.commits += 1
+        except Exception as e:
+            try:
+                cur.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass  # Transaction was not started
+            for pending in batch:
+                if pending.error is None:
+                    pending.result = None
+                    pending.error = e
+        for pending in batch:
+            if pending.error is not None and not self.options.wait:
+                self._errors.append(pending.error)
+            pending.done.set()
+
+
 class MetadataStore(object):
     """The database holding metadata associated to SHA1 hashs.
+
+    By default, a single connection is used, which can only be used from the
+    thread that created the MetadataStore. If `pool_size` is given, the store
+    can be shared between threads: queries are run on a pool of up to
+    `pool_size` read connections, and writes are serialized on a single
+    writer connection.
+
+    If `group_commit` is given (a GroupCommit object), writes from concurrent
+    callers are batched and committed together by a background thread.
     """
-    def __init__(self, database):
+    # How long results of keys() and values() are kept, in seconds
+    SUMMARY_EXPIRY = 10
+
+    def __init__(self, database, pool_size=None, group_commit=None):
+        self._pool = None
+        self._writer = None
+        self._write_lock = threading.Lock()
+        self._summaries = {}
         try:
-            self.conn = sqlite3.connect(database)
+            self.conn = sqlite3.connect(database,
+                                        check_same_thread=pool_size is None)
             self.conn.row_factory = Row
             cur = self.conn.cursor()
             tables = cur.execute('''
-                    SELECT name FROM sqlite_master WHERE type = 'table'
+                    SELECT type, name FROM sqlite_master
+                    WHERE type IN ('table', 'index')
                     ''')
             tables = set(r['name'] for r in tables.fetchall())
-            if tables != set(['metadata']):
+            if 'metadata' not in tables:
                 raise InvalidStore("Database doesn't have required structure")
+            temp_tables = []
+            if not all(name in tables
+                       for name, _queries in _EXTRA_TABLES + _EXTRA_INDEXES):
+                try:
+                    _create_extra_tables(cur, tables)
+                    self.conn.commit()
+                except sqlite3.OperationalError:
+                    # Read-only database: do without the indexes, and use
+                    # empty temporary tables for the missing ones
+                    self.conn.rollback()
+                    temp_tables = [name for name, _queries in _EXTRA_TABLES
+                                   if name not in tables]
+                    _create_temp_tables(cur, temp_tables)
+            if ((pool_size is not None or group_commit is not None) and
+                    not temp_tables):
+                # Write-ahead logging lets readers proceed during writes
+                cur.execute('PRAGMA journal_mode = WAL')
+            if pool_size is not None:
+                self._pool = ConnectionPool(database, pool_size, temp_tables)
+            if group_commit is not None:
+                self._writer = GroupCommitWriter(database, group_commit)
         except sqlite3.Error as e:
             raise InvalidStore("Cannot access database: %s: %s" % (
-                e.__class__.__name__, e.message))
+                e.__class__.__name__, e))
 
     @staticmethod
     def create_db(database):
@@ -99,26 +455,99 @@ class MetadataStore(object):
             cur.execute(query)
             for idx_query in indexes:
                 cur.execute(idx_query)
+            _create_extra_tables(cur)
 
             conn.commit()
             conn.close()
         except sqlite3.Error as e:  # pragma: no cover
             raise CreationError("Could not create database: %s: %s" % (
-                e.__class__.__name__, e.message))
+                e.__class__.__name__, e))
 
     def close(self):
-        self.conn.commit()
-        self.conn.close()
+        try:
+            if self._writer is not None:
+                self._writer.close()
+        finally:
+            with self._write_lock:
+                self.conn.commit()
+                self.conn.close()
+            if self._pool is not None:
+                self._pool.close()
+
+    def flush(self):
+        """Waits for pending writes to be committed, when using group commit.
+
+        Errors from fire-and-forget writes are raised here.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Context manager giving out a connection to run queries on.
+        """
+        if self._pool is None:
+            yield self.conn
+        else:
+            with self._pool.connection() as conn:
+                yield conn
 
-    def add(self, objectid, metadata):
+    def _write(self, func, deferrable=False):
+        """Runs func(cursor) in a transaction on the writer connection.
+
+        Writes are serialized. Returns what func returned.
+
+        With group commit, the write is handed to the writer thread; if
+        deferrable is True and the writer is fire-and-forget, this returns
+        None without waiting for the commit.
+        """
+        # Summaries might change; fire-and-forget writes only show up in them
+        # after the next write, or when they expire
+        self._summaries = {}
+        if self._writer is not None:
+            return self._writer.submit(func,
+                                       wait=None if deferrable else True)
+        with self._write_lock:
+            cur = self.conn.cursor()
+            try:
+                result = func(cur)
+                self.conn.commit()
+                return result
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+    def add(self, objectid, metadata, refs=None, stats=None):
         """Adds an object to the store.
 
-        Returns True if it wasn't already stored.
+        `refs` is a list of (parent, kind, hash) for what the blob refers to,
+        such as chunks, and what those refer to in turn; they are recorded
+        with the entry so that they don't get garbage-collected.
+
+        `stats` is (size, files) for the blob: the total size of the content
+        and the number of files (1 for a file).
+
+        Returns True if it wasn't already stored (None if the write was
+        deferred by a fire-and-forget group commit).
         """
         assert 'hash' in metadata
         metadata = normalize_metadata(metadata)
-        cur = self.conn.cursor()
-        try:
+
+        def add(cur):
+            if refs:
+                cur.executemany(
+                    '''
+                    INSERT OR IGNORE INTO blob_refs(parent, kind, child)
+                    VALUES(?, ?, ?)
+                    ''',
+                    refs)
+            if stats is not None:
+                cur.execute(
+                    '''
+                    INSERT OR REPLACE INTO blob_stats(filehash, size, files)
+                    VALUES(?, ?, ?)
+                    ''',
+                    (metadata['hash']['value'],) + tuple(stats))
             cur.execute(
                 '''
                 SELECT objectid FROM metadata
@@ -137,19 +566,15 @@ class MetadataStore(object):
                     VALUES(:objectid, :key, :value)
                     '''.format(name=t),
                     {'objectid': objectid, 'key': mkey, 'value': v})
-            self.conn.commit()
             return True
-        except BaseException:
-            self.conn.rollback()
-            raise
+        return self._write(add, deferrable=True)
 
     def remove(self, objectid):
         """Removes an object from the store.
 
         Raises KeyError if the entry didn't exist.
         """
-        cur = self.conn.cursor()
-        try:
+        def remove(cur):
             cur.execute(
                 '''
                 DELETE FROM metadata WHERE objectid = :objectid
@@ -157,45 +582,608 @@ class MetadataStore(object):
                 {'objectid': objectid})
             if not cur.rowcount:
                 raise KeyError(objectid)
-            self.conn.commit()
-        except BaseException:
-            self.conn.rollback()
-            raise
+        self._write(remove)
+
+    def remove_many(self, conditions=None, objectids=None):
+        """Removes all the objects matching conditions, or with given ids.
+
+        This happens in a single transaction: the objectids are collected in
+        a temporary table, deleted together, and the file hashes no entry
+        refers to anymore are found with a single query. Objectids that don't
+        exist are ignored.
+
+        Returns (count, filehashes) where count is the number of objects
+        removed and filehashes is the list of the now unreferenced hashes.
+        """
+        if (conditions is None) == (objectids is None):
+            raise TypeError("Either conditions or objectids should be given")
+
+        def remove_many(cur):
+            cur.execute(
+                '''
+                CREATE TEMP TABLE IF NOT EXISTS doomed(
+                    objectid VARCHAR(40) PRIMARY KEY,
+                    filehash VARCHAR(40))
+                ''')
+            try:
+                if objectids is not None:
+                    cur.executemany(
+                        '''
+                        INSERT OR IGNORE INTO temp.doomed(objectid)
+                        VALUES(?)
+                        ''',
+                        [(o,) for o in objectids])
+                else:
+                    hquery, params = self._objectid_query(conditions)
+                    cur.execute(
+                        '''
+                        INSERT OR IGNORE INTO temp.doomed(objectid)
+                        {ids}
+                        '''.format(ids=hquery),
+                        params)
+                cur.execute(
+                    '''
+                    UPDATE temp.doomed SET filehash = (
+                        SELECT mvalue_str FROM metadata
+                        WHERE metadata.objectid = doomed.objectid
+                            AND mkey = 'hash')
+                    ''')
+                cur.execute(
+                    '''
+                    DELETE FROM metadata
+                    WHERE objectid IN (SELECT objectid FROM temp.doomed)
+                    ''')
+                cur.execute(
+                    '''
+                    SELECT COUNT(*) FROM temp.doomed
+                    WHERE filehash IS NOT NULL
+                    ''')
+                count = cur.fetchone()[0]
+                # Anti-join: hashes of the removed entries no entry refers to
+                cur.execute(
+                    '''
+                    SELECT DISTINCT d.filehash FROM temp.doomed d
+                    WHERE d.filehash IS NOT NULL AND NOT EXISTS (
+                        SELECT 1 FROM metadata m
+                        WHERE m.mkey = 'hash' AND m.mvalue_str = d.filehash
+                    ) AND NOT EXISTS (
+                        SELECT 1 FROM blob_refs r
+                        WHERE r.kind = 'blob' AND r.child = d.filehash)
+                    ''')
+                filehashes = [r[0] for r in cur.fetchall()]
+            finally:
+                cur.execute('DELETE FROM temp.doomed')
+            return count, filehashes
+        return self._write(remove_many)
+
+    def update_metadata(self, conditions=None, objectids=None, set=None,
+                        unset=None, algorithm=None):
+        """Changes the metadata of all the objects matching conditions.
+
+        Alternatively, a list of objectids can be given. Keys in `set` are
+        given the new values, and keys in `unset` are removed; 'hash' can't be
+        changed. Entries are given their new objectids, computed with the hash
+        `algorithm`, and those that end up identical to another entry are
+        merged with it.
+
+        This happens in a single transaction: the objectids are collected in
+        a temporary table, the metadata rows are changed together, then the
+        new objectids are computed and applied.
+
+        Returns a dict mapping the objectids of the updated objects to their
+        new objectid.
+        """
+        from file_archive import hash_metadata
+
+        if (conditions is None) == (objectids is None):
+            raise TypeError("Either conditions or objectids should be given")
+        set = normalize_metadata(set or {})
+        unset = list(unset or [])
+        if 'hash' in set or 'hash' in unset:
+            raise ValueError("Can't change the hash of an entry")
+        if any(key in set for key in unset):
+            raise ValueError("Keys can't be both set and unset")
+
+        def update_metadata(cur):
+            cur.execute(
+                '''
+                CREATE TEMP TABLE IF NOT EXISTS retagged(
+                    objectid VARCHAR(40) PRIMARY KEY,
+                    newid VARCHAR(40))
+                ''')
+            cur.execute(
+                '''
+                CREATE INDEX IF NOT EXISTS temp.retagged_newid
+                ON retagged(newid)
+                ''')
+            try:
+                if objectids is not None:
+                    cur.executemany(
+                        '''
+                        INSERT OR IGNORE INTO temp.retagged(objectid)
+                        VALUES(?)
+                        ''',
+                        [(o,) for o in objectids])
+                    cur.execute(
+                        '''
+                        DELETE FROM temp.retagged WHERE NOT EXISTS (
+                            SELECT 1 FROM metadata m
+                            WHERE m.objectid = retagged.objectid)
+                        ''')
+                else:
+                    hquery, params = self._objectid_query(conditions)
+                    cur.execute(
+                        '''
+                        INSERT OR IGNORE INTO temp.retagged(objectid)
+                        {ids}
+                        '''.format(ids=hquery),
+                        params)
+                targets = 'SELECT objectid FROM temp.retagged'
+                keys = unset + list(set)
+                if keys:
+                    cur.execute(
+                        '''
+                        DELETE FROM metadata
+                        WHERE mkey IN ({keys}) AND objectid IN ({targets})
+                        '''.format(keys=', '.join('?' * len(keys)),
+                                   targets=targets),
+                        keys)
+                for mkey, mvalue in set.items():
+                    cur.execute(
+                        '''
+                        INSERT INTO metadata(objectid, mkey, mvalue_{name})
+                        SELECT objectid, :key, :value FROM temp.retagged
+                        '''.format(name=mvalue['type']),
+                        {'key': mkey, 'value': mvalue['value']})
+
+                # Compute the new objectids
+                rows = cur.execute(
+                    '''
+                    SELECT * FROM metadata
+                    WHERE objectid IN ({targets})
+                    ORDER BY objectid
+                    '''.format(targets=targets)).fetchall()
+                newids = [(hash_metadata(metadata, algorithm), objectid)
+                          for objectid, metadata in ResultBuilder(rows)]
+                cur.executemany(
+                    '''
+                    UPDATE temp.retagged SET newid = ? WHERE objectid = ?
+                    ''',
+                    newids)
+
+                # Entries that become identical to one that isn't changing,
+                # or to another one that is, are dropped: only one is kept
+                cur.execute(
+                    '''
+                    DELETE FROM metadata WHERE objectid IN (
+                        SELECT r.objectid FROM temp.retagged r
+                        WHERE r.newid != r.objectid AND (
+                            EXISTS (
+                                SELECT 1 FROM metadata m
+                                WHERE m.objectid = r.newid AND NOT EXISTS (
+                                    SELECT 1 FROM temp.retagged r2
+                                    WHERE r2.objectid = m.objectid)
+                            ) OR EXISTS (
+                                SELECT 1 FROM temp.retagged r2
+                                WHERE r2.newid = r.newid AND (
+                                    r2.newid = r2.objectid OR
+                                    r2.objectid < r.objectid))))
+                    ''')
+                cur.execute(
+                    '''
+                    UPDATE metadata SET objectid = (
+                        SELECT newid FROM temp.retagged r
+                        WHERE r.objectid = metadata.objectid)
+                    WHERE objectid IN (
+                        SELECT objectid FROM temp.retagged
+                        WHERE newid != objectid)
+                    ''')
+                cur.execute('SELECT objectid, newid FROM temp.retagged')
+                return dict((r[0], r[1]) for r in cur.fetchall())
+            finally:
+                cur.execute('DELETE FROM temp.retagged')
+        return self._write(update_metadata)
 
     def get(self, objectid):
         """Gets an entry from its objectid, as a dict.
         """
-        cur = self.conn.cursor()
-        rows = cur.execute(
-            '''
-            SELECT * FROM metadata
-            WHERE objectid = :objectid
-            ''',
-            {'objectid': objectid})
-        result = ResultBuilder(rows)
-        try:
-            _objectid, metadata = next(result)
-            return metadata
-        except StopIteration:
-            raise KeyError("No entry with this objectid")
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                '''
+                SELECT * FROM metadata
+                WHERE objectid = :objectid
+                ''',
+                {'objectid': objectid})
+            result = ResultBuilder(rows)
+            try:
+                _objectid, metadata = next(result)
+                return metadata
+            except StopIteration:
+                raise KeyError("No entry with this objectid")
+
+    def all_filehashes(self):
+        """Returns the set of all the file hashes entries refer to.
+
+        This includes the blobs that directories of these entries refer to.
+        """
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                _LIVE_BLOBS + '''
+                SELECT filehash FROM live
+                ''')
+            return set(r[0] for r in rows)
+
+    def release_blob(self, filehash):
+        """Forgets what a deleted blob referred to.
+
+        Returns the (kind, hash) pairs that nothing refers to anymore. Blobs
+        in there are released as well, recursively.
+        """
+        def release_blob(cur):
+            cur.execute(
+                '''
+                DELETE FROM blob_stats WHERE filehash = ?
+                ''',
+                (filehash,))
+            released = []
+            parents = [filehash]
+            while parents:
+                parent = parents.pop()
+                cur.execute(
+                    '''
+                    SELECT kind, child FROM blob_refs WHERE parent = ?
+                    ''',
+                    (parent,))
+                children = set((r[0], r[1]) for r in cur.fetchall())
+                cur.execute(
+                    '''
+                    DELETE FROM blob_refs WHERE parent = ?
+                    ''',
+                    (parent,))
+                for kind, child in sorted(children):
+                    cur.execute(
+                        '''
+                        SELECT 1 FROM blob_refs WHERE kind = ? AND child = ?
+                        LIMIT 1
+                        ''',
+                        (kind, child))
+                    if cur.fetchone() is not None:
+                        continue
+                    if kind == 'blob':
+                        cur.execute(
+                            '''
+                            SELECT 1 FROM metadata
+                            WHERE mkey = 'hash' AND mvalue_str = ?
+                            LIMIT 1
+                            ''',
+                            (child,))
+                        if cur.fetchone() is not None:
+                            continue
+                        parents.append(child)
+                    released.append((kind, child))
+            return released
+        return self._write(release_blob)
+
+    def live_refs(self, kind):
+        """Returns the set of hashes of this kind that live blobs refer to.
+        """
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                _LIVE_BLOBS + '''
+                SELECT DISTINCT child FROM blob_refs
+                WHERE kind = :kind AND parent IN (SELECT filehash FROM live)
+                ''',
+                {'kind': kind})
+            return set(r[0] for r in rows)
+
+    def forget_refs(self, filehashes):
+        """Removes what blobs refer to and their stats, without checking
+        anything.
+        """
+        def forget_refs(cur):
+            cur.executemany(
+                '''
+                DELETE FROM blob_refs WHERE parent = ?
+                ''',
+                [(h,) for h in filehashes])
+            cur.executemany(
+                '''
+                DELETE FROM blob_stats WHERE filehash = ?
+                ''',
+                [(h,) for h in filehashes])
+        self._write(forget_refs)
+
+    def entry_stats(self, conditions=None):
+        """Returns the size and number of files of entries, in one query.
+
+        Returns a list of (objectid, filehash, size, files) for the entries
+        matching the conditions (or all of them), ordered by objectid. size
+        and files are None for blobs added before sizes were recorded; see
+        set_stats().
+        """
+        if conditions:
+            hquery, params = self._objectid_query(conditions)
+            where = 'AND m.objectid IN ({ids})'.format(ids=hquery)
+        else:
+            where, params = '', {}
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                '''
+                SELECT m.objectid, m.mvalue_str, s.size, s.files
+                FROM metadata m
+                LEFT OUTER JOIN blob_stats s ON s.filehash = m.mvalue_str
+                WHERE m.mkey = 'hash' {where}
+                ORDER BY m.objectid
+                '''.format(where=where),
+                params)
+            return [tuple(r) for r in rows]
+
+    def get_stats(self, filehashes):
+        """Returns the recorded (size, files) of blobs, as a dict.
+        """
+        filehashes = list(filehashes)
+        stats = {}
+        with self._reading() as conn:
+            cur = conn.cursor()
+            # Stay under SQLite's limit on the number of parameters
+            for i in range(0, len(filehashes), 500):
+                batch = filehashes[i:i + 500]
+                rows = cur.execute(
+                    '''
+                    SELECT filehash, size, files FROM blob_stats
+                    WHERE filehash IN ({params})
+                    '''.format(params=', '.join('?' * len(batch))),
+                    batch)
+                for r in rows:
+                    stats[r[0]] = r[1], r[2]
+        return stats
+
+    def set_stats(self, records):
+        """Records the stats of blobs, from (filehash, size, files) tuples.
+        """
+        def set_stats(cur):
+            cur.executemany(
+                '''
+                INSERT OR REPLACE INTO blob_stats(filehash, size, files)
+                VALUES(?, ?, ?)
+                ''',
+                records)
+        self._write(set_stats)
 
     def has_filehash(self, filehash):
         """Checks for at least one entry with the given file hash.
 
-        File should be garbage-collected if no entry refers to it.
+        Blobs that a directory refers to count as well. File should be
+        garbage-collected if nothing refers to it.
+        """
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                '''
+                SELECT 1 FROM metadata
+                WHERE mkey = 'hash' AND mvalue_str = :filehash
+                UNION ALL
+                SELECT 1 FROM blob_refs
+                WHERE kind = 'blob' AND child = :filehash
+                ''',
+                {'filehash': filehash})
+            try:
+                next(rows)
+                return True
+            except StopIteration:
+                return False
+
+    def get_config(self):
+        """Reads the options recorded for the store, as a dict.
+        """
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                '''
+                SELECT key, value FROM store_config
+                ''')
+            return dict((r[0], r[1]) for r in rows)
+
+    def set_config(self, options):
+        """Records options for the store, from a dict.
+
+        Options set to None are removed.
+        """
+        def set_config(cur):
+            for key, value in options.items():
+                if value is None:
+                    cur.execute(
+                        '''
+                        DELETE FROM store_config WHERE key = ?
+                        ''',
+                        (key,))
+                else:
+                    cur.execute(
+                        '''
+                        INSERT OR REPLACE INTO store_config(key, value)
+                        VALUES(?, ?)
+                        ''',
+                        (key, value))
+        self._write(set_config)
+
+    def get_verified(self):
+        """Reads the verification ledger.
+
+        Returns a dict mapping file hashes to (size, mtime, inode,
+        verified_at) tuples.
+        """
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                '''
+                SELECT filehash, size, mtime, inode, verified_at
+                FROM verify_ledger
+                ''')
+            return dict((r[0], tuple(r[1:])) for r in rows)
+
+    def set_verified(self, records):
+        """Records blobs as verified in the ledger.
+
+        `records` is a list of (filehash, size, mtime, inode, verified_at)
+        tuples.
+        """
+        def set_verified(cur):
+            cur.executemany(
+                '''
+                INSERT OR REPLACE INTO verify_ledger(filehash, size, mtime,
+                                                     inode, verified_at)
+                VALUES(?, ?, ?, ?, ?)
+                ''',
+                records)
+        self._write(set_verified)
+
+    def forget_verified(self, filehashes):
+        """Removes blobs from the verification ledger.
+        """
+        def forget_verified(cur):
+            cur.executemany(
+                '''
+                DELETE FROM verify_ledger WHERE filehash = ?
+                ''',
+                [(h,) for h in filehashes])
+        self._write(forget_verified)
+
+    # Paths looked up in the hash cache per query, below SQLite's limit of
+    # parameters
+    HASH_CACHE_BATCH = 500
+
+    def get_cached_hashes(self, paths):
+        """Reads the hash cache for the given paths.
+
+        Returns a dict mapping the paths that have a record to (size, mtime,
+        inode, filehash) tuples.
+        """
+        paths = list(paths)
+        cached = {}
+        with self._reading() as conn:
+            cur = conn.cursor()
+            for i in range(0, len(paths), self.HASH_CACHE_BATCH):
+                batch = paths[i:i + self.HASH_CACHE_BATCH]
+                rows = cur.execute(
+                    '''
+                    SELECT path, size, mtime, inode, filehash
+                    FROM hash_cache
+                    WHERE path IN ({paths})
+                    '''.format(paths=', '.join('?' * len(batch))),
+                    batch)
+                cached.update((r[0], tuple(r[1:])) for r in rows)
+        return cached
+
+    def set_cached_hashes(self, records):
+        """Records file hashes in the hash cache.
+
+        `records` is a list of (path, size, mtime, inode, filehash) tuples.
         """
-        cur = self.conn.cursor()
-        rows = cur.execute(
-            '''
-            SELECT * FROM metadata
-            WHERE mkey = 'hash' AND mvalue_str = :filehash
-            ''',
-            {'filehash': filehash})
+        def set_cached_hashes(cur):
+            cur.executemany(
+                '''
+                INSERT OR REPLACE INTO hash_cache(path, size, mtime, inode,
+                                                  filehash)
+                VALUES(?, ?, ?, ?, ?)
+                ''',
+                records)
+        self._write(set_cached_hashes)
+
+    def all_cached_hashes(self):
+        """Lists the records of the hash cache.
+
+        Returns a list of (path, size, mtime, inode) tuples.
+        """
+        with self._reading() as conn:
+            rows = conn.execute(
+                '''
+                SELECT path, size, mtime, inode FROM hash_cache
+                ''')
+            return [tuple(r) for r in rows]
+
+    def forget_cached_hashes(self, paths):
+        """Removes records from the hash cache.
+        """
+        def forget_cached_hashes(cur):
+            cur.executemany(
+                '''
+                DELETE FROM hash_cache WHERE path = ?
+                ''',
+                [(p,) for p in paths])
+        self._write(forget_cached_hashes)
+
+    def clear_hash_cache(self):
+        """Empties the hash cache.
+        """
+        def clear_hash_cache(cur):
+            cur.execute('DELETE FROM hash_cache')
+        self._write(clear_hash_cache)
+
+    def _summary(self, key, func):
+        # Cached results of keys() and values()
+        now = time.time()
+        summaries = self._summaries
         try:
-            next(rows)
-            return True
-        except StopIteration:
-            return False
+            date, result = summaries[key]
+        except KeyError:
+            pass
+        else:
+            if now - date < self.SUMMARY_EXPIRY:
+                return list(result)
+        result = func()
+        summaries[key] = now, result
+        # Copied, so that callers can't change the cached list
+        return list(result)
+
+    def keys(self):
+        """Lists the metadata keys in use, with their types.
+
+        Returns a list of (key, type, count) tuples, sorted by key, where
+        count is the number of entries with that key and type.
+
+        This is cached for a few seconds, or until the next write.
+        """
+        def keys():
+            result = []
+            with self._reading() as conn:
+                cur = conn.cursor()
+                for _datatype, t in _TYPES:
+                    rows = cur.execute(
+                        '''
+                        SELECT mkey, COUNT(*) FROM metadata
+                        WHERE mvalue_{t} IS NOT NULL
+                        GROUP BY mkey
+                        '''.format(t=t))
+                    result.extend((r[0], t, r[1]) for r in rows)
+            result.sort()
+            return result
+        return self._summary(('keys',), keys)
+
+    def values(self, key, limit=None):
+        """Lists the values of a metadata key, most frequent first.
+
+        Returns a list of (value, count) tuples, for at most `limit` values.
+
+        This is cached for a few seconds, or until the next write.
+        """
+        def values():
+            result = []
+            limit_clause = 'LIMIT %d' % limit if limit is not None else ''
+            with self._reading() as conn:
+                cur = conn.cursor()
+                for _datatype, t in _TYPES:
+                    rows = cur.execute(
+                        '''
+                        SELECT mvalue_{t}, COUNT(*) AS nb FROM metadata
+                        WHERE mkey = :key AND mvalue_{t} IS NOT NULL
+                        GROUP BY mvalue_{t}
+                        ORDER BY nb DESC, mvalue_{t}
+                        {limit}
+                        '''.format(t=t, limit=limit_clause),
+                        {'key': key})
+                    result.extend((r[0], r[1]) for r in rows)
+            # For equal counts, ints come first, as SQLite sorts them
+            result.sort(key=lambda r: (-r[1], isinstance(r[0], string_types),
+                                       r[0]))
+            return result[:limit]
+        return self._summary(('values', key, limit), values)
 
     def query_one(self, conditions):
         """Returns at most one entry matching the conditions, as a dict.
@@ -214,36 +1202,82 @@ class MetadataStore(object):
         except StopIteration:
             return None, None
 
-    def query_all(self, conditions, limit=None):
+    def query_all(self, conditions, limit=None, size=None, after=None):
         """Returns an iterable of rows matching the conditions.
 
         Each row is a pair (objectid, metadata), where metadata will have the
         'hash' key plus all the stored metadata.
 
         `conditions` is a dictionary of metadata that need to be included in
-        the actual dict of each entry.
+        the actual dict of each entry. `size` optionally filters on the size
+        of the file or directory, as a number or a dict with 'lt' and/or 'gt'
+        keys; entries whose size wasn't recorded don't match.
+
+        Results are ordered by objectid; if `after` is given, only the
+        objectids after it are returned, to get the next page of results.
+        """
+        hquery, params = self._objectid_query(conditions, limit, size, after)
+
+        # And we put that in the query
+        with self._reading() as conn:
+            rows = conn.cursor().execute(
+                '''
+                SELECT *
+                FROM metadata
+                WHERE objectid IN ({ids})
+                ORDER BY objectid
+                '''.format(ids=hquery),
+                params)
+            if self._pool is not None:
+                # The connection goes back to the pool, so we can't keep a
+                # cursor open on it
+                rows = rows.fetchall()
+
+        return ResultBuilder(rows)
+
+    def _objectid_query(self, conditions, limit=None, size=None,
+                        after=None):
+        """Builds the query selecting the objectids matching the conditions.
+
+        Returns (query, params).
         """
-        # Build the LIMIT part from the limit arg (number or None)
+        # Build the LIMIT part from the limit arg (number or None); these are
+        # the first objectids in order, so that results can be paged through
+        # with `after`
         if limit is not None:
-            limit = 'LIMIT %d' % limit
+            limit = 'ORDER BY i0.objectid LIMIT %d' % limit
         else:
             limit = ''
 
-        cur = self.conn.cursor()
+        if size is not None:
+            sjoin, params = self._size_join(size)
+        else:
+            sjoin, params = '', {}
+
+        if after is not None:
+            after_cond = 'i0.objectid > :after'
+            params['after'] = after
+        else:
+            after_cond = ''
+
         if not conditions:
             hquery = '''
-                    SELECT DISTINCT objectid
-                    FROM metadata
+                    SELECT DISTINCT i0.objectid
+                    FROM metadata i0
+                    {sjoin}
+                    {where}
                     {limit}
-                    '''.format(limit=limit)
-            params = {}
+                    '''.format(sjoin=sjoin,
+                               where='WHERE ' + after_cond if after else '',
+                               limit=limit)
         else:
             conditems = self._make_conditions(conditions)
-            i, key, cond0, params = next(conditems)
+            i, key, cond0, prms = next(conditems)
+            params.update(prms)
             hquery = '''
                     SELECT i0.objectid
                     FROM metadata i0
-                    '''
+                    ''' + sjoin
             params['key0'] = key
             for i, key, cond, prms in conditems:
                 hquery += '''
@@ -253,22 +1287,35 @@ class MetadataStore(object):
                 params['key%d' % i] = key
                 params.update(prms)
             hquery += '''
-                    WHERE i0.mkey = :key0 {cond}
+                    WHERE i0.mkey = :key0 {cond} {after}
                     {limit}
                     '''.format(cond='AND ' + cond0 if cond0 else '',
+                               after='AND ' + after_cond if after else '',
                                limit=limit)
+        return hquery, params
 
-        # And we put that in the query
-        rows = cur.execute(
-            '''
-            SELECT *
-            FROM metadata
-            WHERE objectid IN ({ids})
-            ORDER BY objectid
-            '''.format(ids=hquery),
-            params)
+    def _size_join(self, size):
+        """Builds the joins on blob_stats filtering on size.
 
-        return ResultBuilder(rows)
+        Returns (joins, params).
+        """
+        if isinstance(size, int_types):
+            size = {'equal': size}
+        conds = []
+        params = {}
+        for k, v in size.items():
+            op = {'equal': '=', 'lt': '<', 'gt': '>'}.get(k)
+            if op is None:
+                raise ValueError("Unsupported operation %r" % k)
+            conds.append('AND ss.size {op} :size_{k}'.format(op=op, k=k))
+            params['size_%s' % k] = v
+        join = '''
+                INNER JOIN metadata sh ON sh.objectid = i0.objectid
+                    AND sh.mkey = 'hash'
+                INNER JOIN blob_stats ss ON ss.filehash = sh.mvalue_str
+                    {conds}
+                '''.format(conds=' '.join(conds))
+        return join, params
 
     def _make_conditions(self, conditions):
         for i, (key, value) in enumerate(conditions.items()):
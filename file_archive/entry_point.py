@@ -1,6 +1,5 @@
 from __future__ import division, unicode_literals
 
-import codecs
 import locale
 import sys
 
@@ -14,11 +13,12 @@ def entry_point():
 
     # Encoding for output streams
     if str == bytes:
+        import codecs
         writer = codecs.getwriter(locale.getpreferredencoding())
         sys.stdout = writer(sys.stdout)
         sys.stderr = writer(sys.stderr)
 
-    # Load gettext translation catalog
+    # Select translation catalog (loaded on first use)
     setup_translation()
 
     main(sys.argv[1:])
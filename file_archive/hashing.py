@@ -0,0 +1,127 @@
+"""Hash algorithms for content identity.
+
+Algorithms are looked up by name; 'sha1' (the default, used by stores that
+don't record one), 'sha256' and 'blake2b' come from hashlib ('blake2b' needs
+Python 3.6+), and 'blake3' needs the blake3 package. More can be added with
+register_algorithm().
+"""
+
+from __future__ import division, unicode_literals
+
+import hashlib
+
+
+__all__ = ['HashAlgorithm', 'get_algorithm', 'register_algorithm',
+           'available_algorithms', 'DEFAULT_ALGORITHM']
+
+
+DEFAULT_ALGORITHM = 'sha1'
+
+
+class Hash(object):
+    """Wraps a hash object, silently accepting unicode so long as it's ASCII.
+    """
+    def __init__(self, hashobj):
+        self._hash = hashobj
+
+    def update(self, arg):
+        if not isinstance(arg, bytes):
+            arg = arg.encode('ascii')
+        self._hash.update(arg)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class HashAlgorithm(object):
+    """A hash algorithm, as a function returning hashlib-like objects.
+
+    `new(data)` should return an object with update() and hexdigest()
+    methods, that already hashed `data`.
+    """
+    def __init__(self, name, new):
+        self.name = name
+        self.new = new
+        self.hex_length = len(new(b'').hexdigest())
+
+    def hash(self, data=b''):
+        """Returns a new hash object, that also accepts ASCII unicode.
+        """
+        h = Hash(self.new(b''))
+        if data:
+            h.update(data)
+        return h
+
+
+def _sha1():
+    return HashAlgorithm('sha1', hashlib.sha1)
+
+
+def _sha256():
+    return HashAlgorithm('sha256', hashlib.sha256)
+
+
+def _blake2b():
+    blake2b = hashlib.blake2b  # AttributeError on Python < 3.6
+
+    def new(data=b''):
+        return blake2b(data, digest_size=32)
+
+    return HashAlgorithm('blake2b', new)
+
+
+def _blake3():
+    from blake3 import blake3
+
+    return HashAlgorithm('blake3', blake3)
+
+
+# Functions building the algorithms, so that their modules are imported on
+# first use only
+_factories = {'sha1': _sha1, 'sha256': _sha256, 'blake2b': _blake2b,
+              'blake3': _blake3}
+_algorithms = {}
+
+
+def register_algorithm(name, new):
+    """Adds a hash algorithm.
+
+    new(data) should return a hashlib-like object with update() and
+    hexdigest() methods.
+    """
+    _algorithms[name] = HashAlgorithm(name, new)
+
+
+def get_algorithm(name=None):
+    """Gets a hash algorithm by name, or the default one if None.
+
+    HashAlgorithm objects are returned as-is. Raises KeyError if it doesn't
+    exist and ImportError if it is not available.
+    """
+    if isinstance(name, HashAlgorithm):
+        return name
+    if name is None:
+        name = DEFAULT_ALGORITHM
+    try:
+        return _algorithms[name]
+    except KeyError:
+        pass
+    try:
+        algorithm = _factories[name]()
+    except AttributeError:
+        raise ImportError("%s is not available" % name)
+    _algorithms[name] = algorithm
+    return algorithm
+
+
+def available_algorithms():
+    """Returns the names of the hash algorithms that can be used.
+    """
+    names = []
+    for name in sorted(set(_factories) | set(_algorithms)):
+        try:
+            get_algorithm(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
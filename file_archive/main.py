@@ -1,16 +1,15 @@
 from __future__ import division, unicode_literals
 
-import json
 import locale
 import os
 import sys
-import tempfile
 import warnings
 
-from file_archive import FileStore, copy_file, BufferedReader
+from file_archive import FileStore, copy_file, CHUNKSIZE
+from file_archive.blobs import blob_kind
 from file_archive.compat import int_types, unicode_type
 from file_archive.errors import UsageWarning
-from file_archive.trans import _
+from file_archive.trans import _, _n
 
 
 def parse_query_metadata(args):
@@ -106,8 +105,18 @@ def parse_new_metadata(args):
 def cmd_add(store, args):
     """Add command.
 
-    add <filename> [key1=value1] [...]
+    add [-c] <filename> [key1=value1] [...]
     """
+    while args and args[0][0] == '-':
+        if args[0] == '-c':
+            store.hash_cache = True
+        elif args[0] == '--':
+            del args[0]
+            break
+        else:
+            sys.stderr.write(_("Unknown option: {opt}\n", opt=args[0]))
+            sys.exit(1)
+        del args[0]
     if not args:
         sys.stderr.write(_("Missing filename\n"))
         sys.exit(1)
@@ -128,6 +137,8 @@ def cmd_write(store, args):
 
     write [key1=value1] [...]
     """
+    import tempfile
+
     metadata = parse_new_metadata(args)
     fd, filename = tempfile.mkstemp()
     os.close(fd)
@@ -142,15 +153,19 @@ def cmd_write(store, args):
 def cmd_query(store, args):
     """Query command.
 
-    query [-d] [-t] [key1=value1] [...]
+    query [-d] [-t] [-s <size>] [key1=value1] [...]
     """
     pydict = False
     types = False
+    size = None
     while args and args[0][0] == '-':
         if args[0] == '-d':
             pydict = True
         elif args[0] == '-t':
             types = True
+        elif args[0] == '-s' and len(args) >= 2:
+            size = parse_size(args[1], size)
+            del args[0]
         elif args[0] == '--':
             del args[0]
             break
@@ -162,7 +177,7 @@ def cmd_query(store, args):
     if h is not None:
         entries = [store.get(h)]
     else:
-        entries = store.query(metadata)
+        entries = store.query(metadata, size=size)
 
     if not pydict:
         for entry in sorted(entries, key=lambda e: e.objectid):
@@ -175,6 +190,8 @@ def cmd_query(store, args):
                         v = 'str:%s' % v
                 sys.stdout.write("\t%s\t%s\n" % (k, v))
     else:
+        import json
+
         sys.stdout.write('{')
         for entry_nb, entry in enumerate(sorted(entries,
                                                 key=lambda e: e.objectid)):
@@ -204,16 +221,20 @@ def cmd_query(store, args):
 def cmd_print(store, args):
     """Print command.
 
-    print [-m] [-t] <filehash> [...]
-    print [-m] [-t] [key1=value1] [...]
+    print [-m] [-t] [-r <start>:<end>] <filehash> [...]
+    print [-m] [-t] [-r <start>:<end>] [key1=value1] [...]
     """
     meta = False
     types = False
+    start, end = 0, None
     while args and args[0][0] == '-':
         if args[0] == '-m':
             meta = True
         elif args[0] == '-t':
             types = True
+        elif args[0] in ('-r', '--range') and len(args) >= 2:
+            start, end = parse_range(args[1])
+            del args[0]
         elif args[0] == '--':
             del args[0]
             break
@@ -252,35 +273,196 @@ def cmd_print(store, args):
                     v = 'str:%s' % v
             sys.stdout.write("%s\t%s\n" % (k, v))
     else:
-        if os.path.isdir(entry.filename):
+        if entry.isdir():
             sys.stderr.write(_("Error: match found but is a directory\n"))
             sys.exit(2)
-        fp = entry.open()
-        try:
-            for chunk in BufferedReader(fp):
-                sys.stdout.write(chunk)
-        finally:
-            fp.close()
+        if not _send_blob(entry, start, end):
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            fp = entry.open()
+            try:
+                fp.seek(start)
+                remaining = end - start if end is not None else None
+                while remaining is None or remaining > 0:
+                    chunk = fp.read(CHUNKSIZE if remaining is None
+                                    else min(CHUNKSIZE, remaining))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+            finally:
+                fp.close()
+
+
+def parse_size(value, size=None):
+    """Parses a size condition given on the command-line.
+
+    This is a number of bytes, optionally prefixed with '<' or '>'; the
+    condition is added to the `size` dict if one is given.
+    """
+    if size is None:
+        size = {}
+    op = {'<': 'lt', '>': 'gt'}.get(value[:1])
+    try:
+        size[op or 'equal'] = int(value[1:] if op else value)
+    except ValueError:
+        sys.stderr.write(_("Invalid size: {size}\n", size=value))
+        sys.exit(1)
+    return size
+
+
+def cmd_du(store, args):
+    """Disk usage command.
+
+    du [-s] [key1=value1] [...]
+    """
+    summary = False
+    while args and args[0][0] == '-':
+        if args[0] == '-s':
+            summary = True
+        elif args[0] == '--':
+            del args[0]
+            break
+        else:
+            sys.stderr.write(_("Unknown option: {opt}\n", opt=args[0]))
+            sys.exit(1)
+        del args[0]
+    h, metadata = parse_query_metadata(args)
+    if h is not None:
+        sys.stderr.write(_("du takes conditions, not an objectid\n"))
+        sys.exit(1)
+
+    # Files and directories stored once count once in the total
+    total = {}
+    for objectid, filehash, size, files in store.disk_usage(metadata):
+        if not summary:
+            sys.stdout.write("%d\t%d\t%s\n" % (size, files, objectid))
+        total[filehash] = size, files
+    size = sum(s for s, _f in total.values())
+    files = sum(f for _s, f in total.values())
+    sys.stdout.write("%d\t%d\t%s\n" % (size, files, _("total")))
+
+
+def cmd_keys(store, args):
+    """Keys command.
+
+    keys
+    """
+    if args:
+        sys.stderr.write(_("keys command accepts no argument\n"))
+        sys.exit(1)
+    for key, t, count in store.metadata_keys():
+        sys.stdout.write("%s\t%s\t%d\n" % (key, t, count))
+
+
+def cmd_values(store, args):
+    """Values command.
+
+    values [-t] [-n <count>] <key>
+    """
+    types = False
+    limit = 20
+    while args and args[0][0] == '-':
+        if args[0] == '-t':
+            types = True
+        elif args[0] == '-n' and len(args) >= 2:
+            try:
+                limit = int(args[1])
+            except ValueError:
+                limit = 0
+            if limit <= 0:
+                sys.stderr.write(_("Invalid count: {count}\n",
+                                   count=args[1]))
+                sys.exit(1)
+            del args[0]
+        elif args[0] == '--':
+            del args[0]
+            break
+        else:
+            sys.stderr.write(_("Unknown option: {opt}\n", opt=args[0]))
+            sys.exit(1)
+        del args[0]
+    if len(args) != 1:
+        sys.stderr.write(_("values command takes a single key\n"))
+        sys.exit(1)
+
+    for value, count in store.metadata_values(args[0], limit):
+        if types:
+            if isinstance(value, int_types):
+                value = 'int:%d' % value
+            else:  # isinstance(value, string_types):
+                value = 'str:%s' % value
+        sys.stdout.write("%d\t%s\n" % (count, value))
+
+
+def parse_range(value):
+    """Parses a byte range given on the command-line, as 'start:end'.
+
+    Either can be omitted. Returns (start, end), where end might be None.
+    """
+    try:
+        start, end = value.split(':')
+        start = int(start) if start else 0
+        end = int(end) if end else None
+    except ValueError:
+        start = -1
+    if start < 0 or (end is not None and end < start):
+        sys.stderr.write(_("Invalid range: {range}\n", range=value))
+        sys.exit(1)
+    return start, end
+
+
+def _send_blob(entry, start=0, end=None):
+    """Copies a file to stdout with sendfile(), if possible.
+
+    This only works for files stored as-is, and if stdout is a real file
+    descriptor. Returns False if nothing was sent.
+    """
+    if not hasattr(os, 'sendfile') or blob_kind(entry.filename) is not None:
+        return False
+    try:
+        out = sys.stdout.fileno()
+    except (AttributeError, ValueError, IOError):
+        return False  # Not a real file
+    sys.stdout.flush()
+    with open(entry.filename, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if end is not None:
+            size = min(size, end)
+        offset = start
+        while offset < size:
+            try:
+                sent = os.sendfile(out, fp.fileno(), offset, size - offset)
+            except OSError:
+                if offset == start:
+                    return False  # Not supported for this file descriptor
+                raise
+            if sent == 0:
+                break
+            offset += sent
+    return True
 
 
 def cmd_remove(store, args):
     """Remove command.
 
-    remove [-f] <filehash>
-    remove [-f] <key1=value1> [...]
+    remove [-f] [-d] <filehash>
+    remove [-f] [-d] <key1=value1> [...]
     """
-    if args and args[0] == '-f':
+    force = False
+    while args and args[0] in ('-f', '-d'):
+        if args[0] == '-f':
+            force = True
+        else:
+            # Move blobs to the trash, leaving the deleting to gc
+            store.deferred_delete = True
         del args[0]
-        force = True
-    else:
-        force = False
     h, metadata = parse_query_metadata(args)
     if h is not None:
         store.remove(h)
     else:
-        entries = store.query(metadata)
         if not args and not force:
-            nb = sum(1 for e in entries)
+            nb = sum(1 for e in store.query(metadata))
             if nb:
                 sys.stderr.write(_(
                     "Error: not removing files unconditionally unless -f "
@@ -288,19 +470,206 @@ def cmd_remove(store, args):
                     "(command would have removed {nb} files)\n",
                     nb=nb))
                 sys.exit(1)
-        for e in entries:
-            store.remove(e)
+        store.remove_many(metadata)
+
+
+def cmd_tag(store, args):
+    """Tag command.
+
+    tag [-f] [-s <key=value>] [-u <key>] [...] <filehash>
+    tag [-f] [-s <key=value>] [-u <key>] [...] <key1=value1> [...]
+    """
+    force = False
+    new = []
+    unset = []
+    while args and args[0][0] == '-':
+        if args[0] == '-f':
+            force = True
+        elif args[0] == '-s' and len(args) >= 2:
+            new.append(args[1])
+            del args[0]
+        elif args[0] == '-u' and len(args) >= 2:
+            unset.append(args[1])
+            del args[0]
+        elif args[0] == '--':
+            del args[0]
+            break
+        else:
+            sys.stderr.write(_("Unknown option: {opt}\n", opt=args[0]))
+            sys.exit(1)
+        del args[0]
+    new = parse_new_metadata(new)
+    if not new and not unset:
+        sys.stderr.write(_("Nothing to change, use -s or -u\n"))
+        sys.exit(1)
+    h, metadata = parse_query_metadata(args)
+    if h is None and not args and not force:
+        nb = sum(1 for e in store.query(metadata))
+        if nb:
+            sys.stderr.write(_(
+                "Error: not changing files unconditionally unless -f is "
+                "given\n"
+                "(command would have changed {nb} files)\n",
+                nb=nb))
+            sys.exit(1)
+    try:
+        if h is not None:
+            changed = store.update_metadata(objectids=[h], set=new,
+                                            unset=unset)
+            if not changed:
+                sys.stderr.write(_("Objectid not found\n"))
+                sys.exit(2)
+        else:
+            changed = store.update_metadata(metadata, set=new, unset=unset)
+    except ValueError as e:
+        sys.stderr.write("%s\n" % e.args[0])
+        sys.exit(1)
+    for old, objectid in sorted(changed.items()):
+        sys.stdout.write("%s\t%s\n" % (old, objectid))
 
 
 def cmd_verify(store, args):
     """Verify command.
 
-    This command accepts no argument.
+    verify [-q] [-a <days>] [-j <workers>] [-c <checkpoint>] [-r <bytes/s>]
+           [-t <seconds>]
     """
-    if args:
-        sys.stderr.write(_("verify command accepts no argument\n"))
+    options = {'-j': 'workers', '-c': 'checkpoint', '-r': 'rate',
+               '-t': 'time_limit', '-a': 'max_age'}
+    kwargs = {}
+    while args:
+        if args[0] == '-q':
+            kwargs['quick'] = True
+            del args[0]
+            continue
+        if args[0] not in options or len(args) < 2:
+            sys.stderr.write(_("Unknown option: {opt}\n", opt=args[0]))
+            sys.exit(1)
+        opt, value = options[args[0]], args[1]
+        if opt != 'checkpoint':
+            try:
+                value = int(value)
+            except ValueError:
+                sys.stderr.write(_("Invalid number: {nb}\n", nb=value))
+                sys.exit(1)
+        if opt == 'max_age':
+            value *= 86400
+        kwargs[opt] = value
+        del args[:2]
+
+    if sys.stderr.isatty():
+        def progress(done, total, nbytes):
+            sys.stderr.write(_("\rChecked {done}/{total} blobs ({mb} MB)",
+                               done=done, total=total,
+                               mb=nbytes // 1000000))
+            sys.stderr.flush()
+        kwargs['progress'] = progress
+
+    report = store.verify(**kwargs)
+    if 'progress' in kwargs and report.checked:
+        sys.stderr.write('\n')
+
+    for filehash in report.corrupt:
+        sys.stdout.write("corrupt\t%s\n" % filehash)
+    for objectid, filehash in report.missing:
+        sys.stdout.write("missing\t%s\t%s\n" % (objectid or '-', filehash))
+    for filehash in report.orphaned:
+        sys.stdout.write("orphaned\t%s\n" % filehash)
+    for objectid in report.bad_objectids:
+        sys.stdout.write("bad-objectid\t%s\n" % objectid)
+    if not report.complete:
+        sys.stderr.write(_("Verification stopped before the end; run it "
+                           "again with the same checkpoint to resume\n"))
+    if not report.ok:
+        sys.exit(4)
+
+
+def cmd_gc(store, args):
+    """Garbage collection command.
+
+    gc [-n] [-m <quarantine>] [-j <workers>] [-g <seconds>]
+    """
+    options = {'-m': 'quarantine', '-j': 'workers', '-g': 'grace'}
+    kwargs = {}
+    while args:
+        if args[0] == '-n':
+            kwargs['dry_run'] = True
+            del args[0]
+            continue
+        if args[0] not in options or len(args) < 2:
+            sys.stderr.write(_("Unknown option: {opt}\n", opt=args[0]))
+            sys.exit(1)
+        opt, value = options[args[0]], args[1]
+        if opt != 'quarantine':
+            try:
+                value = int(value)
+            except ValueError:
+                sys.stderr.write(_("Invalid number: {nb}\n", nb=value))
+                sys.exit(1)
+        kwargs[opt] = value
+        del args[:2]
+
+    report = store.gc(**kwargs)
+    for name, size in report.removed:
+        sys.stdout.write("%s\t%d\n" % (name, size))
+    if report.dry_run:
+        sys.stderr.write(_n("{nb} blob would be removed ({mb} MB)\n",
+                            "{nb} blobs would be removed ({mb} MB)\n",
+                            len(report.removed),
+                            nb=len(report.removed),
+                            mb=report.bytes // 1000000))
+    else:
+        sys.stderr.write(_n("{nb} blob removed ({mb} MB)\n",
+                            "{nb} blobs removed ({mb} MB)\n",
+                            len(report.removed),
+                            nb=len(report.removed),
+                            mb=report.bytes // 1000000))
+    if report.trash:
+        sys.stderr.write(_n("{nb} blob reclaimed from the trash ({mb} MB)\n",
+                            "{nb} blobs reclaimed from the trash ({mb} MB)\n",
+                            report.trash,
+                            nb=report.trash,
+                            mb=report.trash_bytes // 1000000))
+    if report.hash_cache:
+        sys.stderr.write(_n("{nb} stale hash cache record removed\n",
+                            "{nb} stale hash cache records removed\n",
+                            report.hash_cache,
+                            nb=report.hash_cache))
+
+
+def cmd_convert(store, args):
+    """Convert command.
+
+    convert [-H <algorithm>] <destination>
+    """
+    from file_archive.errors import CreationError
+
+    hash_algorithm = None
+    while args and args[0][0] == '-':
+        if args[0] == '-H' and len(args) >= 2:
+            hash_algorithm = args[1]
+            del args[0]
+        elif args[0] == '--':
+            del args[0]
+            break
+        else:
+            sys.stderr.write(_("Unknown option: {opt}\n", opt=args[0]))
+            sys.exit(1)
+        del args[0]
+    if len(args) != 1:
+        sys.stderr.write(_("convert command takes a single destination\n"))
+        sys.exit(1)
+
+    try:
+        changed = store.convert(args[0], hash_algorithm=hash_algorithm)
+    except ValueError as e:
+        sys.stderr.write("%s\n" % e.args[0])
         sys.exit(1)
-    store.verify()
+    except CreationError as e:
+        sys.stderr.write(_("Can't create store: {err}\n", err=e.args[0]))
+        sys.exit(3)
+    for old, objectid in sorted(changed.items()):
+        sys.stdout.write("%s\t%s\n" % (old, objectid))
 
 
 def cmd_view(store, args):
@@ -317,37 +686,78 @@ commands = {
     'query': cmd_query,
     'print': cmd_print,
     'remove': cmd_remove,
+    'tag': cmd_tag,
     'verify': cmd_verify,
+    'gc': cmd_gc,
+    'du': cmd_du,
+    'keys': cmd_keys,
+    'values': cmd_values,
+    'convert': cmd_convert,
     'view': cmd_view,
 }
 
 
-def main(args):
-    warnings.filterwarnings('always', category=UsageWarning)
-
-    usage = _(
-        "usage: {bin} <store> create\n"
-        "   or: {bin} <store> add <filename> [key1=value1] [...]\n"
+def usage():
+    return _(
+        "usage: {bin} <store> create [-z <codec>] [-c] [-d] "
+        "[-H <algorithm>]\n"
+        "   or: {bin} <store> add [-c] <filename> [key1=value1] [...]\n"
         "   or: {bin} <store> write [key1=value1] [...]\n"
-        "   or: {bin} <store> query [-d] [-t] [key1=value1] [...]\n"
-        "   or: {bin} <store> print [-m] [-t] <filehash> [...]\n"
-        "   or: {bin} <store> print [-m] [-t] [key1=value1] [...]\n"
-        "   or: {bin} <store> remove [-f] <filehash>\n"
-        "   or: {bin} <store> remove [-f] <key1=value1> [...]\n"
-        "   or: {bin} <store> verify\n"
+        "   or: {bin} <store> query [-d] [-t] [-s <size>] [key1=value1] "
+        "[...]\n"
+        "   or: {bin} <store> print [-m] [-t] [-r <start>:<end>] <filehash> "
+        "[...]\n"
+        "   or: {bin} <store> print [-m] [-t] [-r <start>:<end>] "
+        "[key1=value1] [...]\n"
+        "   or: {bin} <store> remove [-f] [-d] <filehash>\n"
+        "   or: {bin} <store> remove [-f] [-d] <key1=value1> [...]\n"
+        "   or: {bin} <store> tag [-f] [-s <key=value>] [-u <key>] [...] "
+        "<filehash>\n"
+        "   or: {bin} <store> tag [-f] [-s <key=value>] [-u <key>] [...] "
+        "<key1=value1> [...]\n"
+        "   or: {bin} <store> verify [-q] [-a <days>] [-j <workers>] "
+        "[-c <checkpoint>] [-r <bytes/s>] [-t <seconds>]\n"
+        "   or: {bin} <store> gc [-n] [-m <quarantine>] [-j <workers>] "
+        "[-g <seconds>]\n"
+        "   or: {bin} <store> du [-s] [key1=value1] [...]\n"
+        "   or: {bin} <store> keys\n"
+        "   or: {bin} <store> values [-t] [-n <count>] <key>\n"
+        "   or: {bin} <store> convert [-H <algorithm>] <destination>\n"
         "   or: {bin} <store> view\n",
         bin='file_archive')
 
+
+def main(args):
+    warnings.filterwarnings('always', category=UsageWarning)
+
     if len(args) < 2:
-        sys.stderr.write(usage)
+        sys.stderr.write(usage())
         sys.exit(1)
 
     store = args[0]
     command = args[1]
 
     if command == 'create':
+        kwargs = {}
+        options = args[2:]
+        while options:
+            if options[0] == '-c':
+                kwargs['chunking'] = True
+                del options[0]
+            elif options[0] == '-d':
+                kwargs['directory_manifests'] = True
+                del options[0]
+            elif options[0] == '-z' and len(options) >= 2:
+                kwargs['compression'] = options[1]
+                del options[:2]
+            elif options[0] == '-H' and len(options) >= 2:
+                kwargs['hash_algorithm'] = options[1]
+                del options[:2]
+            else:
+                sys.stderr.write(usage())
+                sys.exit(1)
         try:
-            FileStore.create_store(store)
+            FileStore.create_store(store, **kwargs)
         except Exception as e:
             sys.stderr.write(_("Can't create store: {err}\n", err=e.args[0]))
             sys.exit(3)
@@ -363,7 +773,7 @@ def main(args):
         try:
             func = commands[command]
         except KeyError:
-            sys.stderr.write(usage)
+            sys.stderr.write(usage())
             sys.exit(1)
         try:
             func(store, args[2:])
@@ -1,10 +1,17 @@
 from __future__ import division, unicode_literals
 
-from tdparser import Lexer, Parser, Token, ParserError
+from collections import OrderedDict
+import re
+import threading
+
+from tdparser import Lexer, LexerError, Parser, Token, ParserError
 from tdparser.topdown import EndToken
 
+from file_archive.compat import int_types, string_types
+
 
-__all__ = ['parse_expression', 'parse_expressions']
+__all__ = ['parse_expression', 'parse_expressions', 'match_conditions',
+           'narrows_conditions']
 
 
 def escape_string(text):
@@ -87,7 +94,39 @@ class ExistType(Token):
         return left.text, {'type': right.text}
 
 
-lexer.register_tokens(Key, Number, String, Operator, ExistType)
+_TOKENS = [Key, Number, String, Operator, ExistType]
+
+# Kept for compatibility, _lex() is used instead
+lexer.register_tokens(*_TOKENS)
+
+
+# A single regular expression for all the tokens (and whitespace), each in its
+# own group. Tokens start with different characters, so the first one that
+# matches is also the longest, like with tdparser's Lexer
+_TOKEN_RE = re.compile('|'.join(['(%s)' % t.regexp for t in _TOKENS] +
+                                ['([ \t]+)']))
+_TOKEN_CLASSES = _TOKENS + [None]
+
+
+def _lex(expression):
+    """Splits an expression into tokens, ending with an EndToken.
+
+    This gives the same tokens as lexer.lex(), in a single pass.
+    """
+    pos = 0
+    end = len(expression)
+    match = _TOKEN_RE.match
+    while pos < end:
+        m = match(expression, pos)
+        if m is None:
+            raise LexerError("Invalid character %s in %s" % (
+                             expression[pos], expression[pos:]),
+                             position=pos)
+        token_class = _TOKEN_CLASSES[m.lastindex - 1]
+        if token_class is not None:
+            yield token_class(m.group())
+        pos = m.end()
+    yield EndToken()
 
 
 def _update_conditions(conditions, expr):
@@ -106,9 +145,29 @@ def _update_conditions(conditions, expr):
         conditions[key] = cond
 
 
-def parse_expression(expression):
-    tokens = lexer.lex(expression)
-    parser = Parser(tokens)
+# Most recently parsed expressions, and the conditions they gave
+CACHE_SIZE = 256
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cached(key, parse):
+    with _cache_lock:
+        conditions = _cache.pop(key, None)
+        if conditions is not None:
+            _cache[key] = conditions
+    if conditions is None:
+        conditions = parse()
+        with _cache_lock:
+            _cache[key] = conditions
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    # Callers own the result and might change it
+    return dict((k, dict(v)) for k, v in conditions.items())
+
+
+def _parse_expression(expression):
+    parser = Parser(_lex(expression))
     conditions = {}
     while not isinstance(parser.current_token, EndToken):
         expr = parser.expression()
@@ -118,11 +177,90 @@ def parse_expression(expression):
     return conditions
 
 
-def parse_expressions(expression_list):
+def parse_expression(expression):
+    """Parses a query, made of conditions separated by spaces.
+
+    Returns the conditions as a dict, for FileStore.query(). Results are
+    cached, so parsing the same expression again is cheap.
+    """
+    return _cached(('expression', expression),
+                   lambda: _parse_expression(expression))
+
+
+def _parse_expressions(expression_list):
     conditions = {}
     for expression in expression_list:
-        expr = lexer.parse(expression)
+        expr = Parser(_lex(expression)).parse()
         if isinstance(expr, Token):
             raise ParserError("Found unexpected token %s in query" % expr)
         _update_conditions(conditions, expr)
     return conditions
+
+
+def parse_expressions(expression_list):
+    """Parses a list of conditions, for example from the command-line.
+
+    Returns the conditions as a dict, for FileStore.query(). Results are
+    cached, like with parse_expression().
+    """
+    expression_list = tuple(expression_list)
+    return _cached(('expressions', expression_list),
+                   lambda: _parse_expressions(expression_list))
+
+
+def _match_condition(cond, value):
+    t = cond.get('type')
+    if t == 'int' and not isinstance(value, int_types):
+        return False
+    elif t == 'str' and not isinstance(value, string_types):
+        return False
+    for k, v in cond.items():
+        if k == 'equal' and value != v:
+            return False
+        elif k == 'lt' and not value < v:
+            return False
+        elif k == 'gt' and not value > v:
+            return False
+    return True
+
+
+def match_conditions(conditions, metadata):
+    """Checks whether metadata matches parsed conditions, in memory.
+
+    This gives the same result as querying the store with these conditions.
+    """
+    for key, cond in conditions.items():
+        if key not in metadata or not _match_condition(cond, metadata[key]):
+            return False
+    return True
+
+
+def narrows_conditions(conditions, previous):
+    """Checks whether parsed conditions only match entries `previous` matches.
+
+    This is the case if they have the same conditions, possibly tightened,
+    and maybe more; the results of `previous` can then be filtered with
+    match_conditions() instead of querying the store again.
+
+    Conditions the store rejects, such as comparisons on strings, never
+    narrow, so that they get sent to the store and fail there.
+    """
+    for cond in conditions.values():
+        if cond.get('type') == 'str' and ('lt' in cond or 'gt' in cond):
+            return False
+    for key, prev in previous.items():
+        cond = conditions.get(key)
+        if cond is None or cond.get('type') != prev.get('type'):
+            return False
+        for k, v in prev.items():
+            if k == 'type':
+                continue
+            elif k not in cond:
+                return False
+            elif k == 'equal' and cond[k] != v:
+                return False
+            elif k == 'lt' and cond[k] > v:
+                return False
+            elif k == 'gt' and cond[k] < v:
+                return False
+    return True
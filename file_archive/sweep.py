@@ -0,0 +1,237 @@
+"""Garbage collection of the objects directory.
+
+This is used by FileStore.gc().
+"""
+
+from __future__ import division, unicode_literals
+
+import os
+import threading
+import time
+
+from file_archive.compat import scandir
+from file_archive.verify import _mtime_ns, blob_fingerprint
+
+
+__all__ = ['GCReport']
+
+
+class GCReport(object):
+    """Results of FileStore.gc().
+
+    removed: (name, size) pairs for the unreferenced blobs that were deleted
+        or quarantined (or would have been, in a dry run); name is the hash,
+        'chunk-' followed by the hash for chunks, or the name of a temporary
+        file left over by a crash
+    bytes: total size of these blobs
+    trash: number of blobs reclaimed from the trash (see deferred_delete)
+    trash_bytes: total size of these
+    hash_cache: number of hash cache records removed, as their file is gone
+        or changed
+    dry_run: True if nothing was actually removed
+    """
+    def __init__(self, dry_run):
+        self.removed = []
+        self.bytes = 0
+        self.trash = 0
+        self.trash_bytes = 0
+        self.hash_cache = 0
+        self.dry_run = dry_run
+
+
+def _delete(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        import shutil
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def empty_trash(trash, dry_run=False, stop=None):
+    """Deletes the blobs in the trash directory.
+
+    `stop` is called between blobs, and returning True interrupts the process.
+
+    Returns (count, size) for the blobs deleted.
+    """
+    count = size = 0
+    if not os.path.isdir(trash):
+        return count, size
+    for entry in scandir(trash):
+        if stop is not None and stop():
+            break
+        try:
+            blob_size = blob_fingerprint(entry.path)[0]
+            if not dry_run:
+                _delete(entry.path)
+        except OSError:
+            continue  # Reclaimed concurrently
+        count += 1
+        size += blob_size
+    return count, size
+
+
+def prune_hash_cache(metadata, dry_run=False):
+    """Removes the hash cache records that can't match their file anymore.
+
+    Records of files that are gone or whose size, mtime or inode changed are
+    removed. Those of unchanged files are kept, even if no entry refers to
+    their hash anymore, since they would be used if the file was added again.
+
+    Returns the number of records removed.
+    """
+    stale = []
+    for path, size, mtime, inode in metadata.all_cached_hashes():
+        try:
+            st = os.stat(path)
+        except OSError:
+            stale.append(path)
+            continue
+        if (st.st_size, _mtime_ns(st), st.st_ino) != (size, mtime, inode):
+            stale.append(path)
+    if stale and not dry_run:
+        metadata.forget_cached_hashes(stale)
+    return len(stale)
+
+
+class Reaper(threading.Thread):
+    """Background thread emptying the trash directory whenever woken up.
+    """
+    def __init__(self, trash):
+        threading.Thread.__init__(self, name='file_archive reaper')
+        self.daemon = True
+        self.trash = trash
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def wake(self):
+        self._wakeup.set()
+
+    def close(self):
+        """Stops the thread, after the blob being deleted if any.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        self.join()
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopping:
+                return
+            empty_trash(self.trash, stop=lambda: self._stopping)
+
+
+def _is_live(name, live, live_chunks):
+    if name.startswith('chunk-'):
+        return name[6:] in live_chunks
+    return name in live
+
+
+class Collector(object):
+    """Finds and removes unreferenced blobs, on a pool of threads.
+    """
+    def __init__(self, store, dry_run=False, quarantine=None, workers=4,
+                 grace=3600):
+        self.store = store
+        self.dry_run = dry_run
+        self.quarantine = quarantine
+        self.workers = workers
+        self.grace = grace
+
+    def measure(self, item):
+        name, path = item
+        try:
+            return name, blob_fingerprint(path)[0]
+        except OSError:
+            return name, 0
+
+    def remove(self, item):
+        """Removes a blob; runs on the worker threads.
+        """
+        name, size = self.measure(item)
+        path = item[1]
+        if self.quarantine is not None:
+            destination = os.path.join(self.quarantine, name)
+            try:
+                os.rename(path, destination)
+            except OSError:
+                # Might be on a different device
+                import shutil
+                shutil.move(path, destination)
+        else:
+            _delete(path)
+        return name, size
+
+    def _iter_objects(self):
+        """Yields (name, DirEntry) for the blobs and chunks in the store.
+        """
+        for item in self.store._iter_blobs(temporary=True):
+            yield item
+        chunks = os.path.join(self.store.store, 'chunks')
+        if not os.path.isdir(chunks):
+            return
+        for prefix in scandir(chunks):
+            if len(prefix.name) != 2 or not prefix.is_dir():
+                continue
+            for chunk in scandir(prefix.path):
+                yield 'chunk-' + prefix.name + chunk.name, chunk
+
+    def run(self):
+        from multiprocessing.pool import ThreadPool
+
+        report = GCReport(self.dry_run)
+        now = time.time()
+
+        # Find the blobs no entry refers to, and the chunks no such blob
+        # refers to. Recent ones are skipped, as they might have just been
+        # stored by someone who is about to add an entry
+        live = self.store.metadata.all_filehashes()
+        live_chunks = self.store.metadata.live_refs('chunk')
+        candidates = []
+        for name, entry in self._iter_objects():
+            if _is_live(name, live, live_chunks):
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # Removed concurrently
+            if now - st.st_mtime >= self.grace:
+                candidates.append((name, entry.path))
+        report.trash, report.trash_bytes = empty_trash(self.store._trash,
+                                                       dry_run=self.dry_run)
+        report.hash_cache = prune_hash_cache(self.store.metadata,
+                                             dry_run=self.dry_run)
+        if not candidates:
+            return report
+
+        if self.quarantine is not None and not self.dry_run and \
+                not os.path.isdir(self.quarantine):
+            os.makedirs(self.quarantine)
+
+        pool = ThreadPool(self.workers)
+        try:
+            if self.dry_run:
+                report.removed = pool.map(self.measure, candidates)
+            else:
+                with self.store._gc_lock.exclusive():
+                    # Entries might have been added in the meantime
+                    live = self.store.metadata.all_filehashes()
+                    live_chunks = self.store.metadata.live_refs('chunk')
+                    candidates = [c for c in candidates
+                                  if not _is_live(c[0], live, live_chunks)]
+                    report.removed = list(pool.imap_unordered(self.remove,
+                                                              candidates))
+                    self.store.metadata.forget_refs(
+                        [name for name, _size in report.removed])
+        finally:
+            pool.close()
+            pool.join()
+
+        report.removed.sort()
+        report.bytes = sum(size for _name, size in report.removed)
+        if not self.dry_run and report.removed:
+            self.store.metadata.forget_verified(
+                [name for name, _size in report.removed])
+        return report
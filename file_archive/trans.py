@@ -1,8 +1,7 @@
 from __future__ import division, unicode_literals
 
-import gettext
 import locale
-import pkg_resources
+import os
 
 
 __all__ = ['setup_translation', '_', '_n']
@@ -19,47 +18,79 @@ else:
     string_types = str
 
 
-trans = gettext.NullTranslations()
+# The catalog is only loaded the first time a message gets translated, so that
+# commands that don't output any text don't pay for gettext
+trans = None
+selected_languages = None
 
 
 def setup_translation(languages=None):
-    global trans
+    global trans, selected_languages
 
     if languages is None:
         languages = []
     elif isinstance(languages, string_types):
         languages = [languages]
-
-    d = pkg_resources.resource_filename('file_archive', 'l10n')
+    else:
+        languages = list(languages)
 
     lang = locale.getlocale()[0]
     if lang is not None:
         languages.append(lang)
-    trans = gettext.translation('file_archive', d, languages, fallback=True)
+    selected_languages = languages
+    trans = None
+
+
+def _locale_dir():
+    """Finds the directory containing the compiled catalogs.
+    """
+    d = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'l10n')
+    if os.path.isdir(d):
+        return d
+    # We might be running from a zipped egg; pkg_resources is very slow to
+    # import, so only use it if we have to
+    import pkg_resources
+    return pkg_resources.resource_filename('file_archive', 'l10n')
+
 
+def get_translation():
+    """Gets the translation object, loading the catalog if needed.
+    """
+    global trans
+
+    if trans is None:
+        import gettext
+
+        if selected_languages is None:
+            trans = gettext.NullTranslations()
+        else:
+            trans = gettext.translation('file_archive', _locale_dir(),
+                                        selected_languages, fallback=True)
+    return trans
 
-if hasattr(trans, 'ugettext'):
+
+if str == bytes:
     def _(*args, **kwargs):
-        tr = trans.ugettext(*args)
+        tr = get_translation().ugettext(*args)
         if kwargs:
             tr = tr.format(**kwargs)
         return tr
 
     def _n(singular, plural, n, **kwargs):
-        tr = trans.ungettext(singular, plural, n)
+        tr = get_translation().ungettext(singular, plural, n)
         if kwargs:
             tr = tr.format(**kwargs)
         return tr
 else:
     # ugettext was removed from Python 3
     def _(*args, **kwargs):
-        tr = trans.gettext(*args)
+        tr = get_translation().gettext(*args)
         if kwargs:
             tr = tr.format(**kwargs)
         return tr
 
     def _n(singular, plural, n, **kwargs):
-        tr = trans.ngettext(singular, plural, n)
+        tr = get_translation().ngettext(singular, plural, n)
         if kwargs:
             tr = tr.format(**kwargs)
         return tr
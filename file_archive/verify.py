@@ -0,0 +1,312 @@
+"""Integrity checking of a file store.
+
+This is used by FileStore.verify().
+"""
+
+from __future__ import division, unicode_literals
+
+import os
+import threading
+import time
+
+from file_archive import (_directory_hash, hash_directory, hash_file,
+                          hash_metadata)
+from file_archive.blobs import (blob_kind, chunk_path, open_blob,
+                                read_directory, read_refs)
+from file_archive.compat import scandir
+
+
+__all__ = ['VerifyReport', 'Throttle']
+
+
+class Throttle(object):
+    """Limits the rate at which bytes are read, across threads.
+    """
+    def __init__(self, rate):
+        if rate <= 0:
+            raise ValueError("Rate should be positive")
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def consume(self, nbytes):
+        """Accounts for nbytes having been read, sleeping if needed.
+        """
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class CountingFile(object):
+    """Wraps a file object to count (and maybe throttle) bytes read.
+    """
+    def __init__(self, fp, counter, throttle=None):
+        self._fp = fp
+        self._counter = counter
+        self._throttle = throttle
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._counter[0] += len(data)
+        if self._throttle is not None:
+            self._throttle.consume(len(data))
+        return data
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _mtime_ns(st):
+    try:
+        return st.st_mtime_ns
+    except AttributeError:  # Python < 3.3
+        return int(st.st_mtime * 1000000000)
+
+
+def blob_fingerprint(path):
+    """Computes the stat fingerprint of a blob, as (size, mtime, inode).
+
+    For directories, this is the total size of the files, the latest mtime
+    of anything in it (in nanoseconds), and the inode of the directory
+    itself. This only needs a stat walk, no file is read.
+
+    Chunked blobs are handled the same way, over the manifest and the chunks
+    it lists, so that damage to a chunk changes the fingerprint.
+    """
+    st = os.lstat(path)
+    if not os.path.isdir(path):
+        size = st.st_size
+        mtime = _mtime_ns(st)
+        objects = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+        for kind, childhash in read_refs(path):
+            if kind == 'chunk':
+                chunk_st = os.stat(chunk_path(objects, childhash))
+                size += chunk_st.st_size
+                mtime = max(mtime, _mtime_ns(chunk_st))
+        return size, mtime, st.st_ino
+    size = 0
+    mtime = _mtime_ns(st)
+    dirs = [path]
+    while dirs:
+        for entry in scandir(dirs.pop()):
+            entry_st = entry.stat(follow_symlinks=False)
+            mtime = max(mtime, _mtime_ns(entry_st))
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.path)
+            elif not entry.is_symlink():
+                size += entry_st.st_size
+    return size, mtime, st.st_ino
+
+
+class VerifyReport(object):
+    """Results of FileStore.verify().
+
+    corrupt: hashes of the blobs whose content doesn't match their hash
+    missing: (objectid, hash) pairs of entries whose blob is not in the store;
+        objectid is None for blobs that a directory refers to
+    orphaned: hashes of the blobs no entry refers to
+    bad_objectids: objectids that don't match the hash of their metadata
+    checked: number of blobs hashed
+    skipped: number of blobs not hashed in quick mode, as their fingerprint
+        matches the ledger
+    bytes: number of bytes read
+    complete: False if verification was stopped by the time limit; the
+        checkpoint file can be used to resume it
+    """
+    def __init__(self):
+        self.corrupt = []
+        self.missing = []
+        self.orphaned = []
+        self.bad_objectids = []
+        self.checked = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.complete = True
+
+    @property
+    def ok(self):
+        return not (self.corrupt or self.missing or self.orphaned or
+                    self.bad_objectids)
+
+
+def read_checkpoint(filename):
+    """Reads the results recorded in a checkpoint file, as a dict.
+    """
+    results = {}
+    if filename is None or not os.path.exists(filename):
+        return results
+    with open(filename, 'r') as fp:
+        for line in fp:
+            line = line.split()
+            # The last line might be incomplete if we got killed
+            if len(line) == 2 and line[1] in ('ok', 'corrupt'):
+                results[line[0]] = line[1] == 'ok'
+    return results
+
+
+class Verifier(object):
+    """Checks a store, re-hashing blobs on a pool of threads.
+
+    Blobs that are successfully verified get recorded in the verification
+    ledger, along with their stat fingerprint. In quick mode, blobs whose
+    fingerprint didn't change since they were last verified (less than
+    `max_age` seconds ago, if given) are not re-hashed.
+    """
+    LEDGER_BATCH = 100
+
+    def __init__(self, store, workers=4, progress=None, checkpoint=None,
+                 rate=None, time_limit=None, quick=False, max_age=None):
+        self.store = store
+        self.workers = workers
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.throttle = Throttle(rate) if rate else None
+        self.time_limit = time_limit
+        self.quick = quick
+        self.max_age = max_age
+        self._start = None
+        self._stop = False
+
+    def check_blob(self, item):
+        """Re-hashes a blob; runs on the worker threads.
+
+        Returns (filehash, valid, bytes_read, fingerprint), or None if we
+        were stopped. bytes_read is None if the blob was skipped because its
+        fingerprint matches the ledger record.
+        """
+        filehash, path, record = item
+        if self._stop:
+            return None
+        if (self.time_limit is not None and
+                time.time() - self._start >= self.time_limit):
+            self._stop = True
+            return None
+        try:
+            fingerprint = blob_fingerprint(path)
+        except OSError:
+            return filehash, False, 0, None
+        if (self.quick and record is not None and
+                tuple(record[:3]) == fingerprint and
+                (self.max_age is None or
+                 self._start - record[3] < self.max_age)):
+            return filehash, True, None, fingerprint
+        counter = [0]
+        algorithm = self.store.hash_algorithm
+
+        def open_func(name, mode):
+            return CountingFile(open(name, mode), counter, self.throttle)
+
+        try:
+            if os.path.isdir(path):
+                actual = hash_directory(path, open_func=open_func,
+                                        algorithm=algorithm)
+            elif blob_kind(path) == 'directory':
+                # The files are blobs of their own, checked separately
+                actual = _directory_hash(read_directory(path), algorithm)
+            else:
+                # Hash the decoded content, for compressed blobs
+                with CountingFile(open_blob(path), counter,
+                                  self.throttle) as fp:
+                    actual = hash_file(fp, algorithm)
+        except (IOError, OSError):
+            actual = None
+        return filehash, actual == filehash, counter[0], fingerprint
+
+    def run(self):
+        from multiprocessing.pool import ThreadPool
+
+        report = VerifyReport()
+        self._start = time.time()
+        algorithm = self.store.hash_algorithm
+
+        # Check the entries, and find out which blobs should exist
+        referenced = self.store.metadata.all_filehashes()
+        blobs = dict((h, e.path) for h, e in self.store._iter_blobs())
+        of_entries = set()
+        for objectid, metadata in self.store.metadata.query_all({}):
+            if hash_metadata(metadata, algorithm) != objectid:
+                report.bad_objectids.append(objectid)
+            filehash = metadata['hash']
+            of_entries.add(filehash)
+            if filehash not in blobs:
+                report.missing.append((objectid, filehash))
+        report.missing.extend(sorted((None, h) for h in referenced
+                                     if h not in blobs and
+                                     h not in of_entries))
+        report.orphaned = sorted(h for h in blobs if h not in referenced)
+
+        # Forget about blobs that are gone from the ledger
+        ledger = self.store.metadata.get_verified()
+        gone = [h for h in ledger if h not in blobs]
+        if gone:
+            self.store.metadata.forget_verified(gone)
+
+        # Re-hash the blobs, skipping those already checked by an interrupted
+        # run
+        done = read_checkpoint(self.checkpoint)
+        todo = []
+        for filehash in sorted(referenced):
+            if filehash not in blobs:
+                continue
+            if filehash in done:
+                if not done[filehash]:
+                    report.corrupt.append(filehash)
+            else:
+                todo.append((filehash, blobs[filehash], ledger.get(filehash)))
+        total = len(todo)
+
+        checkpoint = None
+        if self.checkpoint is not None:
+            checkpoint = open(self.checkpoint, 'a')
+        verified = []
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self.check_blob, todo):
+                if result is None:
+                    report.complete = False
+                    continue
+                filehash, valid, nbytes, fingerprint = result
+                if nbytes is None:
+                    report.skipped += 1
+                else:
+                    report.checked += 1
+                    report.bytes += nbytes
+                    if valid:
+                        verified.append((filehash,) + fingerprint +
+                                        (int(time.time()),))
+                if not valid:
+                    report.corrupt.append(filehash)
+                if checkpoint is not None:
+                    checkpoint.write('%s %s\n' % (
+                        filehash, 'ok' if valid else 'corrupt'))
+                    checkpoint.flush()
+                if len(verified) >= self.LEDGER_BATCH:
+                    self.store.metadata.set_verified(verified)
+                    verified = []
+                if self.progress is not None:
+                    self.progress(report.checked + report.skipped, total,
+                                  report.bytes)
+        finally:
+            self._stop = True
+            pool.close()
+            pool.join()
+            if checkpoint is not None:
+                checkpoint.close()
+            if verified:
+                self.store.metadata.set_verified(verified)
+
+        if report.corrupt:
+            self.store.metadata.forget_verified(report.corrupt)
+        if report.complete and self.checkpoint is not None:
+            os.remove(self.checkpoint)
+        report.corrupt.sort()
+        return report
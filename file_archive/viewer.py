@@ -1,8 +1,10 @@
 from __future__ import division, unicode_literals
 
+from collections import OrderedDict
 import imp
 import os
 import platform
+import re
 import subprocess
 import sys
 
@@ -15,8 +17,10 @@ except ImportError:
 
 
 from file_archive import hash_metadata
-from file_archive.compat import int_types
-from file_archive.parser import parse_expression
+from file_archive.blobs import blob_kind
+from file_archive.compat import int_types, queue
+from file_archive.parser import escape_string, match_conditions, \
+    narrows_conditions, parse_expression
 from file_archive.trans import _, _n
 
 
@@ -96,27 +100,486 @@ class SearchError(Exception):
     """
 
 
-class FileItem(QtWidgets.QTreeWidgetItem):
-    def __init__(self, entry):
+class SearchThread(QtCore.QThread):
+    """Runs searches in the background, one page of results at a time.
+
+    The thread has its own connection to the store. Each search gets a
+    number from new_search(); when a new search is started or cancel() is
+    called, pages requested for the previous one are skipped, and results
+    already sent for it should be ignored.
+    """
+    # (search number, [(entry, stats), ...], whether there are more)
+    results = QtCore.pyqtSignal(int, object, bool)
+    # (search number, error message)
+    failed = QtCore.pyqtSignal(int, object)
+    # (key, summary): the keys of the store if key is None, as (key, type,
+    # count) tuples, else the most frequent values of key, as (value, count)
+    summary = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, path, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self._path = path
+        self._requests = queue.Queue()
+        self._current = 0
+
+    def new_search(self):
+        self._current += 1
+        return self._current
+
+    def cancel(self):
+        self._current += 1
+
+    def fetch(self, number, request, after, count):
+        """Requests a page of results for a search.
+
+        `request` is either ('get', objectid) or ('query', conditions); up to
+        `count` entries are fetched, starting after objectid `after`.
+        """
+        self._requests.put(('fetch', number, request, after, count))
+
+    def summarize(self, key=None, limit=None):
+        """Requests the list of keys, or of the values of a key.
+
+        The result is sent through the summary signal.
+        """
+        self._requests.put(('summary', key, limit))
+
+    def stop(self):
+        self.cancel()
+        self._requests.put(None)
+        self.wait()
+
+    def run(self):
+        from file_archive import FileStore
+
+        store = FileStore(self._path)
+        try:
+            while True:
+                request = self._requests.get()
+                if request is None:
+                    break
+                if request[0] == 'summary':
+                    self._summarize(store, *request[1:])
+                    continue
+                _kind, number, request, after, count = request
+                if number != self._current:
+                    continue  # Superseded already
+                try:
+                    entries, more = self._fetch(store, request, after, count)
+                except SearchError as e:
+                    self.failed.emit(number, e.args[0])
+                except Exception as e:
+                    self.failed.emit(number, '%s' % e)
+                else:
+                    stats = store.metadata.get_stats(
+                        set(e['hash'] for e in entries))
+                    self.results.emit(
+                        number,
+                        [(e, stats.get(e['hash'])) for e in entries],
+                        more)
+        finally:
+            store.close()
+
+    def _summarize(self, store, key, limit):
+        try:
+            if key is None:
+                summary = store.metadata_keys()
+            else:
+                summary = store.metadata_values(key, limit)
+        except Exception:
+            return  # No completions then
+        self.summary.emit(key, summary)
+
+    def _fetch(self, store, request, after, count):
+        kind, arg = request
+        if kind == 'get':
+            try:
+                return [store.get(arg)], False
+            except KeyError:
+                raise SearchError(_("objectid '{oid}' not found", oid=arg))
+        else:
+            # Each page is a separate query, so no read transaction is kept
+            # open while the user browses
+            entries = list(store.query(arg, limit=count, after=after))
+            return entries, len(entries) == count
+
+
+def format_size(size):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1000:
+            break
+        size /= 1000
+    else:
+        unit = 'TB'
+    if unit == 'B':
+        return '%d %s' % (size, unit)
+    return '%.1f %s' % (size, unit)
+
+
+class ResultRow(object):
+    """An entry in the ResultModel.
+    """
+    def __init__(self, row, entry, stats):
+        self.row = row
         self.entry = entry
-        QtWidgets.QTreeWidgetItem.__init__(self, [entry.objectid])
+        self.stats = stats
+        if stats is None:
+            self.size = ''
+        elif entry.isdir():
+            self.size = _n("{size} ({nb} file)", "{size} ({nb} files)",
+                           stats[1], size=format_size(stats[0]), nb=stats[1])
+        else:
+            self.size = format_size(stats[0])
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        # Only built when the row gets expanded
+        if self._metadata is None:
+            self._metadata = []
+            for k, v in sorted(self.entry.metadata.items()):
+                if isinstance(v, int_types):
+                    self._metadata.append((k, '%d' % v, 'int'))
+                else:  # isinstance(v, string_types):
+                    self._metadata.append((k, v, 'str'))
+        return self._metadata
+
+
+class ResultModel(QtCore.QAbstractItemModel):
+    """Results of a search, fetched one page at a time as the view scrolls.
+
+    Top-level rows are the entries, and their children are their metadata.
+    """
+    PAGE_SIZE = 200
+
+    # Emitted when a page is added or the search ends
+    changed = QtCore.pyqtSignal()
+
+    def __init__(self, searcher, parent=None):
+        QtCore.QAbstractItemModel.__init__(self, parent)
+        self._searcher = searcher
+        self._searcher.results.connect(self._add_results)
+        self._searcher.failed.connect(self._failed)
+        self._headers = [_("Key"), _("Value"), _("Type"), _("Size")]
+        self._rows = []
+        self._request = None
+        self._number = None
+        self._more = False
+        self.complete = False
+        self.error = None
+
+    @property
+    def searching(self):
+        """Whether a page is being fetched.
+        """
+        return self._number is not None
+
+    @property
+    def has_more(self):
+        return self._more
+
+    @property
+    def request(self):
+        return self._request
+
+    def results(self):
+        """Returns the results fetched so far, as (entry, stats) pairs.
+        """
+        return [(row.entry, row.stats) for row in self._rows]
+
+    def set_request(self, request):
+        """Starts a new search, clearing the results.
+        """
+        self.beginResetModel()
+        self._rows = []
+        self._request = request
+        self._number = None
+        self._more = True
+        self.complete = False
+        self.error = None
+        self.endResetModel()
+        self._searcher.cancel()
+        self.fetch_more()
+        self.changed.emit()
+
+    def set_results(self, request, results):
+        """Shows the results of a search, known without asking the store.
+        """
+        self.beginResetModel()
+        self._rows = [ResultRow(i, entry, stats)
+                      for i, (entry, stats) in enumerate(results)]
+        self._request = request
+        self._number = None
+        self._more = False
+        self.complete = True
+        self.error = None
+        self.endResetModel()
+        self._searcher.cancel()
+        self.changed.emit()
+
+    def clear(self, error=None):
+        self.beginResetModel()
+        self._rows = []
+        self._request = None
+        self._number = None
+        self._more = False
+        self.complete = False
+        self.error = error
+        self.endResetModel()
+        self._searcher.cancel()
+        self.changed.emit()
+
+    def cancel(self):
+        """Stops fetching results; the ones already there are kept.
+        """
+        if self._number is not None:
+            self._searcher.cancel()
+            self._number = None
+            self._more = False
+            self.changed.emit()
+
+    @property
+    def can_fetch_more(self):
+        return self._more and self._number is None
+
+    def fetch_more(self):
+        """Requests the next page of results, if any.
+
+        This is not done through canFetchMore()/fetchMore(), as QTreeView
+        calls these whenever it lays out its items, which would load all the
+        results; the view requests pages when it gets scrolled down instead.
+        """
+        if not self.can_fetch_more:
+            return
+        self._number = self._searcher.new_search()
+        after = self._rows[-1].entry.objectid if self._rows else None
+        self._searcher.fetch(self._number, self._request, after,
+                             self.PAGE_SIZE)
+
+    def _add_results(self, number, results, more):
+        if number != self._number:
+            return  # Results of a previous search
+        self._number = None
+        self._more = more
+        self.complete = not more
+        if results:
+            start = len(self._rows)
+            self.beginInsertRows(QtCore.QModelIndex(),
+                                 start, start + len(results) - 1)
+            for i, (entry, stats) in enumerate(results):
+                self._rows.append(ResultRow(start + i, entry, stats))
+            self.endInsertRows()
+        self.changed.emit()
+
+    def _failed(self, number, error):
+        if number == self._number:
+            self.clear(error)
+
+    def entry(self, index):
+        """Returns the entry for a row or one of its children.
+        """
+        if not index.isValid():
+            return None
+        parent = index.internalPointer()
+        if parent is not None:
+            return parent.entry
+        return self._rows[index.row()].entry
+
+    def remove_entries(self, objectids):
+        """Removes the rows of the given entries.
+        """
+        for i in range(len(self._rows) - 1, -1, -1):
+            if self._rows[i].entry.objectid in objectids:
+                self.beginRemoveRows(QtCore.QModelIndex(), i, i)
+                del self._rows[i]
+                for row in self._rows[i:]:
+                    row.row -= 1
+                self.endRemoveRows()
+        self.changed.emit()
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column)
+        return self.createIndex(row, column, self._rows[parent.row()])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        parent = index.internalPointer()
+        if parent is None:
+            return QtCore.QModelIndex()
+        return self.createIndex(parent.row, 0)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if not parent.isValid():
+            return len(self._rows)
+        elif parent.internalPointer() is None:
+            return len(self._rows[parent.row()].metadata)
+        else:
+            return 0
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        # Entries always have metadata (at least their hash); don't build it
+        # until they are expanded
+        if not parent.isValid():
+            return bool(self._rows)
+        return parent.internalPointer() is None
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self._headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        parent = index.internalPointer()
+        if role == QtCore.Qt.DisplayRole:
+            if parent is not None:
+                return parent.metadata[index.row()][index.column()] \
+                    if index.column() < 3 else None
+            row = self._rows[index.row()]
+            if index.column() == 0:
+                return row.entry.objectid
+            elif index.column() == 3:
+                return row.size
+        elif role == QtCore.Qt.FontRole and parent is None:
+            font = QtGui.QFont()
+            font.setBold(True)
+            return font
+        return None
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if (orientation == QtCore.Qt.Horizontal and
+                role == QtCore.Qt.DisplayRole):
+            return self._headers[section]
+        return None
+
+
+class QueryCompleter(QtWidgets.QCompleter):
+    """Completes the key or value being typed in the query box.
+
+    Keys and values come from the store's summaries of its metadata, which
+    are requested from the search thread; values are offered after 'key='.
+    Until a summary is received, the previous one for the same key is shown.
+    """
+    # Most frequent values offered for a key
+    VALUES_LIMIT = 50
+
+    _key_re = re.compile(r'(?:^|(?<=\s))([A-Za-z_][A-Za-z0-9_]*)$')
+    _value_re = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)\s*=\s*'
+                           r'((?:"(?:[^\\"]|\\.)*)?|-?\d*)$')
+
+    # Emitted with the new text once a completion was inserted
+    inserted = QtCore.pyqtSignal(object)
+
+    def __init__(self, searcher, lineedit):
+        QtWidgets.QCompleter.__init__(self, lineedit)
+        self._searcher = searcher
+        self._searcher.summary.connect(self._summary_received)
+        self._lineedit = lineedit
+        self._model = QtGui.QStandardItemModel(self)
+        self._span = None
+        # Summaries received, by key (None for the list of keys)
+        self._summaries = {}
+        # Summaries requested and not yet received
+        self._pending = set()
+        # Key of the summary the completions are waiting for, if any
+        self._waiting = False
+        self.setModel(self._model)
+        self.setWidget(lineedit)
+        self.setCaseSensitivity(QtCore.Qt.CaseInsensitive)
+        self.activated[str].connect(self._insert)
+
+    def _context(self):
+        # Finds what is being typed, as (key, prefix); key is None when
+        # typing a key, or the key whose value is being typed
+        before = self._lineedit.text()[:self._lineedit.cursorPosition()]
+        m = self._value_re.search(before)
+        if m is not None:
+            return m.group(1), m.group(2)
+        m = self._key_re.search(before)
+        if m is not None:
+            return None, m.group(1)
+        return None
+
+    def update(self, text):
+        """Shows the completions for what's before the cursor.
+
+        The summary is requested again, and the completions get updated when
+        it is received.
+        """
+        context = self._context()
+        if context is not None and context[0] not in self._pending:
+            self._pending.add(context[0])
+            self._searcher.summarize(context[0], self.VALUES_LIMIT)
+        self._show(context)
+
+    def _summary_received(self, key, summary):
+        self._pending.discard(key)
+        self._summaries[key] = summary
+        if self._waiting == key or self.popup().isVisible():
+            self._show(self._context())
+
+    def _show(self, context):
+        self._waiting = False
+        if context is None:
+            self.popup().hide()
+            return
+        key, prefix = context
+        summary = self._summaries.get(key)
+        if summary is None:
+            self._waiting = key
+            self.popup().hide()
+            return
+        if key is not None:
+            completions = []
+            for value, _count in summary:
+                if isinstance(value, int_types):
+                    completions.append('%d' % value)
+                else:  # isinstance(value, string_types):
+                    completions.append(escape_string(value))
+        else:
+            completions = sorted(set(k for k, _t, _count in summary))
+
+        cursor = self._lineedit.cursorPosition()
+        self._span = cursor - len(prefix), cursor
+        self._model.clear()
+        for completion in completions:
+            self._model.appendRow(QtGui.QStandardItem(completion))
+        self.setCompletionPrefix(prefix)
+        if self.completionCount() == 0 or (
+                self.completionCount() == 1 and
+                self.currentCompletion() == prefix):
+            self.popup().hide()
+        else:
+            self.complete()
 
+    def _insert(self, completion):
+        text = self._lineedit.text()
+        start, end = self._span
+        text = text[:start] + completion + text[end:]
+        self._lineedit.setText(text)
+        self._lineedit.setCursorPosition(start + len(completion))
+        self.inserted.emit(text)
 
-class MetadataItem(FileItem):
-    def __init__(self, entry, key, value):
-        if isinstance(value, int_types):
-            t = 'int'
-            value = '%d' % value
-        else:  # isinstance(v, string_types):
-            t = 'str'
-        QtWidgets.QTreeWidgetItem.__init__(self, [key, value, t])
-        self.entry = entry
+
+def _conditions_key(conditions):
+    # Hashable version of parsed conditions
+    return tuple(sorted((k, tuple(sorted(v.items())))
+                        for k, v in conditions.items()))
 
 
 class StoreViewerWindow(QtWidgets.QMainWindow):
     WINDOW_TITLE = _("file_archive viewer")
 
-    MAX_RESULTS = 100
+    # Delay after the last keystroke before searching, in milliseconds
+    SEARCH_DELAY = 250
+
+    # Number of complete result lists kept around
+    RESULT_CACHE_SIZE = 16
+    # Result lists longer than this are not kept
+    RESULT_CACHE_MAX = 50000
 
     def __init__(self, store):
         QtWidgets.QMainWindow.__init__(self)
@@ -127,26 +590,66 @@ class StoreViewerWindow(QtWidgets.QMainWindow):
         searchbar = QtWidgets.QHBoxLayout()
 
         self._needs_refresh = False
+        self._result_cache = OrderedDict()
+
+        # Search as the user types, once they stop for a moment
+        self._search_timer = QtCore.QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(self.SEARCH_DELAY)
+        self._search_timer.timeout.connect(self._search)
 
         # Input line for the query
         self._input = QtWidgets.QLineEdit()
         self._input.setPlaceholderText(_("Enter query here"))
         self._input.returnPressed.connect(self._search)
-        self._input.textEdited.connect(lambda t: self._set_needs_refresh())
+        self._input.textEdited.connect(self._text_edited)
         searchbar.addWidget(self._input)
 
+        # Searches run on a background thread; the model asks it for more
+        # results as the view gets scrolled down
+        self._searcher = SearchThread(os.path.dirname(store.store), self)
+
+        # Completion of keys and values, from summaries also fetched by the
+        # background thread
+        self._completer = QueryCompleter(self._searcher, self._input)
+        self._input.textEdited.connect(self._completer.update)
+        self._completer.inserted.connect(self._text_edited)
+
         # Search button
         self._searchbutton = QtWidgets.QPushButton(_("Search"))
-        self._searchbutton.clicked.connect(self._search)
+        self._searchbutton.clicked.connect(
+            lambda: self._search(refresh=True))
         searchbar.addWidget(self._searchbutton)
 
+        # Progress, shown while results are being fetched
+        self._progress = QtWidgets.QProgressBar()
+        self._progress.setRange(0, 0)
+        self._progress.setVisible(False)
+        searchbar.addWidget(self._progress)
+        self._stopbutton = QtWidgets.QPushButton(_("Stop"))
+        self._stopbutton.setVisible(False)
+        searchbar.addWidget(self._stopbutton)
+        self._status = QtWidgets.QLabel()
+        searchbar.addWidget(self._status)
+
         results = QtWidgets.QHBoxLayout()
 
+        self._model = ResultModel(self._searcher, self)
+        self._model.changed.connect(self._results_changed)
+        self._stopbutton.clicked.connect(self._model.cancel)
+        self._searcher.start()
+
         # Result view, as a tree with metadata
-        self._result_tree = QtWidgets.QTreeWidget()
-        self._result_tree.setColumnCount(3)
-        self._result_tree.setHeaderLabels([_("Key"), _("Value"), _("Type")])
-        self._result_tree.itemSelectionChanged.connect(self._selection_changed)
+        self._result_tree = QtWidgets.QTreeView()
+        self._result_tree.setUniformRowHeights(True)
+        self._result_tree.setSelectionMode(
+            QtWidgets.QAbstractItemView.ExtendedSelection)
+        self._result_tree.setModel(self._model)
+        self._result_tree.selectionModel().selectionChanged.connect(
+            lambda selected, deselected: self._selection_changed())
+        scrollbar = self._result_tree.verticalScrollBar()
+        scrollbar.valueChanged.connect(self._scrolled)
+        scrollbar.rangeChanged.connect(self._scrolled)
         results.addWidget(self._result_tree)
 
         # Buttons, enabled/disabled when the selection changes
@@ -211,114 +714,181 @@ class StoreViewerWindow(QtWidgets.QMainWindow):
     def _alter_search_conditions(self, conditions):
         return conditions
 
-    def _search(self):
-        error = None
+    def _text_edited(self, text):
+        # Results don't match the query anymore, no use fetching more
+        self._model.cancel()
+        self._set_needs_refresh()
+        self._search_timer.start()
+
+    def _cached_results(self, conditions):
+        """Finds the results of a query from those of a previous one.
+
+        This works if the query is the same as one whose results were all
+        fetched, or narrows it (e.g. the user typed one more condition).
+        """
+        if not all(isinstance(v, dict) for v in conditions.values()):
+            return None
+        key = _conditions_key(conditions)
+        if key in self._result_cache:
+            self._result_cache[key] = self._result_cache.pop(key)
+            return self._result_cache[key][1]
+        best = None
+        for previous, results in self._result_cache.values():
+            if (narrows_conditions(conditions, previous) and
+                    (best is None or len(results) < len(best))):
+                best = results
+        if best is None:
+            return None
+        return [(entry, stats) for entry, stats in best
+                if match_conditions(conditions, entry.metadata)]
+
+    def _cache_results(self):
+        kind, conditions = self._model.request
+        if (kind != 'query' or
+                self._model.rowCount() > self.RESULT_CACHE_MAX or
+                not all(isinstance(v, dict) for v in conditions.values())):
+            return
+        key = _conditions_key(conditions)
+        self._result_cache.pop(key, None)
+        if len(self._result_cache) >= self.RESULT_CACHE_SIZE:
+            self._result_cache.popitem(last=False)
+        self._result_cache[key] = conditions, self._model.results()
+
+    def _search(self, refresh=False):
+        self._search_timer.stop()
+        if refresh:
+            # The store might have been changed by someone else
+            self._result_cache.clear()
 
         query = self._input.text()
 
         if len(query.split()) == 1 and all(o not in query.strip()
                                            for o in '=<>'):
-            objectid = query.strip()
-            try:
-                entries = [self.store.get(objectid)]
-            except KeyError:
-                error = _("objectid '{oid}' not found", oid=objectid)
-
+            self._model.set_request(('get', query.strip()))
         else:
             try:
                 conditions = parse_expression(query)
             except tdparser.Error as e:
-                error = e.args[0]
+                self._model.clear(e.args[0])
             else:
                 conditions = self._alter_search_conditions(conditions)
-                entries = self.store.query(conditions, limit=self.MAX_RESULTS)
+                results = self._cached_results(conditions)
+                if results is not None:
+                    self._model.set_results(('query', conditions), results)
+                else:
+                    self._model.set_request(('query', conditions))
 
-        self._result_tree.clear()
+        self._set_needs_refresh(False)
 
-        if error is not None:
-            w = QtWidgets.QTreeWidgetItem([error])
-            w.setForeground(0, QtGui.QColor(255, 0, 0))
-            self._result_tree.addTopLevelItem(w)
-            self._result_tree.setFirstItemColumnSpanned(w, True)
+    def _scrolled(self, *args):
+        # Get more results when reaching the end of the list (or if the list
+        # doesn't fill the view)
+        scrollbar = self._result_tree.verticalScrollBar()
+        if scrollbar.value() >= scrollbar.maximum() - scrollbar.pageStep():
+            self._model.fetch_more()
+
+    def _results_changed(self):
+        searching = self._model.searching
+        self._progress.setVisible(searching)
+        self._stopbutton.setVisible(searching)
+        count = self._model.rowCount()
+        if self._model.complete:
+            self._cache_results()
+        if self._model.error is not None:
+            self._status.setStyleSheet('color: red;')
+            self._status.setText(self._model.error)
+            return
+        self._status.setStyleSheet('')
+        if searching:
+            self._status.setText(_n("Searching... {nb} result",
+                                    "Searching... {nb} results",
+                                    count, nb=count))
+        elif count == 0:
+            self._status.setText(_("No matches"))
+        elif self._model.has_more:
+            self._status.setText(_n("{nb} result so far",
+                                    "{nb} results so far",
+                                    count, nb=count))
         else:
-            for i, entry in enumerate(entries):
-                file_item = FileItem(entry)
-                f = file_item.font(0)
-                f.setBold(True)
-                file_item.setFont(0, f)
-                self._result_tree.addTopLevelItem(file_item)
-                self._result_tree.setFirstItemColumnSpanned(file_item, True)
-                for k, v in entry.metadata.items():
-                    file_item.addChild(MetadataItem(entry, k, v))
-
-                if i + 1 == self.MAX_RESULTS:
-                    last_item = QtWidgets.QTreeWidgetItem(
-                        [_("... stripped after {nb} results...",
-                           nb=self.MAX_RESULTS)])
-                    f = last_item.font(0)
-                    f.setBold(True)
-                    f.setItalic(True)
-                    last_item.setFont(0, f)
-                    self._result_tree.addTopLevelItem(last_item)
-                    self._result_tree.setFirstItemColumnSpanned(last_item,
-                                                                True)
-                    break
-            if self._result_tree.topLevelItemCount() == 0:
-                w = QtWidgets.QTreeWidgetItem([_("No matches")])
-                self._result_tree.addTopLevelItem(w)
-                self._result_tree.setFirstItemColumnSpanned(w, True)
-            self._result_tree.expandAll()
-
-        self._set_needs_refresh(False)
+            self._status.setText(_n("{nb} result", "{nb} results",
+                                    count, nb=count))
+
+    def closeEvent(self, event):
+        self._searcher.stop()
+        QtWidgets.QMainWindow.closeEvent(self, event)
+
+    def _selected_entries(self):
+        entries = []
+        seen = set()
+        for index in self._result_tree.selectionModel().selectedRows():
+            entry = self._model.entry(index)
+            if entry.objectid not in seen:
+                seen.add(entry.objectid)
+                entries.append(entry)
+        return entries
 
     def _selection_changed(self):
-        items = self._result_tree.selectedItems()
+        rows = self._result_tree.selectionModel().selectedRows()
         for t, button in self._buttons:
             if t == 'single':
-                button.setEnabled(len(items) == 1 and
-                                  isinstance(items[0], FileItem))
+                button.setEnabled(len(rows) == 1)
             elif t == 'multi':
-                button.setEnabled(bool(items) and
-                                  all(isinstance(i, FileItem) for i in items))
+                button.setEnabled(bool(rows))
 
     def _openfile(self):
-        item = self._result_tree.currentItem()
-        if item is not None:
-            openfile(item.entry.filename)
+        entries = self._selected_entries()
+        if entries:
+            entry = entries[0]
+            filename = entry.filename
+            if blob_kind(filename) is not None:
+                # Not stored as-is (compressed, chunked, or a directory
+                # manifest), give a copy to the external program
+                import tempfile
+                filename = os.path.join(
+                    tempfile.mkdtemp(prefix='file_archive_'),
+                    entry.objectid)
+                self.store.extract(entry, filename)
+            openfile(filename)
 
     def _copy_objectid(self):
-        items = self._result_tree.selectedItems()
-        if not items:
+        entries = self._selected_entries()
+        if not entries:
             return
-        objectid = items[0].entry.objectid
+        objectid = entries[0].objectid
 
         clipboard = QtWidgets.QApplication.clipboard()
         clipboard.setText(objectid)
 
     def _edit_metadata(self):
-        items = self._result_tree.selectedItems()
-        if not items:
+        entries = self._selected_entries()
+        if not entries:
             return
-        entry = items[0].entry
+        entry = entries[0]
 
         editor = MetadataEditor(entry, self)
         editor.show()
 
     def change_metadata(self, old_objectid, metadata, remove_original=False):
-        new_objectid = hash_metadata(metadata)
+        new_objectid = hash_metadata(metadata, self.store.hash_algorithm)
         if new_objectid == old_objectid:
             return
 
-        self.store.metadata.add(new_objectid, metadata)
-
         if remove_original:
-            self.store.remove(old_objectid)
+            # Changed in place, the file doesn't go anywhere
+            old_metadata = self.store.get(old_objectid).metadata
+            self.store.update_metadata(
+                objectids=[old_objectid],
+                set=dict((k, v) for k, v in metadata.items()
+                         if k != 'hash'),
+                unset=[k for k in old_metadata if k not in metadata])
+        else:
+            self.store.metadata.add(new_objectid, metadata)
 
-        self._search()
+        self._search(refresh=True)
 
     def _delete(self):
-        items = self._result_tree.selectedItems()
-        if not items:
+        entries = self._selected_entries()
+        if not entries:
             return
         confirm = QtWidgets.QMessageBox.question(
             self,
@@ -327,20 +897,15 @@ class StoreViewerWindow(QtWidgets.QMainWindow):
                "Please confirm.",
                "You are about to delete {num} entries from the store. "
                "Please confirm.",
-               len(items),
-               num=len(items)),
+               len(entries),
+               num=len(entries)),
             QtWidgets.QMessageBox.Ok | QtWidgets.QMessageBox.Cancel,
             QtWidgets.QMessageBox.Cancel)
         if confirm == QtWidgets.QMessageBox.Ok:
-            ids = set([i.entry.objectid for i in items])
-            i = 0
-            while i < self._result_tree.topLevelItemCount():
-                oid = self._result_tree.topLevelItem(i).entry.objectid
-                if oid in ids:
-                    self.store.remove(oid)
-                    self._result_tree.takeTopLevelItem(i)
-                else:
-                    i += 1
+            ids = set(entry.objectid for entry in entries)
+            self.store.remove_many(objectids=ids)
+            self._result_cache.clear()
+            self._model.remove_entries(ids)
 
 
 class MetadataEditor(QtWidgets.QDialog):
@@ -0,0 +1,55 @@
+"""Measures the time it takes to parse query expressions.
+
+usage: python scripts/bench_parser.py [number]
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from file_archive import parser  # noqa: E402
+
+
+EXPRESSIONS = [
+    'model="weather2"',
+    'model="weather2" run>12 run<40 author:str',
+    'experiment="some \\"quoted\\" name" size>1024 size<1048576 '
+    'host="node12" rank=0 user:str kind="output"',
+]
+
+
+def bench(name, func, number):
+    # Best of a few runs, in microseconds per call
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-10s %8.2f us" % (name, best / number * 1e6))
+
+
+def main(number):
+    for expression in EXPRESSIONS:
+        print(expression)
+
+        def tdparser_lexer():
+            # What parse_expression() used to do
+            p = parser.Parser(parser.lexer.lex(expression))
+            conditions = {}
+            while not isinstance(p.current_token, parser.EndToken):
+                parser._update_conditions(conditions, p.expression())
+
+        def uncached():
+            parser._parse_expression(expression)
+
+        def cached():
+            parser.parse_expression(expression)
+
+        bench('tdparser', tdparser_lexer, number)
+        bench('compiled', uncached, number)
+        bench('cached', cached, number)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
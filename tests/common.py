@@ -2,6 +2,7 @@ from __future__ import division, unicode_literals
 
 import contextlib
 import os
+import random
 import shutil
 import tempfile
 import warnings
@@ -36,3 +37,10 @@ def temp_warning_filter():
         yield
     finally:
         warnings.filters = filters
+
+
+def random_bytes(size, seed=0):
+    """Returns random-looking bytes, the same every time for a given seed.
+    """
+    rng = random.Random(seed)
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(size)))
@@ -0,0 +1,103 @@
+from __future__ import division, unicode_literals
+
+import os
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from file_archive import FileStore
+
+if asyncio is not None:
+    from file_archive.aio import AsyncFileStore
+
+
+@unittest.skipIf(asyncio is None, "asyncio unavailable")
+class TestAsyncStore(unittest.TestCase):
+    """Tests the asyncio interface.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test_file_archive_')
+        FileStore.create_store(self.path)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.store = AsyncFileStore(self.path, max_workers=2)
+        testfiles = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'testfiles')
+        self.t = lambda f: os.path.join(testfiles, f)
+
+    def tearDown(self):
+        self.wait(self.store.close())
+        self.store = None
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        shutil.rmtree(self.path)
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def collect(self, aiterator):
+        result = []
+        while True:
+            try:
+                result.append(self.wait(aiterator.__anext__()))
+            except StopAsyncIteration:
+                return result
+
+    def test_add_query(self):
+        entries = self.wait(asyncio.gather(
+            self.store.add(self.t('file1.bin'), {'a': 'b'}),
+            self.store.add(self.t('file2.bin'), {'a': 'c'}),
+            self.store.add(self.t('dir3'), {'a': 'b'})))
+        self.assertEqual(entries[0].objectid,
+                         '8ce67dc4c67401ff8122ecebc98ecee506211f88')
+        self.assertEqual(entries[2]['hash'],
+                         'ed1e24cdb080c9b870598572ee645fb358f8d7dc')
+
+        found = self.collect(self.store.query({'a': 'b'}))
+        self.assertEqual(set(e.objectid for e in found),
+                         set([entries[0].objectid, entries[2].objectid]))
+        self.assertEqual(len(self.collect(self.store.query({}))), 3)
+
+        entry = self.wait(self.store.get(entries[1].objectid))
+        self.assertEqual(entry.metadata, {'hash': entries[1]['hash'],
+                                          'a': 'c'})
+
+        with self.assertRaises(ValueError):
+            self.wait(self.store.add(self.t('file5.bin'),
+                                     {'a': {'whatsthis': 'value'}}))
+
+    def test_open_remove(self):
+        entry = self.wait(self.store.add(self.t('file1.bin'), {}))
+        fp = self.wait(self.store.open(entry.objectid))
+        try:
+            self.assertEqual(self.wait(fp.read()),
+                             b'this is some\n'
+                             b'random content\n'
+                             b'note LF line endings\n')
+            self.wait(fp.seek(5))
+            self.assertEqual(self.collect(fp), [b'is some\n'
+                                                b'random content\n'
+                                                b'note LF line endings\n'])
+        finally:
+            self.wait(fp.close())
+
+        self.wait(self.store.remove(entry.objectid))
+        self.assertFalse(os.path.exists(entry.filename))
+        with self.assertRaises(KeyError):
+            self.wait(self.store.get(entry.objectid))
+
+    def test_concurrent_add_remove(self):
+        entry = self.wait(self.store.add(self.t('file1.bin'), {'a': 'b'}))
+        self.wait(asyncio.gather(
+            self.store.remove(entry.objectid),
+            self.store.add(self.t('file1.bin'), {'a': 'c'})))
+        self.assertTrue(os.path.isfile(entry.filename))
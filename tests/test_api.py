@@ -4,6 +4,8 @@ import os
 import platform
 import shutil
 import tempfile
+import threading
+import time
 import warnings
 
 try:
@@ -14,7 +16,7 @@ except ImportError:
 import file_archive
 from file_archive.compat import BytesIO
 
-from tests.common import temp_dir, temp_warning_filter
+from tests.common import random_bytes, temp_dir, temp_warning_filter
 
 
 requires_symlink = unittest.skipIf(platform.system() == 'Windows',
@@ -41,6 +43,61 @@ class TestInternals(unittest.TestCase):
         finally:
             file_archive.CHUNKSIZE = old_chunk_size
 
+    def test_hash_files(self):
+        with temp_dir() as t:
+            paths = []
+            for i in range(100):
+                sub = os.path.join(t, 'd%d' % (i // 10))
+                if not os.path.isdir(sub):
+                    os.mkdir(sub)
+                paths.append(os.path.join(sub, 'f%d' % i))
+                with open(paths[-1], 'wb') as fp:
+                    fp.write(random_bytes(i * 100, seed=i))
+            # Larger than the buffer files are read into
+            paths.append(os.path.join(t, 'big'))
+            with open(paths[-1], 'wb') as fp:
+                fp.write(random_bytes(1000) * 1100)
+
+            expected = []
+            for path in paths:
+                with open(path, 'rb') as fp:
+                    expected.append(file_archive.hash_file(fp))
+            self.assertEqual(file_archive.hash_files(paths, workers=1),
+                             expected)
+            self.assertEqual(file_archive.hash_files(paths, workers=3),
+                             expected)
+            self.assertEqual(file_archive.hash_files([]), [])
+
+            # Hashing in batch gives the same result as file by file
+            self.assertEqual(file_archive.hash_directory(t),
+                             file_archive.hash_directory(t, open_func=open))
+
+    @requires_symlink
+    def test_copy_directory(self):
+        with temp_dir() as t:
+            src = os.path.join(t, 'src')
+            os.makedirs(os.path.join(src, 'sub', 'subsub'))
+            with open(os.path.join(src, 'sub', 'file'), 'wb') as fp:
+                fp.write(b'some content\n')
+            with open(os.path.join(t, 'outside'), 'wb') as fp:
+                fp.write(b'outside\n')
+            os.symlink(os.path.join(src, 'sub', 'file'),
+                       os.path.join(src, 'sub', 'subsub', 'in'))
+            os.symlink(os.path.join(t, 'outside'), os.path.join(src, 'out'))
+
+            dest = os.path.join(t, 'dest')
+            file_archive.copy_directory(src, dest)
+            self.assertEqual(os.readlink(os.path.join(dest, 'sub', 'subsub',
+                                                      'in')),
+                             '../file')
+            self.assertFalse(os.path.islink(os.path.join(dest, 'out')))
+            with open(os.path.join(dest, 'out'), 'rb') as fp:
+                self.assertEqual(fp.read(), b'outside\n')
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', file_archive.UsageWarning)
+                self.assertEqual(file_archive.hash_directory(dest),
+                                 file_archive.hash_directory(src))
+
     @requires_symlink
     def test_relativize_link(self):
         with temp_dir() as t:
@@ -76,6 +133,17 @@ class TestInternals(unittest.TestCase):
                              None)
 
 
+class TestThrottle(unittest.TestCase):
+    def test_throttle(self):
+        from file_archive.verify import Throttle
+
+        throttle = Throttle(10000)
+        start = time.time()
+        for i in range(3):
+            throttle.consume(2000)
+        self.assertGreaterEqual(time.time() - start, 0.35)
+
+
 class TestCreate(unittest.TestCase):
     """Tests the creation of a new file store on disk.
     """
@@ -115,6 +183,40 @@ class TestOpen(unittest.TestCase):
             with self.assertRaises(file_archive.InvalidStore):
                 file_archive.FileStore(d)
 
+    @unittest.skipIf(platform.system() == 'Windows' or os.getuid() == 0,
+                     "Can't make a file read-only")
+    def test_open_readonly(self):
+        import sqlite3
+
+        with temp_dir() as d:
+            file_archive.FileStore.create_store(d)
+            store = file_archive.FileStore(d)
+            store.add_file(BytesIO(b'content'), {'a': 'b'})
+            store.close()
+            # Remove the tables added to the schema later
+            conn = sqlite3.connect(os.path.join(d, 'database'))
+            conn.execute('DROP TABLE verify_ledger')
+            conn.execute('DROP TABLE blob_stats')
+            conn.execute('DROP INDEX metadata_key_str')
+            conn.commit()
+            conn.close()
+            os.chmod(os.path.join(d, 'database'), 0o444)
+            os.chmod(d, 0o555)
+            try:
+                for pool_size in (None, 2):
+                    store = file_archive.FileStore(d, pool_size=pool_size)
+                    try:
+                        entry = store.query_one({'a': 'b'})
+                        self.assertEqual(entry.metadata['a'], 'b')
+                        self.assertEqual(store.metadata.keys(),
+                                         [('a', 'str', 1), ('hash', 'str', 1)])
+                        self.assertTrue(store.verify(quick=True).ok)
+                    finally:
+                        store.close()
+            finally:
+                os.chmod(d, 0o755)
+                os.chmod(os.path.join(d, 'database'), 0o644)
+
 
 class TestStore(unittest.TestCase):
     """Tests opening the store and using it.
@@ -179,6 +281,191 @@ class TestStore(unittest.TestCase):
         self.assertEqual(os.listdir(os.path.join(self.path, 'objects', 'ed')),
                          ['1e24cdb080c9b870598572ee645fb358f8d7dc'])
 
+    def test_hash_cache(self):
+        with temp_dir() as d:
+            for name in ('a', 'b', 'c'):
+                with open(os.path.join(d, name), 'wb') as fp:
+                    fp.write(b'content of %s\n' % name.encode('ascii'))
+            # Recently modified files are not recorded
+            old = time.time() - 60
+            for name in ('a', 'b'):
+                os.utime(os.path.join(d, name), (old, old))
+            dirhash = file_archive.hash_directory(d)
+
+            self.store.hash_cache = True
+            self.assertEqual(self.store.add_directory(d, {})['hash'], dirhash)
+            cached = self.store.metadata.get_cached_hashes(
+                os.path.join(os.path.realpath(d), name)
+                for name in ('a', 'b', 'c'))
+            self.assertEqual(sorted(os.path.basename(p) for p in cached),
+                             ['a', 'b'])
+
+            # Changing a file without changing its size, mtime and inode
+            # shows that it is not read again
+            with open(os.path.join(d, 'a'), 'r+b') as fp:
+                fp.write(b'CONTENT')
+            os.utime(os.path.join(d, 'a'), (old, old))
+            self.assertEqual(self.store.add_directory(d, {'a': 1})['hash'],
+                             dirhash)
+            entry = self.store.add_file(os.path.join(d, 'a'), {})
+            self.assertEqual(
+                entry['hash'],
+                file_archive.hash_file(BytesIO(b'content of a\n')))
+
+            # Once the mtime changes, the file is hashed again
+            os.utime(os.path.join(d, 'a'), (old + 1, old + 1))
+            newhash = file_archive.hash_directory(d)
+            self.assertNotEqual(newhash, dirhash)
+            self.assertEqual(self.store.add_directory(d, {})['hash'], newhash)
+            self.assertEqual(self.store.add_directory(d, {'a': 2})['hash'],
+                             newhash)
+
+            # Records of files that are gone or changed are pruned by gc
+            os.remove(os.path.join(d, 'b'))
+            os.utime(os.path.join(d, 'a'), (old + 2, old + 2))
+            self.assertEqual(self.store.gc(dry_run=True).hash_cache, 2)
+            self.assertEqual(len(self.store.metadata.get_cached_hashes(
+                cached)), 2)
+            self.assertEqual(self.store.gc().hash_cache, 2)
+            self.assertEqual(self.store.metadata.get_cached_hashes(cached),
+                             {})
+            self.assertEqual(self.store.add_directory(d, {})['hash'],
+                             file_archive.hash_directory(d))
+            self.assertEqual(self.store.gc().hash_cache, 0)
+
+            self.store.metadata.clear_hash_cache()
+            self.assertEqual(self.store.metadata.get_cached_hashes(cached),
+                             {})
+
+    def test_map_file(self):
+        entry = self.store.add_file(self.t('file1.bin'), {})
+        with open(self.t('file1.bin'), 'rb') as fp:
+            content = fp.read()
+        m = self.store.map_file(entry.objectid)
+        try:
+            self.assertEqual(m[:], content)
+            with self.assertRaises(TypeError):
+                m[0] = b'x'
+        finally:
+            m.close()
+        self.assertEqual(bytes(entry.mmap()[:]), content)
+
+        entry = self.store.add_directory(self.t('dir4'), {})
+        with open(self.t('dir4/somedir/afile.bin'), 'rb') as fp:
+            content = fp.read()
+        self.assertEqual(
+            self.store.map_file(entry, 'somedir/afile.bin')[:], content)
+        with self.assertRaises(ValueError):
+            self.store.map_file(entry)
+
+        entry = self.store.add_file(BytesIO(b''), {})
+        self.assertEqual(bytes(entry.mmap()), b'')
+
+    def test_read_range(self):
+        entry = self.store.add_file(self.t('file1.bin'), {})
+        with open(self.t('file1.bin'), 'rb') as fp:
+            content = fp.read()
+        self.assertEqual(self.store.read_range(entry.objectid, 5, 9),
+                         content[5:14])
+        self.assertEqual(self.store.read_range(entry, 20), content[20:])
+        self.assertEqual(self.store.read_range(entry, 40, 1000),
+                         content[40:])
+        self.assertEqual(self.store.read_range(entry, 1000, 10), b'')
+        with self.assertRaises(ValueError):
+            self.store.read_range(entry, -1, 10)
+
+        entry = self.store.add_directory(self.t('dir4'), {})
+        with open(self.t('dir4/somedir/afile.bin'), 'rb') as fp:
+            content = fp.read()
+        self.assertEqual(
+            self.store.read_range(entry, 2, 3, 'somedir/afile.bin'),
+            content[2:5])
+
+    def test_disk_usage(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b'})
+        e2 = self.store.add_directory(self.t('dir4'), {'a': 'c'})
+        self.store.add_directory(self.t('dir4'), {'a': 'd'})
+        size1 = os.path.getsize(self.t('file1.bin'))
+        size2 = sum(os.path.getsize(self.t(f)) for f in [
+            'dir4/somefile.bin', 'dir4/somedir/afile.bin',
+            'dir4/somedir/anotherfile.bin'])
+        usage = self.store.disk_usage({'a': 'c'})
+        self.assertEqual(usage, [(e2.objectid, e2['hash'], size2, 3)])
+        self.assertEqual(len(self.store.disk_usage()), 3)
+
+        def query(size):
+            return sorted(e['a'] for e in self.store.query({}, size=size))
+
+        self.assertEqual(query(size1), ['b'])
+        self.assertEqual(query({'lt': size1}), ['c', 'd'])
+        self.assertEqual(query({'gt': size2, 'lt': size1 + 1}), ['b'])
+        self.assertEqual(sorted(e['a'] for e in self.store.query(
+            {'a': 'c'}, size={'lt': size1})), ['c'])
+        with self.assertRaises(ValueError):
+            query({'near': 12})
+
+        # Stores from before sizes were recorded get measured once
+        self.store.metadata.forget_refs([e1['hash'], e2['hash']])
+        self.assertEqual(query(size1), [])
+        self.assertEqual(self.store.disk_usage({'a': 'b'}),
+                         [(e1.objectid, e1['hash'], size1, 1)])
+        self.assertEqual(sorted(u[2:] for u in self.store.disk_usage()),
+                         [(size2, 3), (size2, 3), (size1, 1)])
+        self.assertEqual(query(size1), ['b'])
+
+        # Stats are forgotten with the blob
+        self.store.remove(e1)
+        self.assertEqual(self.store.metadata.get_stats([e1['hash']]), {})
+
+    def test_paging(self):
+        for i in range(25):
+            self.store.add_file(BytesIO(b'file %d' % i), {'i': i, 'k': 'v'})
+        self.store.add_file(BytesIO(b'other'), {'k': 'w'})
+        for conditions in [{}, {'k': 'v'}]:
+            expected = sorted(e.objectid
+                              for e in self.store.query(conditions))
+            pages = []
+            after = None
+            while True:
+                page = [e.objectid for e in self.store.query(
+                    conditions, limit=10, after=after)]
+                pages.append(page)
+                if len(page) < 10:
+                    break
+                after = page[-1]
+            self.assertEqual([len(p) for p in pages],
+                             [10, 10, len(expected) - 20])
+            self.assertEqual(sum(pages, []), expected)
+
+    def test_keys_values(self):
+        for i in range(6):
+            self.store.add_file(BytesIO(b'file %d' % i),
+                                {'i': i % 3, 'k': 'v' if i < 4 else 'w'})
+        self.store.add_file(BytesIO(b'other'), {'k': 12})
+        self.assertEqual(self.store.metadata_keys(),
+                         [('hash', 'str', 7), ('i', 'int', 6),
+                          ('k', 'int', 1), ('k', 'str', 6)])
+        self.assertEqual(self.store.metadata_values('i'),
+                         [(0, 2), (1, 2), (2, 2)])
+        self.assertEqual(self.store.metadata_values('k'),
+                         [('v', 4), ('w', 2), (12, 1)])
+        self.assertEqual(self.store.metadata_values('k', 2),
+                         [('v', 4), ('w', 2)])
+        self.assertEqual(self.store.metadata_values('nope'), [])
+
+        # Changing the results doesn't change the cache
+        del self.store.metadata_keys()[:]
+        self.store.metadata_values('k').sort(key=lambda v: v[1])
+        self.assertEqual(len(self.store.metadata_keys()), 4)
+        self.assertEqual(self.store.metadata_values('k'),
+                         [('v', 4), ('w', 2), (12, 1)])
+
+        # Cached results are dropped on writes
+        self.store.remove_many({'k': 'v'})
+        self.assertEqual(self.store.metadata_values('k'),
+                         [('w', 2), (12, 1)])
+        self.assertEqual(self.store.metadata_keys()[0], ('hash', 'str', 3))
+
     def test_reqs(self):
         def assert_one(cond, expected):
             entry = self.store.query_one(cond)
@@ -308,6 +595,238 @@ class TestStore(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.store.get(oid)
 
+    def test_remove_many(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b', 'n': 1})
+        e2 = self.store.add_file(self.t('file1.bin'), {'a': 'b', 'n': 2})
+        e3 = self.store.add_file(self.t('file2.bin'), {'a': 'b', 'n': 3})
+        e4 = self.store.add_directory(self.t('dir4'), {'a': 'c'})
+        e5 = self.store.add_file(self.t('file2.bin'), {'a': 'c'})
+
+        # e1 still refers to file1, e5 to file2
+        self.assertEqual(
+            self.store.remove_many({'a': 'b', 'n': {'type': 'int', 'gt': 1}}),
+            2)
+        self.assertTrue(os.path.isfile(e1.filename))
+        self.assertTrue(os.path.isfile(e3.filename))
+        self.assertEqual(set(e.objectid for e in self.store.query({})),
+                         set([e1.objectid, e4.objectid, e5.objectid]))
+
+        self.assertEqual(
+            self.store.remove_many(objectids=[e1, e4.objectid, e2.objectid]),
+            2)
+        self.assertFalse(os.path.exists(e1.filename))
+        self.assertFalse(os.path.exists(e4.filename))
+        self.assertEqual(self.store.remove_many({}), 1)
+        self.assertFalse(os.path.exists(e5.filename))
+        self.assertEqual(self.store.remove_many({}), 0)
+        with self.assertRaises(TypeError):
+            self.store.remove_many()
+
+    def test_update_metadata(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b', 'n': 1})
+        e2 = self.store.add_file(self.t('file1.bin'), {'a': 'b', 'n': 2})
+        e3 = self.store.add_file(self.t('file2.bin'), {'a': 'b', 'n': 3})
+        e4 = self.store.add_directory(self.t('dir4'), {'a': 'c'})
+
+        changed = self.store.update_metadata(
+            {'a': 'b', 'n': {'type': 'int', 'gt': 1}},
+            set={'tag': 'x', 'a': 'd'})
+        self.assertEqual(sorted(changed), sorted([e2.objectid, e3.objectid]))
+        new2 = self.store.get(changed[e2.objectid])
+        self.assertEqual(new2.metadata, {'hash': e2['hash'], 'a': 'd',
+                                         'n': 2, 'tag': 'x'})
+        self.assertEqual(new2.objectid,
+                         file_archive.hash_metadata(new2.metadata))
+        with self.assertRaises(KeyError):
+            self.store.get(e2.objectid)
+        self.assertEqual(self.store.get(e1.objectid).metadata, e1.metadata)
+        self.assertTrue(os.path.isfile(e3.filename))
+
+        # Entries that become identical get merged
+        changed = self.store.update_metadata(
+            objectids=[e1, changed[e2.objectid], 'missing'],
+            unset=['n', 'tag'],
+            set={'a': 'e'})
+        self.assertEqual(len(changed), 2)
+        self.assertEqual(len(set(changed.values())), 1)
+        self.assertEqual(
+            sorted(e.metadata.get('a') for e in self.store.query({})),
+            ['c', 'd', 'e'])
+
+        # Back to the metadata of an existing entry
+        new4 = self.store.add_directory(self.t('dir4'), {'a': 'f'})
+        changed = self.store.update_metadata(objectids=[new4],
+                                             set={'a': 'c'})
+        self.assertEqual(changed, {new4.objectid: e4.objectid})
+        self.assertEqual(len(list(self.store.query({'a': 'c'}))), 1)
+        self.assertTrue(os.path.isdir(e4.filename) or
+                        os.path.isfile(e4.filename))
+
+        with self.assertRaises(ValueError):
+            self.store.update_metadata({}, set={'hash': 'abc'})
+        with self.assertRaises(ValueError):
+            self.store.update_metadata({}, set={'a': 'b'}, unset=['a'])
+        with self.assertRaises(TypeError):
+            self.store.update_metadata(set={'a': 'b'})
+
+    def test_verify(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b'})
+        e2 = self.store.add_file(self.t('file2.bin'), {})
+        e3 = self.store.add_directory(self.t('dir4'), {})
+        e5 = self.store.add_file(self.t('file5.bin'), {})
+        progress = []
+        report = self.store.verify(
+            workers=2,
+            progress=lambda *args: progress.append(args))
+        self.assertTrue(report.ok)
+        self.assertTrue(report.complete)
+        self.assertEqual(report.checked, 4)
+        self.assertEqual(len(progress), 4)
+        self.assertEqual(progress[-1][:2], (4, 4))
+
+        # Corrupt some blobs
+        with open(e2.filename, 'ab') as fp:
+            fp.write(b'corrupted')
+        with open(os.path.join(e3.filename, 'somefile.bin'), 'ab') as fp:
+            fp.write(b'corrupted')
+        os.remove(e5.filename)
+        self.store.metadata.remove(e1.objectid)
+        self.store.metadata.add('0' * 40, e1.metadata)
+        report = self.store.verify()
+        self.assertFalse(report.ok)
+        self.assertEqual(report.corrupt, sorted([e2['hash'], e3['hash']]))
+        self.assertEqual(report.missing, [(e5.objectid, e5['hash'])])
+        self.assertEqual(report.orphaned, [])
+        self.assertEqual(report.bad_objectids, ['0' * 40])
+
+        self.store.metadata.remove('0' * 40)
+        report = self.store.verify()
+        self.assertEqual(report.orphaned, [e1['hash']])
+
+    def test_verify_checkpoint(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {})
+        e2 = self.store.add_file(self.t('file2.bin'), {})
+        with open(e1.filename, 'ab') as fp:
+            fp.write(b'corrupted')
+        with temp_dir() as d:
+            checkpoint = os.path.join(d, 'checkpoint')
+            with open(checkpoint, 'w') as fp:
+                fp.write('%s ok\n%s corrupt\n' % (e1['hash'], e2['hash']))
+            report = self.store.verify(checkpoint=checkpoint)
+            self.assertEqual(report.checked, 0)
+            self.assertEqual(report.corrupt, [e2['hash']])
+            self.assertFalse(os.path.exists(checkpoint))
+
+            report = self.store.verify(checkpoint=checkpoint, time_limit=0)
+            self.assertEqual(report.checked, 0)
+            self.assertFalse(report.complete)
+            self.assertTrue(os.path.exists(checkpoint))
+
+            report = self.store.verify(checkpoint=checkpoint)
+            self.assertEqual(report.checked, 2)
+            self.assertEqual(report.corrupt, [e1['hash']])
+            self.assertTrue(report.complete)
+            self.assertFalse(os.path.exists(checkpoint))
+
+    def test_verify_quick(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {})
+        e2 = self.store.add_directory(self.t('dir4'), {})
+        report = self.store.verify(quick=True)
+        self.assertEqual((report.checked, report.skipped), (2, 0))
+        ledger = self.store.metadata.get_verified()
+        self.assertEqual(set(ledger), set([e1['hash'], e2['hash']]))
+
+        report = self.store.verify(quick=True)
+        self.assertEqual((report.checked, report.skipped), (0, 2))
+        self.assertTrue(report.ok)
+
+        # Changing a file in a directory changes the fingerprint
+        somefile = os.path.join(e2.filename, 'somedir', 'afile.bin')
+        with open(somefile, 'ab') as fp:
+            fp.write(b'corrupted')
+        report = self.store.verify(quick=True)
+        self.assertEqual((report.checked, report.skipped), (1, 1))
+        self.assertEqual(report.corrupt, [e2['hash']])
+        self.assertNotIn(e2['hash'], self.store.metadata.get_verified())
+
+        # Old verifications are re-done
+        report = self.store.verify(quick=True, max_age=-1)
+        self.assertEqual((report.checked, report.skipped), (2, 0))
+
+        self.store.remove(e1)
+        self.store.verify(quick=True)
+        self.assertEqual(list(self.store.metadata.get_verified()), [])
+
+    def test_gc(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {})
+        e2 = self.store.add_file(self.t('file2.bin'), {})
+        e3 = self.store.add_directory(self.t('dir4'), {})
+        for entry in (e2, e3):
+            self.store.metadata.remove(entry.objectid)
+        temp = e1.filename + '.tmp0123'
+        shutil.copyfile(self.t('file5.bin'), temp)
+
+        # Recent blobs are kept
+        report = self.store.gc()
+        self.assertEqual(report.removed, [])
+
+        report = self.store.gc(dry_run=True, grace=0)
+        self.assertEqual([n for n, s in report.removed],
+                         sorted([e2['hash'], e3['hash'],
+                                 e1['hash'] + '.tmp0123']))
+        self.assertTrue(os.path.exists(e2.filename))
+        size = report.bytes
+        self.assertTrue(size > 0)
+
+        with temp_dir() as d:
+            quarantine = os.path.join(d, 'quarantine')
+            report = self.store.gc(quarantine=quarantine, grace=0)
+            self.assertEqual(report.bytes, size)
+            self.assertFalse(os.path.exists(e2.filename))
+            self.assertFalse(os.path.exists(e3.filename))
+            self.assertFalse(os.path.exists(temp))
+            self.assertTrue(os.path.isdir(os.path.join(quarantine,
+                                                       e3['hash'])))
+        self.assertTrue(os.path.exists(e1.filename))
+
+        self.store.remove(e1)
+        self.store.add_file(self.t('file1.bin'), {})
+        self.assertEqual(self.store.gc(grace=0).removed, [])
+
+    def test_deferred_delete(self):
+        self.store.deferred_delete = True
+        e1 = self.store.add_file(self.t('file1.bin'), {})
+        e2 = self.store.add_directory(self.t('dir4'), {})
+        self.store.remove(e1)
+        self.store.remove(e2)
+        self.assertFalse(os.path.exists(e1.filename))
+        self.assertFalse(os.path.exists(e2.filename))
+        self.assertEqual(len(os.listdir(self.store._trash)), 2)
+
+        # Blobs can be added back while the old ones are in the trash
+        e1 = self.store.add_file(self.t('file1.bin'), {})
+        self.assertTrue(os.path.isfile(e1.filename))
+
+        report = self.store.gc(grace=0)
+        self.assertEqual(report.removed, [])
+        self.assertEqual(report.trash, 2)
+        self.assertEqual(os.listdir(self.store._trash), [])
+
+        self.store.remove(e1)
+        self.assertEqual(self.store.empty_trash(), (1, 49))
+
+    def test_reaper(self):
+        self.store.deferred_delete = True
+        self.store.start_reaper()
+        entry = self.store.add_directory(self.t('dir4'), {})
+        self.store.remove(entry)
+        for _ in range(100):
+            if not os.listdir(self.store._trash):
+                break
+            time.sleep(0.05)
+        else:
+            self.fail("Reaper didn't empty the trash")
+
     @requires_symlink
     def test_internal_symlink(self):
         with temp_dir() as d:
@@ -355,3 +874,605 @@ class TestStore(unittest.TestCase):
                     file_archive.UsageWarning)
                 with self.assertRaises(ValueError):
                     self.store.add_directory(d, {'some': 'data'})
+
+
+class TestCompressedStore(unittest.TestCase):
+    """Tests a store with compression enabled.
+    """
+    def setUp(self):
+        from file_archive.compression import Compression
+
+        self.path = tempfile.mkdtemp(prefix='test_file_archive_')
+        file_archive.FileStore.create_store(
+            self.path,
+            compression=Compression('gzip', min_size=64, block_size=1000))
+        self.store = file_archive.FileStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.store = None
+        shutil.rmtree(self.path)
+
+    def test_compressed(self):
+        from file_archive.blobs import MAGIC
+
+        content = b''.join(b'line %d,some,csv,data\n' % i
+                           for i in range(1000))
+        entry = self.store.add_file(BytesIO(content), {})
+        self.assertEqual(entry['hash'],
+                         file_archive.hash_file(BytesIO(content)))
+        with open(entry.filename, 'rb') as fp:
+            self.assertEqual(fp.read(len(MAGIC)), MAGIC)
+        self.assertLess(os.path.getsize(entry.filename), len(content) // 3)
+
+        fp = entry.open()
+        try:
+            self.assertEqual(fp.read(), content)
+            fp.seek(10005)
+            self.assertEqual(fp.read(10), content[10005:10015])
+        finally:
+            fp.close()
+        fp = self.store.open_file(entry.objectid, binary=False)
+        try:
+            self.assertEqual(fp.readline(), 'line 0,some,csv,data\n')
+        finally:
+            fp.close()
+        self.assertEqual(self.store.read_range(entry, 15000, 30),
+                         content[15000:15030])
+        m = self.store.map_file(entry.objectid)
+        self.assertTrue(m.readonly)
+        self.assertEqual(m.tobytes(), content)
+        self.assertTrue(self.store.verify().ok)
+
+    def test_not_compressed(self):
+        from file_archive.blobs import MAGIC
+
+        # Small
+        entry = self.store.add_file(BytesIO(b'short'), {})
+        with open(entry.filename, 'rb') as fp:
+            self.assertEqual(fp.read(), b'short')
+
+        # Incompressible
+        content = os.urandom(5000)
+        entry = self.store.add_file(BytesIO(content), {})
+        self.assertEqual(os.path.getsize(entry.filename), 5000)
+        fp = entry.open()
+        try:
+            self.assertEqual(fp.read(), content)
+        finally:
+            fp.close()
+
+        # Looks like an encoded blob
+        content = MAGIC + b'compressed gzip 1000\n'
+        entry = self.store.add_file(BytesIO(content), {})
+        fp = entry.open()
+        try:
+            self.assertEqual(fp.read(), content)
+        finally:
+            fp.close()
+        self.assertTrue(self.store.verify().ok)
+
+    def test_reopen(self):
+        from file_archive.compression import Compression
+
+        content = b''.join(b'line %d,some,csv,data\n' % i
+                           for i in range(1000))
+        with temp_dir() as d:
+            path = os.path.join(d, 'store')
+            file_archive.FileStore.create_store(
+                path,
+                compression=Compression('gzip', skip_extensions=['.log'],
+                                        max_ratio=0.5))
+            store = file_archive.FileStore(path)
+            try:
+                self.assertEqual(store.compression.skip_extensions,
+                                 frozenset(['.log']))
+                self.assertEqual(store.compression.max_ratio, 0.5)
+                for name in ('server.log', 'data.png'):
+                    with open(os.path.join(d, name), 'wb') as fp:
+                        fp.write(content + name.encode('ascii'))
+                entry = store.add_file(os.path.join(d, 'server.log'), {})
+                self.assertGreater(os.path.getsize(entry.filename),
+                                   len(content))
+                entry = store.add_file(os.path.join(d, 'data.png'), {})
+                self.assertLess(os.path.getsize(entry.filename),
+                                len(content) // 3)
+            finally:
+                store.close()
+
+    def test_invalid_codec(self):
+        with temp_dir() as d:
+            with self.assertRaises(ValueError):
+                file_archive.FileStore.create_store(os.path.join(d, 'store'),
+                                                    compression='nope')
+
+    def test_unavailable_codec(self):
+        self.store.metadata.set_config({'compression.codec': 'nope'})
+        with self.assertRaises(file_archive.InvalidStore):
+            file_archive.FileStore(self.path)
+
+
+class TestChunkedStore(unittest.TestCase):
+    """Tests a store with chunking enabled.
+    """
+    def setUp(self):
+        from file_archive.chunking import Chunking
+
+        self.path = tempfile.mkdtemp(prefix='test_file_archive_')
+        file_archive.FileStore.create_store(
+            self.path,
+            chunking=Chunking(avg_size=1024, threshold=4096))
+        self.store = file_archive.FileStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.store = None
+        shutil.rmtree(self.path)
+
+    def chunks(self):
+        chunks = set()
+        for dirpath, _dirnames, filenames in os.walk(
+                os.path.join(self.path, 'objects', 'chunks')):
+            chunks.update(filenames)
+        return chunks
+
+    def test_chunking(self):
+        from file_archive.chunking import Chunking, iter_chunks
+
+        chunking = Chunking(avg_size=1024)
+        content = random_bytes(100000)
+        chunks = list(iter_chunks(BytesIO(content), chunking))
+        self.assertEqual(b''.join(chunks), content)
+        self.assertTrue(all(len(c) <= 8192 for c in chunks))
+        self.assertTrue(all(len(c) >= 256 for c in chunks[:-1]))
+
+        # Cut points only depend on nearby content
+        edited = content[:50000] + b'edit' + content[50000:]
+        edited_chunks = list(iter_chunks(BytesIO(edited), chunking))
+        self.assertLessEqual(len(set(edited_chunks) - set(chunks)), 2)
+
+        with self.assertRaises(ValueError):
+            Chunking(avg_size=1000)
+
+    def test_chunking_vectorized(self):
+        from file_archive.chunking import Chunking, _get_gear_array
+
+        if _get_gear_array() is False:
+            self.skipTest("numpy is not available")
+        content = bytearray(random_bytes(100000))
+        for chunking in (Chunking(avg_size=1024), Chunking(avg_size=64),
+                         Chunking(avg_size=256, min_size=16)):
+            start = 0
+            while start < len(content):
+                cut = chunking.find_cut(content, start, len(content),
+                                        vectorized=False)
+                self.assertEqual(
+                    chunking.find_cut(content, start, len(content)), cut)
+                start = cut
+
+    def test_chunked(self):
+        content1 = random_bytes(100000)
+        content2 = content1[:50000] + b'edit' + content1[50000:]
+        e1 = self.store.add_file(BytesIO(content1), {'v': 1})
+        nb_chunks = len(self.chunks())
+        self.assertGreater(nb_chunks, 10)
+        e2 = self.store.add_file(BytesIO(content2), {'v': 2})
+        self.assertEqual(e1['hash'],
+                         file_archive.hash_file(BytesIO(content1)))
+        self.assertLessEqual(len(self.chunks()), nb_chunks + 2)
+
+        fp = self.store.open_file(e2.objectid)
+        try:
+            self.assertEqual(fp.read(), content2)
+            fp.seek(49990)
+            self.assertEqual(fp.read(20), content2[49990:50010])
+        finally:
+            fp.close()
+        self.assertEqual(self.store.read_range(e2, 70000, 10000),
+                         content2[70000:80000])
+        self.assertTrue(self.store.verify().ok)
+
+        # Small files are stored whole
+        e3 = self.store.add_file(BytesIO(b'small'), {})
+        with open(e3.filename, 'rb') as fp:
+            self.assertEqual(fp.read(), b'small')
+
+        # Shared chunks are kept until no blob refers to them
+        self.store.remove(e1)
+        self.assertLessEqual(len(self.chunks()), nb_chunks + 2)
+        fp = e2.open()
+        try:
+            self.assertEqual(fp.read(), content2)
+        finally:
+            fp.close()
+        self.assertEqual(self.store.gc(grace=0).removed, [])
+        self.store.remove(e2)
+        self.assertEqual(self.chunks(), set())
+
+    def test_verify_quick(self):
+        entry = self.store.add_file(BytesIO(random_bytes(20000)), {})
+        self.assertTrue(self.store.verify().ok)
+        report = self.store.verify(quick=True)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.skipped, 1)
+
+        # Corrupt a chunk in place; the manifest doesn't change
+        chunk = None
+        for dirpath, _dirnames, filenames in os.walk(
+                os.path.join(self.path, 'objects', 'chunks')):
+            if filenames:
+                chunk = os.path.join(dirpath, filenames[0])
+                break
+        st = os.stat(chunk)
+        with open(chunk, 'r+b') as fp:
+            fp.write(b'corrupted')
+        # Make sure the mtime changes, even with a coarse resolution
+        os.utime(chunk, (st.st_atime, st.st_mtime + 2))
+        report = self.store.verify(quick=True)
+        self.assertEqual(report.corrupt, [entry['hash']])
+        self.assertEqual(report.skipped, 0)
+
+    def test_gc_chunks(self):
+        entry = self.store.add_file(BytesIO(os.urandom(20000)), {})
+        self.store.metadata.remove(entry.objectid)
+        nb_chunks = len(self.chunks())
+        report = self.store.gc(grace=0)
+        self.assertEqual(len(report.removed), nb_chunks + 1)
+        self.assertEqual(self.chunks(), set())
+        self.assertFalse(os.path.exists(entry.filename))
+
+
+class TestManifestStore(unittest.TestCase):
+    """Tests a store keeping directories as manifests.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test_file_archive_')
+        file_archive.FileStore.create_store(self.path,
+                                            directory_manifests=True)
+        self.store = file_archive.FileStore(self.path)
+        testfiles = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'testfiles')
+        self.t = lambda f: os.path.join(testfiles, f)
+
+    def tearDown(self):
+        self.store.close()
+        self.store = None
+        shutil.rmtree(self.path)
+
+    def blobs(self):
+        return set(name for name, _entry in self.store._iter_blobs())
+
+    def read(self, entry, path):
+        with self.store.open_file(entry.objectid, path) as fp:
+            return fp.read()
+
+    def test_manifests(self):
+        e3 = self.store.add_directory(self.t('dir3'), {'d': 3})
+        # Same hash as when the directory is copied
+        self.assertEqual(e3['hash'],
+                         'ed1e24cdb080c9b870598572ee645fb358f8d7dc')
+        self.assertTrue(e3.isdir())
+        self.assertEqual(len(self.blobs()), 3)
+        e4 = self.store.add_directory(self.t('dir4'), {'d': 4})
+        # dir3/firstfile.bin is dir4/somedir/anotherfile.bin
+        self.assertEqual(len(self.blobs()), 3 + 5 - 1)
+
+        with open(self.t('dir4/somedir/afile.bin'), 'rb') as fp:
+            content = fp.read()
+        self.assertEqual(self.read(e4, 'somedir/afile.bin'), content)
+        self.assertEqual(self.read(e4, 'somedir/../somedir/afile.bin'),
+                         content)
+        with self.assertRaises(IOError):
+            self.store.open_file(e4.objectid, 'somedir/missing')
+        with self.assertRaises(IOError):
+            self.store.open_file(e4.objectid, 'somedir')
+        with self.assertRaises(ValueError):
+            self.store.open_file(e4.objectid)
+        self.assertTrue(self.store.verify().ok)
+
+        with temp_dir() as d:
+            self.store.extract(e4, os.path.join(d, 'dir4'))
+            self.assertEqual(
+                file_archive.hash_directory(os.path.join(d, 'dir4')),
+                e4['hash'])
+
+        self.assertEqual(self.store.disk_usage({'d': 4})[0][2:],
+                         self.store._measure_blob(e4.filename))
+
+        # Shared blobs are kept until no directory refers to them
+        self.store.remove(e3)
+        self.assertEqual(len(self.blobs()), 5)
+        self.assertEqual(self.store.gc(grace=0).removed, [])
+        with open(self.t('dir3/firstfile.bin'), 'rb') as fp:
+            self.assertEqual(self.read(e4, 'somedir/anotherfile.bin'),
+                             fp.read())
+        self.assertEqual(self.store.remove_many(objectids=[e4.objectid]), 1)
+        self.assertEqual(self.blobs(), set())
+
+    @requires_symlink
+    def test_links(self):
+        with temp_dir() as d:
+            shutil.copyfile(self.t('file1.bin'), os.path.join(d, 'file'))
+            os.mkdir(os.path.join(d, 'dir'))
+            os.symlink(os.path.join(d, 'file'), os.path.join(d, 'dir', 'link'))
+            os.symlink('.', os.path.join(d, 'dir', 'self'))
+            entry = self.store.add_directory(d, {})
+            self.assertEqual(entry['hash'], file_archive.hash_directory(d))
+        with open(self.t('file1.bin'), 'rb') as fp:
+            content = fp.read()
+        self.assertEqual(self.read(entry, 'dir/link'), content)
+        self.assertEqual(self.read(entry, 'dir/self/self/link'), content)
+
+        with temp_dir() as d:
+            self.store.extract(entry.objectid, os.path.join(d, 'e'))
+            self.assertTrue(os.path.islink(os.path.join(d, 'e', 'dir',
+                                                        'link')))
+            self.assertEqual(
+                file_archive.hash_directory(os.path.join(d, 'e')),
+                entry['hash'])
+
+    def test_verify_missing_child(self):
+        entry = self.store.add_directory(self.t('dir3'), {})
+        with open(self.t('dir3/secondfile.bin'), 'rb') as fp:
+            filehash = file_archive.hash_file(fp)
+        os.remove(self.store._make_filename(filehash))
+        report = self.store.verify()
+        self.assertFalse(report.ok)
+        self.assertEqual(report.missing, [(None, filehash)])
+
+        # Adding it again stores the missing file
+        self.store.add_directory(self.t('dir3'), {})
+        self.assertTrue(self.store.verify().ok)
+        self.assertTrue(os.path.exists(entry.filename))
+
+
+class TestHashAlgorithm(unittest.TestCase):
+    """Tests a store using SHA-256 instead of SHA1.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test_file_archive_')
+        file_archive.FileStore.create_store(self.path,
+                                            directory_manifests=True,
+                                            hash_algorithm='sha256')
+        self.store = file_archive.FileStore(self.path)
+        testfiles = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'testfiles')
+        self.t = lambda f: os.path.join(testfiles, f)
+
+    def tearDown(self):
+        self.store.close()
+        self.store = None
+        shutil.rmtree(self.path)
+
+    def test_sha256(self):
+        import hashlib
+
+        self.assertEqual(self.store.hash_algorithm.name, 'sha256')
+        with open(self.t('file1.bin'), 'rb') as fp:
+            content = fp.read()
+        entry = self.store.add_file(self.t('file1.bin'), {'a': 'b'})
+        filehash = hashlib.sha256(b'file\n' + content).hexdigest()
+        self.assertEqual(entry['hash'], filehash)
+        self.assertEqual(entry.objectid,
+                         file_archive.hash_metadata(entry.metadata, 'sha256'))
+        self.assertEqual(len(entry.objectid), 64)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.path, 'objects', filehash[:2], filehash[2:])))
+
+        d = self.store.add_directory(self.t('dir3'), {})
+        self.assertEqual(d['hash'],
+                         file_archive.hash_directory(self.t('dir3'),
+                                                     algorithm='sha256'))
+        self.assertEqual(len(d['hash']), 64)
+
+        changed = self.store.update_metadata(objectids=[entry],
+                                             set={'a': 'c'})
+        self.assertEqual(changed[entry.objectid],
+                         file_archive.hash_metadata({'hash': filehash,
+                                                     'a': 'c'},
+                                                    'sha256'))
+        self.assertTrue(self.store.verify().ok)
+
+        # The algorithm is recorded in the store
+        self.store.close()
+        self.store = file_archive.FileStore(self.path)
+        self.assertEqual(self.store.hash_algorithm.name, 'sha256')
+        self.assertTrue(self.store.verify().ok)
+
+    def test_convert(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b'})
+        e2 = self.store.add_file(self.t('file1.bin'), {'a': 'c'})
+        e3 = self.store.add_directory(self.t('dir3'), {'d': 3})
+        progress = []
+
+        with temp_dir() as d:
+            dest = os.path.join(d, 'store')
+            newids = self.store.convert(
+                dest, 'sha1', progress=lambda *a: progress.append(a))
+            self.assertEqual(progress, [(1, 2), (2, 2)])
+            self.assertEqual(set(newids),
+                             set([e1.objectid, e2.objectid, e3.objectid]))
+            store = file_archive.FileStore(dest)
+            try:
+                self.assertEqual(store.hash_algorithm.name, 'sha1')
+                self.assertTrue(store.directory_manifests)
+                # Same hashes as in a store created with SHA1
+                self.assertEqual(store.get(newids[e1.objectid]).metadata,
+                                 {'hash': 'fce92fa2647153f7d696a3c1884d732290'
+                                          '273102',
+                                  'a': 'b'})
+                self.assertEqual(store.get(newids[e2.objectid])['a'], 'c')
+                self.assertEqual(store.get(newids[e3.objectid])['hash'],
+                                 'ed1e24cdb080c9b870598572ee645fb358f8d7dc')
+                self.assertTrue(store.verify().ok)
+            finally:
+                store.close()
+
+    def test_invalid_algorithm(self):
+        from file_archive.database import MetadataStore
+
+        with temp_dir() as d:
+            with self.assertRaises(ValueError):
+                file_archive.FileStore.create_store(os.path.join(d, 'store'),
+                                                    hash_algorithm='nope')
+            self.assertFalse(os.path.exists(os.path.join(d, 'store')))
+
+            file_archive.FileStore.create_store(d)
+            metadata = MetadataStore(os.path.join(d, 'database'))
+            metadata.set_config({'hash.algorithm': 'nope'})
+            metadata.close()
+            with self.assertRaises(file_archive.InvalidStore):
+                file_archive.FileStore(d)
+
+
+class TestPooledStore(unittest.TestCase):
+    """Tests sharing a store between threads.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test_file_archive_')
+        file_archive.FileStore.create_store(self.path)
+        self.store = file_archive.FileStore(self.path, pool_size=3)
+        testfiles = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'testfiles')
+        self.t = lambda f: os.path.join(testfiles, f)
+
+    def tearDown(self):
+        self.store.close()
+        self.store = None
+        shutil.rmtree(self.path)
+
+    def run_threads(self, func, nb):
+        errors = []
+
+        def wrapper(i):
+            try:
+                func(i)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=wrapper, args=(i,))
+                   for i in range(nb)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_threads(self):
+        files = ['file1.bin', 'file2.bin', 'dir3', 'file5.bin']
+
+        def add(i):
+            self.store.add(self.t(files[i % len(files)]), {'nb': i})
+        self.run_threads(add, 16)
+
+        def query(i):
+            entries = list(self.store.query({'nb': {'type': 'int',
+                                                    'lt': 8}}))
+            self.assertEqual(len(entries), 8)
+            entry = self.store.query_one({'nb': i})
+            self.assertEqual(entry.metadata['nb'], i)
+            self.assertEqual(self.store.get(entry.objectid).metadata,
+                             entry.metadata)
+        self.run_threads(query, 8)
+
+        def remove(i):
+            self.store.remove(self.store.query_one({'nb': i}))
+            self.store.add(self.t(files[i % len(files)]), {'nb': i + 16})
+        self.run_threads(remove, 16)
+
+        self.assertEqual(len(list(self.store.query({}))), 16)
+        for i, f in enumerate(files):
+            entry = self.store.query_one({'nb': i + 16})
+            self.assertTrue(os.path.exists(entry.filename))
+
+    def test_close_pool(self):
+        from file_archive.database import ConnectionPool
+
+        pool = ConnectionPool(os.path.join(self.path, 'database'), 2)
+        idle = pool.acquire()
+        busy = pool.acquire()
+        pool.release(idle)
+        pool.close()
+        with self.assertRaises(Exception):
+            idle.execute('SELECT 1')
+        busy.execute('SELECT 1')
+        pool.release(busy)
+        with self.assertRaises(Exception):
+            busy.execute('SELECT 1')
+
+
+class TestGroupCommit(unittest.TestCase):
+    """Tests batching writes from concurrent threads.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='test_file_archive_')
+        file_archive.FileStore.create_store(self.path)
+        testfiles = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'testfiles')
+        self.t = lambda f: os.path.join(testfiles, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_wait(self):
+        # The delay is long enough that the batch only gets committed once
+        # all the threads have queued their write
+        store = file_archive.FileStore(
+            self.path, pool_size=2,
+            group_commit=file_archive.GroupCommit(delay=600, max_entries=10))
+        errors = []
+
+        def add(i):
+            try:
+                store.add_file(self.t('file1.bin'), {'nb': i})
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+                # Don't leave the other threads waiting for the batch
+                store.flush()
+
+        try:
+            threads = [threading.Thread(target=add, args=(i,))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:  # pragma: no cover
+                raise errors[0]
+            self.assertEqual(len(list(store.query({}))), 10)
+            self.assertEqual(store.metadata._writer.commits, 1)
+        finally:
+            store.close()
+
+        # Commit each write right away
+        store = file_archive.FileStore(
+            self.path, pool_size=2,
+            group_commit=file_archive.GroupCommit(max_entries=1))
+        try:
+            entry = store.query_one({'nb': 3})
+            store.remove(entry)
+            with self.assertRaises(KeyError):
+                store.remove(entry)
+            self.assertEqual(len(list(store.query({}))), 9)
+            self.assertEqual(store.metadata._writer.commits, 2)
+        finally:
+            store.close()
+
+    def test_fire_and_forget(self):
+        store = file_archive.FileStore(
+            self.path,
+            group_commit=file_archive.GroupCommit(delay=10, max_entries=5,
+                                                  wait=False))
+        try:
+            for i in range(12):
+                store.add_file(self.t('file1.bin'), {'nb': i})
+            store.flush()
+            self.assertEqual(len(list(store.query({}))), 12)
+            self.assertEqual(store.metadata._writer.commits, 3)
+
+            # Removing waits for previous additions
+            store.add_file(self.t('file2.bin'), {})
+            store.remove(store.query_one({'nb': 0}))
+            self.assertEqual(len(list(store.query({}))), 12)
+        finally:
+            store.close()
@@ -2,9 +2,11 @@ from __future__ import division, unicode_literals
 
 import contextlib
 import os
+import subprocess
 import sys
 import tempfile
 import shutil
+import time
 try:
     import unittest2 as unittest
 except ImportError:
@@ -41,6 +43,41 @@ def run_program(*args, **kwargs):
             kwargs['err'].extend(read(err))
 
 
+class TestStartup(unittest.TestCase):
+    """Checks that the command-line doesn't import slow modules on startup.
+    """
+    # Cumulative import time of the entry point, in microseconds
+    BUDGET = 150000
+
+    SLOW_MODULES = ['pkg_resources', 'gettext', 'json', 'tempfile', 'shutil',
+                    'tdparser']
+
+    @unittest.skipIf(sys.version_info < (3, 7), "-X importtime unavailable")
+    def test_import_time(self):
+        top_level = os.path.dirname(os.path.dirname(os.path.abspath(
+            __file__)))
+        proc = subprocess.Popen(
+            [sys.executable, '-X', 'importtime',
+             '-c', 'import file_archive.entry_point'],
+            cwd=top_level,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+
+        times = {}
+        for line in err.decode('utf-8').splitlines():
+            if not line.startswith('import time:'):
+                continue
+            _self, cumulative, module = line[12:].split('|')
+            if cumulative.strip().isdigit():  # skip the header line
+                times[module.strip()] = int(cumulative)
+
+        for module in self.SLOW_MODULES:
+            self.assertNotIn(module, times,
+                             "%s imported on startup" % module)
+        self.assertLess(times['file_archive.entry_point'], self.BUDGET)
+
+
 class TestUsage(unittest.TestCase):
     def test_noargs(self):
         self.assertEqual(run_program(), 1)
@@ -55,6 +92,43 @@ class TestCreate(unittest.TestCase):
             self.assertEqual(run_program(d, 'create'), 0)
             self.assertTrue(os.path.isfile(os.path.join(d, 'database')))
 
+    def test_create_compressed(self):
+        with temp_dir() as d:
+            self.assertEqual(run_program(d, 'create', '-z', 'gzip'), 0)
+            store = FileStore(d)
+            try:
+                self.assertEqual(store.compression.codec, 'gzip')
+            finally:
+                store.close()
+        with temp_dir() as d:
+            self.assertEqual(run_program(d, 'create', '-z', 'nope'), 3)
+            self.assertEqual(run_program(d, 'create', '-z'), 1)
+        with temp_dir() as d:
+            self.assertEqual(run_program(d, 'create', '-c', '-z', 'gzip'), 0)
+            store = FileStore(d)
+            try:
+                self.assertEqual(store.chunking.avg_size, 1 << 20)
+                self.assertFalse(store.directory_manifests)
+            finally:
+                store.close()
+        with temp_dir() as d:
+            self.assertEqual(run_program(d, 'create', '-d'), 0)
+            store = FileStore(d)
+            try:
+                self.assertTrue(store.directory_manifests)
+            finally:
+                store.close()
+        with temp_dir() as d:
+            self.assertEqual(run_program(d, 'create', '-H', 'sha256'), 0)
+            store = FileStore(d)
+            try:
+                self.assertEqual(store.hash_algorithm.name, 'sha256')
+            finally:
+                store.close()
+        with temp_dir() as d:
+            self.assertEqual(run_program(d, 'create', '-H', 'nope'), 3)
+            self.assertEqual(run_program(d, 'create', '-H'), 1)
+
     def test_create_nonempty(self):
         with temp_dir() as d:
             with open(os.path.join(d, 'somefile'), 'wb') as fp:
@@ -101,9 +175,36 @@ class TestStore(unittest.TestCase):
             self.store.get(o1).metadata,
             {'hash': h1, 'a': 'b'})
 
+    def test_putfile_hash_cache(self):
+        with temp_dir() as d:
+            filename = os.path.join(d, 'file1.bin')
+            shutil.copyfile(self.t('file1.bin'), filename)
+            old = time.time() - 60
+            os.utime(filename, (old, old))
+            out = []
+            self.assertEqual(
+                run_program(self.path, 'add', '-c', filename, 'a=b',
+                            out=out),
+                0)
+            h1 = 'fce92fa2647153f7d696a3c1884d732290273102'
+            o1 = '8ce67dc4c67401ff8122ecebc98ecee506211f88'
+            self.assertEqual(out, [o1])
+            self.assertEqual(
+                self.store.get(o1).metadata,
+                {'hash': h1, 'a': 'b'})
+            cached = self.store.metadata.get_cached_hashes(
+                [os.path.realpath(filename)])
+            self.assertEqual([r[3] for r in cached.values()], [h1])
+
     def test_wrongpath(self):
         self.assertEqual(run_program(self.path, 'add', 'nonexistentpath-fa'),
                          1)
+        self.assertEqual(run_program(self.path, 'add', '-c',
+                                     'nonexistentpath-fa'),
+                         1)
+        self.assertEqual(run_program(self.path, 'add', '-x',
+                                     self.t('file1.bin')),
+                         1)
 
     def test_query(self):
         self.store.add_file(self.t('file1.bin'), {'tag': 'test', 'test': 1})
@@ -145,7 +246,192 @@ class TestStore(unittest.TestCase):
                           '    }',
                           '}'])
 
-    # TODO : print
+    def test_verify(self):
+        entry = self.store.add_file(self.t('file1.bin'), {})
+        self.store.add_directory(self.t('dir3'), {})
+        self.assertEqual(run_program(self.path, 'verify', '-j', '2'), 0)
+        self.assertEqual(run_program(self.path, 'verify', '-q', '-a', '1'), 0)
+
+        with open(entry.filename, 'ab') as fp:
+            fp.write(b'corrupted')
+        out = []
+        self.assertEqual(run_program(self.path, 'verify', out=out), 4)
+        self.assertEqual(out, ['corrupt\t%s' % entry['hash']])
+
+        self.assertEqual(run_program(self.path, 'verify', '-j'), 1)
+        self.assertEqual(run_program(self.path, 'verify', '-j', 'two'), 1)
+
+    def test_gc(self):
+        entry = self.store.add_file(self.t('file1.bin'), {})
+        self.store.metadata.remove(entry.objectid)
+        out = []
+        self.assertEqual(run_program(self.path, 'gc', '-n', '-g', '0',
+                                     out=out), 0)
+        self.assertEqual(out, ['%s\t%d' % (entry['hash'], 49)])
+        self.assertTrue(os.path.exists(entry.filename))
+        self.assertEqual(run_program(self.path, 'gc', '-g', '0'), 0)
+        self.assertFalse(os.path.exists(entry.filename))
+
+        self.assertEqual(run_program(self.path, 'gc', '-g'), 1)
+
+        entry = self.store.add_file(self.t('file1.bin'), {})
+        self.assertEqual(run_program(self.path, 'remove', '-d',
+                                     entry.objectid), 0)
+        self.assertFalse(os.path.exists(entry.filename))
+        trash = os.path.join(self.path, 'objects', 'trash')
+        self.assertEqual(len(os.listdir(trash)), 1)
+        self.assertEqual(run_program(self.path, 'gc'), 0)
+        self.assertEqual(os.listdir(trash), [])
+
+    def test_du(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b'})
+        e2 = self.store.add_directory(self.t('dir3'), {'a': 'c'})
+        self.store.add_directory(self.t('dir3'), {'a': 'd'})
+        size1 = os.path.getsize(self.t('file1.bin'))
+        size2 = sum(os.path.getsize(self.t(f)) for f in [
+            'dir3/firstfile.bin', 'dir3/secondfile.bin'])
+        out = []
+        self.assertEqual(run_program(self.path, 'du', 'a=b', out=out), 0)
+        self.assertEqual(out, ['%d\t1\t%s' % (size1, e1.objectid),
+                               '%d\t1\ttotal' % size1])
+        out = []
+        self.assertEqual(run_program(self.path, 'du', '-s', out=out), 0)
+        self.assertEqual(out, ['%d\t3\ttotal' % (size1 + size2)])
+
+        out = []
+        self.assertEqual(run_program(self.path, 'query', '-s', '>%d' % size1,
+                                     'a=c', out=out), 0)
+        self.assertEqual(out[0], e2.objectid)
+        self.assertEqual(run_program(self.path, 'query', '-s', '>a'), 1)
+
+    def test_keys_values(self):
+        self.store.add_file(self.t('file1.bin'), {'a': 'b', 'n': 1})
+        self.store.add_file(self.t('file2.bin'), {'a': 'b'})
+        self.store.add_directory(self.t('dir3'), {'a': 'c', 'n': 'one'})
+        out = []
+        self.assertEqual(run_program(self.path, 'keys', out=out), 0)
+        self.assertEqual(out, ['a\tstr\t3', 'hash\tstr\t3', 'n\tint\t1',
+                               'n\tstr\t1'])
+        out = []
+        self.assertEqual(run_program(self.path, 'values', 'a', out=out), 0)
+        self.assertEqual(out, ['2\tb', '1\tc'])
+        out = []
+        self.assertEqual(run_program(self.path, 'values', '-t', '-n', '1',
+                                     'n', out=out), 0)
+        self.assertEqual(out, ['1\tint:1'])
+        self.assertEqual(run_program(self.path, 'values'), 1)
+        self.assertEqual(run_program(self.path, 'values', '-n', 'x', 'a'), 1)
+        self.assertEqual(run_program(self.path, 'values', '-n', '0', 'a'), 1)
+        self.assertEqual(run_program(self.path, 'keys', 'a'), 1)
+
+    def test_tag(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b', 'n': 1})
+        e2 = self.store.add_file(self.t('file2.bin'), {'a': 'c'})
+        out = []
+        self.assertEqual(run_program(self.path, 'tag', '-s', 'k=int:3',
+                                     '-u', 'n', e1.objectid, out=out), 0)
+        self.assertEqual(len(out), 1)
+        old, new = out[0].split('\t')
+        self.assertEqual(old, e1.objectid)
+        self.assertEqual(self.store.get(new).metadata,
+                         {'hash': e1['hash'], 'a': 'b', 'k': 3})
+
+        out = []
+        self.assertEqual(run_program(self.path, 'tag', '-s', 'd=e',
+                                     'a=c', out=out), 0)
+        self.assertEqual([line.split('\t')[0] for line in out],
+                         [e2.objectid])
+        self.assertEqual(run_program(self.path, 'tag', '-s', 'd=e'), 1)
+        self.assertEqual(run_program(self.path, 'tag', '-f', '-s', 'd=f',
+                                     out=out), 0)
+        self.assertEqual(sorted(e['d'] for e in self.store.query({})),
+                         ['f', 'f'])
+        self.assertEqual(run_program(self.path, 'tag', 'a=b'), 1)
+        self.assertEqual(run_program(self.path, 'tag', '-u', 'hash',
+                                     'a=b'), 1)
+        self.assertEqual(run_program(self.path, 'tag', '-s', 'd=g',
+                                     'notanobjectid'), 2)
+
+    def test_convert(self):
+        e1 = self.store.add_file(self.t('file1.bin'), {'a': 'b'})
+        with temp_dir() as d:
+            dest = os.path.join(d, 'store')
+            out = []
+            self.assertEqual(run_program(self.path, 'convert', '-H', 'sha256',
+                                         dest, out=out), 0)
+            self.assertEqual(len(out), 1)
+            old, new = out[0].split('\t')
+            self.assertEqual(old, e1.objectid)
+            store = FileStore(dest)
+            try:
+                self.assertEqual(store.hash_algorithm.name, 'sha256')
+                self.assertEqual(store.get(new)['a'], 'b')
+            finally:
+                store.close()
+            self.assertEqual(run_program(self.path, 'convert', '-H', 'nope',
+                                         os.path.join(d, 'other')), 1)
+
+            # An algorithm whose module is not installed
+            from file_archive import hashing
+
+            def missing():
+                raise ImportError("No module named 'missing'")
+            hashing._factories['missing'] = missing
+            try:
+                self.assertEqual(
+                    run_program(self.path, 'convert', '-H', 'missing',
+                                os.path.join(d, 'other')),
+                    1)
+            finally:
+                del hashing._factories['missing']
+            self.assertFalse(os.path.exists(os.path.join(d, 'other')))
+            self.assertEqual(run_program(self.path, 'convert', dest), 3)
+            self.assertEqual(run_program(self.path, 'convert'), 1)
+
+    def print_file(self, *args):
+        # print writes bytes, use a real file as stdout
+        with tempfile.TemporaryFile('w+') as out:
+            old_stdout, old_stderr = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = out, StringIO()
+            try:
+                file_archive.main.main([self.path, 'print'] + list(args))
+            except SystemExit as e:
+                ret = e.code
+            finally:
+                sys.stdout, sys.stderr = old_stdout, old_stderr
+            out.flush()
+            out.buffer.seek(0)
+            return ret, out.buffer.read()
+
+    @unittest.skipIf(sys.version_info < (3,), "Needs io stdout")
+    def test_print(self):
+        entry = self.store.add_file(self.t('file1.bin'), {'a': 'b'})
+        with open(self.t('file1.bin'), 'rb') as fp:
+            content = fp.read()
+        self.assertEqual(self.print_file(entry.objectid), (0, content))
+        self.assertEqual(self.print_file('a=b'), (0, content))
+        self.assertEqual(self.print_file('a=c')[0], 2)
+
+        self.assertEqual(self.print_file('-r', '5:14', entry.objectid),
+                         (0, content[5:14]))
+        self.assertEqual(self.print_file('--range', '20:', entry.objectid),
+                         (0, content[20:]))
+        self.assertEqual(self.print_file('-r', ':4', entry.objectid),
+                         (0, content[:4]))
+        self.assertEqual(self.print_file('-r', '4:2', entry.objectid)[0], 1)
+        self.assertEqual(self.print_file('-r', 'a', entry.objectid)[0], 1)
+
+        # Works without sendfile() too
+        sendfile = getattr(os, 'sendfile', None)
+        if sendfile is not None:
+            del os.sendfile
+        try:
+            self.assertEqual(self.print_file(entry.objectid), (0, content))
+            self.assertEqual(self.print_file('-r', '5:14', entry.objectid),
+                             (0, content[5:14]))
+        finally:
+            if sendfile is not None:
+                os.sendfile = sendfile
 
 
 @contextlib.contextmanager
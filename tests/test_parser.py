@@ -6,7 +6,8 @@ try:
 except ImportError:
     import unittest
 
-from file_archive.parser import parse_expression, parse_expressions
+from file_archive.parser import parse_expression, parse_expressions, \
+    match_conditions, narrows_conditions
 
 
 class TestParser(unittest.TestCase):
@@ -81,3 +82,65 @@ class TestParser(unittest.TestCase):
             parse_expressions(['"somevalue":int'])
         with self.assertRaises(tdparser.ParserError):
             parse_expressions(['key1:notatype'])
+
+    def test_match(self):
+        conditions = parse_expression('key1=-12 key2:str key3>2 key3<5')
+        self.assertTrue(match_conditions(
+            conditions, {'key1': -12, 'key2': 'a', 'key3': 3, 'other': 1}))
+        self.assertFalse(match_conditions(
+            conditions, {'key1': -12, 'key2': 'a', 'key3': 5}))
+        self.assertFalse(match_conditions(
+            conditions, {'key1': -12, 'key2': 1, 'key3': 3}))
+        self.assertFalse(match_conditions(
+            conditions, {'key1': '-12', 'key2': 'a', 'key3': 3}))
+        self.assertFalse(match_conditions(conditions, {'key1': -12}))
+        self.assertTrue(match_conditions({}, {'key1': -12}))
+
+    def test_narrows(self):
+        previous = parse_expression('key1="a" key2>2')
+        self.assertTrue(narrows_conditions(previous, previous))
+        self.assertTrue(narrows_conditions(
+            parse_expression('key1="a" key2>2 key3:int'), previous))
+        self.assertTrue(narrows_conditions(
+            parse_expression('key1="a" key2>4 key2<10'), previous))
+        self.assertFalse(narrows_conditions(
+            parse_expression('key1="a" key2>1'), previous))
+        self.assertFalse(narrows_conditions(
+            parse_expression('key1="ab" key2>2'), previous))
+        self.assertFalse(narrows_conditions(
+            parse_expression('key2>2'), previous))
+        self.assertFalse(narrows_conditions(
+            parse_expression('key1:str key2>2'), previous))
+        self.assertTrue(narrows_conditions(previous, {}))
+        # The store doesn't support comparisons on strings
+        self.assertFalse(narrows_conditions(
+            parse_expression('key1:str key1<"b"'),
+            parse_expression('key1:str')))
+
+    def test_lexer(self):
+        from file_archive.parser import _lex, lexer
+
+        def tokens(lex, expression):
+            try:
+                return [(type(t), t.text) for t in lex(expression)]
+            except tdparser.LexerError as e:
+                return e.position
+
+        for expression in ['key1=-12 key2 = "4 2"\tkey3:int 41< key4',
+                           r'key1="some \"string\""', r'key1="some \"str',
+                           'key6!"somethg', 'key4=', '  ', 'a=-', '']:
+            self.assertEqual(tokens(_lex, expression),
+                             tokens(lexer.lex, expression))
+
+    def test_cache(self):
+        conditions = parse_expression('key1>2 key2="a"')
+        conditions['key1']['lt'] = 4
+        del conditions['key2']
+        self.assertEqual(parse_expression('key1>2 key2="a"'),
+                         {'key1': {'type': 'int', 'gt': 2},
+                          'key2': {'type': 'str', 'equal': 'a'}})
+        conditions = parse_expressions(['key1>2', 'key2="a"'])
+        conditions['key1']['lt'] = 4
+        self.assertEqual(parse_expressions(['key1>2', 'key2="a"']),
+                         {'key1': {'type': 'int', 'gt': 2},
+                          'key2': {'type': 'str', 'equal': 'a'}})